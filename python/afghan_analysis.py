@@ -0,0 +1,629 @@
+# Description: A single command-line entry point for the analyses, e.g.
+#
+#       python afghan_analysis.py turnout --election first-round
+#       python afghan_analysis.py vote-share --candidate Ghani \
+#               --province Paktika --output-dir /tmp/out
+#       python afghan_analysis.py serve --port 8642
+#
+# Subcommands (each one draws its figures with the same function as the
+# script named after it):
+#       * turnout - District turnout (sorted, highest first) and its
+#         histograms (turnout_distrib.py).
+#       * margin - Ghani's province and district winning margins vs turnout
+#         (winning_margin_analysis.py).
+#       * vote-share - A candidate's district vote share vs turnout, with a
+#         linear fit and its residuals (vote_share_vs_t.py), or with
+#         --province, the polling station vote share distribution in that
+#         province (province_vote_share_hist.py).
+#       * v-over-e - A candidate's district V/E vs turnout, with a fit and
+#         its residuals (v_over_e_vs_t.py).
+#       * observers - The district observer table and scatterplot from
+#         observer_district_trends.py (this always uses both rounds).
+#       * digits - Last-digit test of each candidate's votes at the polling
+#         stations they won (like R/station_last_digit.R).
+#       * fingerprint - The polling station (turnout, vote share)
+#         fingerprint used by fraud_model_fit.py.
+#       * all - Every analysis above, with its default options, in one
+#         process. Each input file is read only once (see the data cache in
+#         afghan_functions.py).
+#       * serve - Keep the datasets loaded, and answer requests on a local
+#         socket. Each request is one line with the same arguments as the
+#         command line (e.g. "turnout --election runoff"), and each
+#         response is one line of JSON with "ok" and "outputs" (the files
+#         written) or "error".
+#
+# Every analysis writes a CSV file and (unless --no-plots is given) its PNG
+# files to --output-dir, named after the election and analysis. For the
+# runoff, the district analyses use the same data as their scripts. The
+# scripts only cover the runoff, so for the first round, the district data
+# comes from the summary cube (see summary_cube.py), which is built in
+# memory and never saved from here. With --data-backend store, the
+# province and district getters of afghan_functions.py read from the
+# SQLite store (see election_store.py) instead of parsing their CSV file.
+#
+# Inputs:
+#       * The inputs of summary_cube.py, turnout_distrib.py,
+#         winning_margin_analysis.py and observer_district_trends.py
+#
+
+
+import os
+import csv
+import json
+import shlex
+import argparse
+import numpy as np
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# Plots are only ever saved to file.
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from lazy_imports import lazyImport
+
+# Import some convenience functions
+from afghan_functions import getProvinceNumToTurnoutRunoff,\
+        getProvinceDistrictToTurnoutRunoff, populateProvinceNumToName,\
+        populateProvinceNameToPop, setDataBackend
+from summary_cube import getSummaryCube, getStationRows,\
+        getCubeDistrictTurnouts
+from histogram_engine import computeHistograms, renderHistogramFigures
+from turnout_distrib import getDistrictTurnoutArrays,\
+        getTurnoutHistogramSpecs, getTurnoutFigureJobs
+from winning_margin_analysis import getProvinceNumToGhaniWinningMargin,\
+        getProvinceDistrictToGhaniWinningMargin, plotWinningMarginAnalysis
+from vote_share_vs_t import getProvinceDistrictToVoteShare,\
+        plotVoteShareVsT
+from v_over_e_vs_t import getProvinceDistrictToVOverE, plotVOverEVsT
+from province_vote_share_hist import plotProvinceVoteShareDistrib
+from observer_district_trends import getDistrictObserverTable,\
+        plotTurnoutChangeVsObsChange
+from fraud_model_fit import getFingerprint
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+stats = lazyImport("scipy.stats")
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION, STATION_CAPACITY,\
+        ABDULLAH_COLOR, GHANI_COLOR, MIN_DIGIT_VOTES, MAX_DIGIT_VOTES
+from fraud_model_fit import NUM_FINGERPRINT_BINS
+from summary_cube import ELECTIONS, CANDIDATE_COLUMNS
+from afghan_functions import DATA_BACKENDS
+
+# The --election choices, and the summary cube election each maps to.
+ELECTION_NAMES = {"runoff": "Runoff", "first-round": "FirstRound"}
+
+CANDIDATE_COLORS = {"Abdullah": ABDULLAH_COLOR, "Ghani": GHANI_COLOR}
+
+# The default port for serve mode (it only listens on localhost).
+DEFAULT_PORT = 8642
+
+# DIRECTORIES
+OUTPUT_DIR = "../analysis_output/"
+
+
+# This function returns the column index of each runoff candidate in the
+# polling station votes of an election (see summary_cube.py).
+#
+def getCandidateIndices(election):
+    candidates = ELECTIONS[election][1]
+
+    return dict((candidate, candidates.index(column))
+            for candidate, column in CANDIDATE_COLUMNS[election].items())
+
+
+# This function returns the district data of an election from its summary
+# cube: the cube, the mask of its districts that have a turnout (i.e. a
+# population and votes), the turnouts of all of its districts, and the
+# (Province, DistrictId) key of each masked district.
+#
+def getCubeDistrictData(election):
+    cube = getSummaryCube(election, saveCube = False)
+    turnouts = getCubeDistrictTurnouts(cube)
+    valid = np.isfinite(turnouts) & (cube["DistrictVotes"] > 0)
+    keys = list(zip(cube["Provinces"][valid], cube["DistrictIds"][valid]))
+
+    return cube, valid, turnouts, keys
+
+
+# This function returns the province number to value dictionary of the
+# given per-district values in a cube, where each province's value is
+# 100 * the sum of its numerators / the sum of its denominators. If
+# denominators is None, each province's eligible voters (its population
+# times VOTING_FRACTION) are used instead.
+#
+def getCubeProvinceNumToValue(cube, numerators, denominators = None):
+    provinceNameToPop = populateProvinceNameToPop()
+    provinceNumToValue = dict()
+
+    for provinceNum, provinceName in populateProvinceNumToName().items():
+        inProvince = cube["Provinces"] == provinceName
+
+        if denominators is None:
+            denominator = provinceNameToPop[provinceName] * VOTING_FRACTION
+        else:
+            denominator = denominators[inProvince].sum()
+
+        provinceNumToValue[provinceNum] = 100.0 * \
+                numerators[inProvince].sum() / denominator
+
+    return provinceNumToValue
+
+
+# This function returns the path of an output file for the given analysis.
+#
+def getOutputFile(options, name, extension):
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    return os.path.join(options.output_dir, options.election.replace(
+            "-", "_") + "_" + name + "." + extension)
+
+
+# This function writes a CSV file with the given header and columns, and
+# returns its path.
+#
+def writeColumns(options, name, header, columns):
+    outputFile = getOutputFile(options, name, "csv")
+
+    with open(outputFile, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(header)
+        csvWriter.writerows(zip(*columns))
+
+    return outputFile
+
+
+# This function saves and closes the current figure, and returns its path.
+#
+def saveFigure(options, name):
+    outputFile = getOutputFile(options, name, "png")
+    plt.savefig(outputFile, bbox_inches = "tight")
+    plt.close()
+
+    return outputFile
+
+
+# This function writes a CSV file with the turnout and one other value of
+# each district, given dictionaries that map (Province, District) keys to
+# them, and returns its path.
+#
+def writeDistrictColumns(options, name, valueName, provinceDistrictToTurnout,
+                         provinceDistrictToValue):
+    keys = sorted(provinceDistrictToTurnout)
+
+    return writeColumns(options, name,
+            ["Province", "District", "TurnoutPercent", valueName],
+            [[key[0] for key in keys], [key[1] for key in keys],
+             [provinceDistrictToTurnout[key] for key in keys],
+             [provinceDistrictToValue[key] for key in keys]])
+
+
+# This function returns the (Province, District) to turnout and (Province,
+# District) to value dictionaries of a candidate's district analysis. For
+# the runoff, these come from runoffFunction(candidate) (the analysis
+# script's own function) and the runoff turnouts. For the first round,
+# they come from the summary cube, and the value is 100 * the candidate's
+# votes divided by the cube's "DistrictVotes" (or, if byEligible is True,
+# by the district's eligible voters).
+#
+def getCandidateDistrictDicts(options, candidate, runoffFunction,
+                              byEligible):
+    election = ELECTION_NAMES[options.election]
+
+    if election == "Runoff":
+        return getProvinceDistrictToTurnoutRunoff(),\
+                runoffFunction(candidate)
+
+    cube, valid, turnouts, keys = getCubeDistrictData(election)
+    votes = cube["Votes"].sum(axis = 1)[valid,
+            getCandidateIndices(election)[candidate]]
+
+    if byEligible:
+        values = 100.0 * votes / (cube["Population"][valid] *
+                                  VOTING_FRACTION)
+    else:
+        values = 100.0 * votes / cube["DistrictVotes"][valid]
+
+    return dict(zip(keys, turnouts[valid])), dict(zip(keys, values))
+
+
+# The "turnout" subcommand.
+#
+def runTurnout(options):
+    election = ELECTION_NAMES[options.election]
+    turnoutArrays = getDistrictTurnoutArrays()
+    arrays = turnoutArrays[election]
+    order = np.argsort(-arrays["Turnouts"], kind = 'mergesort')
+    outputs = [writeColumns(options, "turnout",
+            ["ProvinceName", "DistrictName", "TurnoutPercent"],
+            [arrays["Provinces"][order], arrays["Districts"][order],
+             arrays["Turnouts"][order]])]
+
+    if not options.no_plots:
+        figureFiles = (getOutputFile(options, "turnout_distrib_entire",
+                                     "png"),
+                       getOutputFile(options, "turnout_distrib_restricted",
+                                     "png"))
+        histograms = computeHistograms(getTurnoutHistogramSpecs(
+                turnoutArrays))
+        renderHistogramFigures(getTurnoutFigureJobs(histograms,
+                                                    {election: figureFiles}))
+        outputs += list(figureFiles)
+
+    return outputs
+
+
+# The "margin" subcommand.
+#
+def runMargin(options):
+    election = ELECTION_NAMES[options.election]
+
+    if election == "Runoff":
+        provinceNumToTurnout = getProvinceNumToTurnoutRunoff()
+        provinceNumToGhaniWinningMargin = \
+                getProvinceNumToGhaniWinningMargin()
+        provinceDistrictToTurnout = getProvinceDistrictToTurnoutRunoff()
+        provinceDistrictToGhaniWinningMargin = \
+                getProvinceDistrictToGhaniWinningMargin()
+    else:
+        cube, valid, turnouts, keys = getCubeDistrictData(election)
+        candidateIndices = getCandidateIndices(election)
+        votes = cube["Votes"].sum(axis = 1)
+        marginVotes = votes[:, candidateIndices["Ghani"]] - \
+                votes[:, candidateIndices["Abdullah"]]
+
+        provinceNumToTurnout = getCubeProvinceNumToValue(cube,
+                cube["DistrictVotes"])
+        provinceNumToGhaniWinningMargin = getCubeProvinceNumToValue(cube,
+                marginVotes, cube["DistrictVotes"])
+        provinceDistrictToTurnout = dict(zip(keys, turnouts[valid]))
+        provinceDistrictToGhaniWinningMargin = dict(zip(keys, 100.0 *
+                marginVotes[valid] / cube["DistrictVotes"][valid]))
+
+    outputs = [writeDistrictColumns(options, "ghani_winning_margin",
+                                    "GhaniWinningMargin",
+                                    provinceDistrictToTurnout,
+                                    provinceDistrictToGhaniWinningMargin)]
+
+    if not options.no_plots:
+        figureFiles = [getOutputFile(options, name, "png") for name in
+                       ["wma_by_province", "wma_by_district"]]
+        plotWinningMarginAnalysis(provinceNumToTurnout,
+                                  provinceNumToGhaniWinningMargin,
+                                  provinceDistrictToTurnout,
+                                  provinceDistrictToGhaniWinningMargin,
+                                  *figureFiles)
+        outputs += figureFiles
+
+    return outputs
+
+
+# The "vote-share" subcommand.
+#
+def runVoteShare(options):
+    if options.province != None:
+        return runProvinceVoteShare(options)
+
+    provinceDistrictToTurnout, provinceDistrictToVoteShare = \
+            getCandidateDistrictDicts(options, options.candidate,
+                                      getProvinceDistrictToVoteShare, False)
+
+    name = options.candidate.lower() + "_vote_share_vs_t"
+    outputs = [writeDistrictColumns(options, name, "VoteShare",
+                                    provinceDistrictToTurnout,
+                                    provinceDistrictToVoteShare)]
+
+    if not options.no_plots:
+        figureFiles = [getOutputFile(options, name, "png"),
+                       getOutputFile(options, name + "_resid", "png")]
+        plotVoteShareVsT(options.candidate,
+                         provinceDistrictToVoteShare,
+                         provinceDistrictToTurnout,
+                         "VS vs T for " + options.candidate,
+                         "VS vs T Residuals for " + options.candidate,
+                         CANDIDATE_COLORS[options.candidate],
+                         *figureFiles)
+        outputs += figureFiles
+
+    return outputs
+
+
+# The "vote-share" subcommand, for the polling stations of one province.
+#
+def runProvinceVoteShare(options):
+    election = ELECTION_NAMES[options.election]
+    districtIds, provinces, votes = getStationRows(election)
+    candidateIndex = getCandidateIndices(election)[options.candidate]
+
+    inProvince = np.char.lower(provinces.astype(str)) == \
+            options.province.lower()
+    totals = votes[inProvince].sum(axis = 1)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        voteShares = 100.0 * votes[inProvince, candidateIndex] / totals
+
+    voteShares = voteShares[totals > 0]
+    name = options.candidate.lower() + "_" + \
+            options.province.lower().replace(" ", "_") + "_distrib"
+    outputs = [writeColumns(options, name, ["VoteShare"], [voteShares])]
+
+    if not options.no_plots:
+        outputs.append(getOutputFile(options, name, "png"))
+        plotProvinceVoteShareDistrib(options.candidate, options.province,
+                                     outputs[-1], election)
+
+    return outputs
+
+
+# The "v-over-e" subcommand.
+#
+def runVOverE(options):
+    provinceDistrictToTurnout, provinceDistrictToVOverE = \
+            getCandidateDistrictDicts(options, options.candidate,
+                                      getProvinceDistrictToVOverE, True)
+
+    name = options.candidate.lower() + "_v_over_e_vs_t"
+    outputs = [writeDistrictColumns(options, name, "VOverE",
+                                    provinceDistrictToTurnout,
+                                    provinceDistrictToVOverE)]
+
+    if not options.no_plots:
+        figureFiles = [getOutputFile(options, name, "png"),
+                       getOutputFile(options, name + "_resid", "png")]
+        plotVOverEVsT(options.candidate,
+                      provinceDistrictToVOverE,
+                      provinceDistrictToTurnout,
+                      "V/E vs T for " + options.candidate,
+                      "V/E vs T Residuals for " + options.candidate,
+                      CANDIDATE_COLORS[options.candidate],
+                      *figureFiles)
+        outputs += figureFiles
+
+    return outputs
+
+
+# The "observers" subcommand.
+#
+def runObservers(options):
+    table = getDistrictObserverTable()
+    columns = ["DistrictId", "Population", "FirstRoundTurnout",
+               "RunoffTurnout", "FirstRoundObsDensity", "RunoffObsDensity",
+               "TurnoutChange", "ObsDensityChange"]
+    outputs = [writeColumns(options, "district_observers", columns,
+                            [table[column] for column in columns])]
+
+    if not options.no_plots:
+        outputs.append(getOutputFile(options, "district_observers", "png"))
+        plotTurnoutChangeVsObsChange(table, outputs[-1])
+
+    return outputs
+
+
+# The "digits" subcommand. For each candidate, this counts the last digits
+# of their votes at the polling stations they won (with between
+# MIN_DIGIT_VOTES and MAX_DIGIT_VOTES votes), and tests them against a
+# uniform distribution with a chi-squared test.
+#
+def runDigits(options):
+    election = ELECTION_NAMES[options.election]
+    votes = getStationRows(election)[2]
+    indices = getCandidateIndices(election)
+
+    outputs = list()
+
+    for candidate in sorted(indices):
+        otherIndices = [index for index in range(votes.shape[1])
+                        if index != indices[candidate]]
+        candidateVotes = votes[:, indices[candidate]]
+        won = candidateVotes > votes[:, otherIndices].max(axis = 1)
+        used = won & (candidateVotes >= MIN_DIGIT_VOTES) & \
+                (candidateVotes <= MAX_DIGIT_VOTES)
+
+        digitCounts = np.bincount(candidateVotes[used].astype(int) % 10,
+                                  minlength = 10)
+        expected = digitCounts.sum() / 10.0
+        chiSquared = ((digitCounts - expected) ** 2 / expected).sum()
+        pValue = stats.chi2.sf(chiSquared, 9)
+
+        print(candidate + " last digits: chi-squared " + str(chiSquared) +\
+              ", p-value " + str(pValue))
+
+        name = candidate.lower() + "_last_digit"
+        outputs.append(writeColumns(options, name,
+                ["Digit", "Count", "Expected"],
+                [np.arange(10), digitCounts, np.full(10, expected)]))
+
+        if not options.no_plots:
+            fig = plt.figure()
+            fig.set_facecolor('white')
+            plt.bar(np.arange(10), digitCounts, 0.8,
+                    color = CANDIDATE_COLORS[candidate])
+            plt.plot([-0.5, 9.5], [expected, expected], 'k--')
+            plt.xlabel("Least Significant Digit")
+            plt.ylabel("Count")
+            plt.title("Last-Digit Analysis for " + candidate + "'s Votes " +\
+                      "in " + candidate + "-Won Polling Stations")
+            outputs.append(saveFigure(options, name))
+
+    return outputs
+
+
+# The "fingerprint" subcommand.
+#
+def runFingerprint(options):
+    election = ELECTION_NAMES[options.election]
+    votes = getStationRows(election)[2]
+    candidateIndex = getCandidateIndices(election)[options.candidate]
+
+    totals = votes.sum(axis = 1)
+    voted = totals > 0
+    turnouts = np.minimum(totals[voted] / float(STATION_CAPACITY), 1.0)
+    shares = votes[voted, candidateIndex] / totals[voted]
+    fingerprint = getFingerprint(turnouts, shares).reshape(
+            NUM_FINGERPRINT_BINS, NUM_FINGERPRINT_BINS)
+
+    binCenters = (np.arange(NUM_FINGERPRINT_BINS) + 0.5) / \
+            NUM_FINGERPRINT_BINS
+    turnoutCenters, shareCenters = np.meshgrid(binCenters, binCenters,
+                                               indexing = 'ij')
+    name = options.candidate.lower() + "_fingerprint"
+    outputs = [writeColumns(options, name,
+            ["TurnoutBinCenter", "VoteShareBinCenter", "Fraction"],
+            [turnoutCenters.ravel(), shareCenters.ravel(),
+             fingerprint.ravel()])]
+
+    if not options.no_plots:
+        fig = plt.figure()
+        fig.set_facecolor('white')
+        plt.imshow(fingerprint.T, origin = 'lower', extent = [0, 1, 0, 1],
+                   cmap = 'Greys', interpolation = 'nearest')
+        plt.xlabel("Turnout (Votes / Station Capacity)")
+        plt.ylabel(options.candidate + "'s Vote Share")
+        plt.title(options.candidate + "'s Election Fingerprint")
+        outputs.append(saveFigure(options, name))
+
+    return outputs
+
+
+# This function runs every other analysis for the chosen election, with
+# their default options.
+#
+def runAll(options):
+    outputs = list()
+
+    for command in sorted(ANALYSES):
+        if command == "all":
+            continue
+
+        arguments = [command, "--election", options.election,
+                     "--output-dir", options.output_dir]
+
+        if options.no_plots:
+            arguments.append("--no-plots")
+
+        outputs += runAnalysis(getArgumentParser().parse_args(arguments))
+
+    return outputs
+
+
+# The analysis subcommands, and the function that runs each one.
+ANALYSES = {
+    "all": runAll,
+    "turnout": runTurnout,
+    "margin": runMargin,
+    "vote-share": runVoteShare,
+    "v-over-e": runVOverE,
+    "observers": runObservers,
+    "digits": runDigits,
+    "fingerprint": runFingerprint,
+}
+
+
+# This function returns the argument parser for the command line (and for
+# serve mode requests).
+#
+def getArgumentParser():
+    parser = argparse.ArgumentParser(prog = "afghan-analysis",
+            description = "Analyses of the 2014 Afghan presidential " +\
+                    "election.")
+    subparsers = parser.add_subparsers(dest = "command")
+
+    # Python 3 makes subcommands optional by default.
+    subparsers.required = True
+
+    for command in sorted(ANALYSES):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument("--election", choices = sorted(ELECTION_NAMES),
+                               default = "runoff")
+        subparser.add_argument("--output-dir", default = OUTPUT_DIR)
+        subparser.add_argument("--no-plots", action = "store_true",
+                               help = "only write the CSV output")
+        subparser.add_argument("--data-backend", choices = DATA_BACKENDS,
+                               default = "csv")
+
+        if command in ["vote-share", "v-over-e", "fingerprint"]:
+            subparser.add_argument("--candidate",
+                                   choices = sorted(CANDIDATE_COLORS),
+                                   default = "Ghani")
+
+        if command == "vote-share":
+            subparser.add_argument("--province", default = None,
+                    help = "plot the polling station distribution for " +\
+                            "this province")
+
+    serveParser = subparsers.add_parser("serve")
+    serveParser.add_argument("--port", type = int, default = DEFAULT_PORT)
+
+    return parser
+
+
+# This function runs one analysis from its parsed options, and returns the
+# list of files written.
+#
+def runAnalysis(options):
+    setDataBackend(options.data_backend)
+
+    return ANALYSES[options.command](options)
+
+
+# A serve mode connection. Each line is one request.
+#
+class AnalysisRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode("utf-8").strip()
+
+            if not line:
+                continue
+
+            try:
+                options = getArgumentParser().parse_args(shlex.split(line))
+
+                if options.command not in ANALYSES:
+                    raise ValueError("Only analyses can be requested")
+
+                response = {"ok": True, "outputs": runAnalysis(options)}
+            except SystemExit:
+                # argparse exits on bad arguments.
+                response = {"ok": False, "error": "bad arguments: " + line}
+            except Exception as error:
+                response = {"ok": False, "error": repr(error)}
+
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+# This function keeps serving analysis requests on localhost:port. Since
+# the datasets are kept in the process-wide cache (see afghan_functions.py),
+# only the first request that needs an input pays for reading it.
+#
+def serve(port):
+    socketserver.TCPServer.allow_reuse_address = True
+    server = socketserver.TCPServer(("127.0.0.1", port),
+                                    AnalysisRequestHandler)
+    print("Serving analysis requests on 127.0.0.1:" + str(port))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# Main code
+if __name__ == "__main__":
+    options = getArgumentParser().parse_args()
+
+    if options.command == "serve":
+        serve(options.port)
+    else:
+        for outputFile in runAnalysis(options):
+            print("Saved " + outputFile)
@@ -19,3 +19,13 @@ VOTING_FRACTION = VOTING_AGE_POPULATION/float(AFGHAN_POPULATION)
 # Colors to use for the two candidates' plots.
 ABDULLAH_COLOR = "#FFAE19"
 GHANI_COLOR = "#72AFE4"
+
+# The number of ballots allocated to each polling station. No station can
+# report more votes than this, so the total votes at a station divided by
+# this number is a proxy for that station's turnout.
+STATION_CAPACITY = 600
+
+# The range of polling station vote counts used in the last-digit test.
+# Counts below 10 only have one digit.
+MIN_DIGIT_VOTES = 10
+MAX_DIGIT_VOTES = STATION_CAPACITY - 1
@@ -2,8 +2,19 @@
 # Description: A set of functions that are commonly used in various
 # modules.
 
-import csv
+import sys
+import math
 import numpy as np
+from lazy_imports import lazyImport, lazyFunction
+
+
+# The bulk CSV parser, imported on first use (bulk_csv.py imports this
+# module).
+readCsvColumns = lazyFunction("bulk_csv", "readCsvColumns")
+
+# The SQLite store, imported on first use (election_store.py imports this
+# module).
+electionStore = lazyImport("election_store")
 
 
 # Constants
@@ -11,6 +22,20 @@ import numpy as np
 # VALUES
 from afghan_constants import VOTING_FRACTION
 
+# The number of trailing digits in a PC_number that identify the polling
+# center within its district. Dropping them gives the IEC district ID.
+POLLING_CENTER_DIGITS = 3
+
+# The province (and district) of the runoff polling stations that aren't
+# assigned to one. These stations are left out of every analysis (as they
+# are out of ../clean_data/runoff_votes_and_turnout.csv).
+UNASSIGNED_PROVINCE = "NA"
+
+# The backends that the province and district getters below can read
+# from: "csv" parses RUNOFF_TURNOUT_FILE, and "store" queries the indexed
+# SQLite store (see election_store.py, which has the same getters).
+DATA_BACKENDS = ["csv", "store"]
+
 # DIRECTORIES
 RAW_DATA_DIR = "../raw_data/"
 CLEAN_DATA_DIR = "../clean_data/"
@@ -24,76 +49,198 @@ RUNOFF_TURNOUT_FILE = CLEAN_DATA_DIR + "runoff_votes_and_turnout.csv"
 
 # Global variables
 
-# Dicts to track province data (cached to avoid regeneration).
-provinceNumToName = None
-provinceNameToPop = None
-provinceDistrictToPop = None
+# The process-wide data cache. Every module gets its shared data (CSV rows,
+# lookup dicts and derived arrays) through getCachedData(), so running
+# several analyses in one process loads each input only once. Cached values
+# are shared, and must not be modified by callers.
+dataCache = dict()
 
+# The backend that the getters read from (see setDataBackend()).
+dataBackend = "csv"
 
-# This function populates a dictionary that maps province numbers to
-# province names. This dictionary is stored in the global variable
-# provinceNumToName.
+
+# This function returns the cached value for "key", calling loader() (a
+# function with no arguments) to create it the first time.
 #
-# The number for each province is assigned by finding its index in a list
-# of sorted province names.
+def getCachedData(key, loader):
+    if key not in dataCache:
+        dataCache[key] = loader()
+
+    return dataCache[key]
+
+
+# This function empties the data cache, e.g. after the input files have
+# changed.
 #
-def populateProvinceNumToName():
-    global provinceNumToName
+def clearDataCache():
+    dataCache.clear()
+
 
-    # If it's already populated, there's nothing to do.
-    if provinceNumToName != None:
-        return provinceNumToName
+# This function sets the backend that the province and district getters
+# read from (one of DATA_BACKENDS). Switching backends empties the data
+# cache, so nothing derived from the other backend is kept.
+#
+def setDataBackend(backend):
+    global dataBackend
 
-    provinceNumToName = getProvinceNumToName()
+    if backend not in DATA_BACKENDS:
+        raise ValueError("Unknown data backend " + str(backend))
 
-    return provinceNumToName
+    if backend != dataBackend:
+        clearDataCache()
+        dataBackend = backend
 
 
-# This function populates a dictionary that maps province names to their
-# populations. This uses the data in RUNOFF_TURNOUT_FILE. The dictionary is
-# then stored in the global variable provinceNameToPop.
+# This function opens a CSV file for the csv module, in both Python 2 and 3.
+# Some of the files have bare CR line ends, which Python 2 only splits
+# lines at in 'rU' mode, and Python 3 (which has no 'rU' mode) in text mode
+# with newline=''. In Python 3, the file is decoded with the given encoding
+# (by default, the locale's); Python 2 reads it as bytes.
 #
-def populateProvinceNameToPop():
-    global provinceNameToPop
+def openCsvFile(fileName, encoding = None):
+    if sys.version_info[0] < 3:
+        return open(fileName, 'rU')
 
-    # If it's already populated, there's nothing to do.
-    if provinceNameToPop != None:
-        return provinceNameToPop
+    return open(fileName, newline = '', encoding = encoding)
 
-    provinceNameToPop = getProvinceNameToPop()
 
-    return provinceNameToPop
+# This function returns the rows of a CSV file (with a header row) as a
+# list of dictionaries of strings, as csv.DictReader would. The rows are
+# made from the cached columns (see getCsvColumns()), so a file is only
+# parsed once per process, however it is read. Numbers are written back
+# as Python would print them (without a ".0" for whole numbers), and empty
+# numeric fields as empty strings.
+#
+def getCsvRows(fileName):
+    def toStrings(column):
+        if column.dtype.kind != "f":
+            return [str(value) for value in column.tolist()]
+
+        return ["" if math.isnan(value) else "%d" % value
+                if value.is_integer() else repr(value)
+                for value in column.tolist()]
+
+    def readCsvRows():
+        columns = getCsvColumns(fileName)
+        names = list(columns)
+        values = [toStrings(columns[name]) for name in names]
+
+        return [dict(zip(names, row)) for row in zip(*values)]
 
+    return getCachedData(("CsvRows", fileName), readCsvRows)
 
-# This function populates a dictionary that maps (Province, District)
-# tuples to their populations.
+
+# This function returns the columns of a CSV file (with a header row) as a
+# dictionary that maps each column name to a typed NumPy array (see
+# bulk_csv.py). Unlike getCsvRows(), this keeps no Python object per cell,
+# so it is what the polling station readers use. The columns are read once
+# per process and cached.
 #
-def populateProvinceDistrictToPop():
-    global provinceDistrictToPop
+def getCsvColumns(fileName):
+    return getCachedData(("CsvColumns", fileName),
+                         lambda: readCsvColumns(fileName)[1])
 
-    # If it's already populated, just return.
-    if provinceDistrictToPop != None:
-        return provinceDistrictToPop
 
-    provinceDistrictToPop = getProvinceDistrictToPop()
+# This function converts an array of PC_numbers to IEC district IDs, by
+# dropping the trailing polling center digits.
+#
+def pcNumbersToDistrictIds(pcNumbers):
+    return np.asarray(pcNumbers, dtype = np.int64) // \
+            10**POLLING_CENTER_DIGITS
 
-    return provinceDistrictToPop
+
+# This function sums "values" over the rows that share a key, using a
+# single np.unique/np.bincount pass. It returns the sorted unique keys and
+# the matching sums. "values" may be 1-D (one value per row) or 2-D (one
+# row of values per key).
+#
+def sumByKey(keys, values):
+    uniqueKeys, inverse = np.unique(np.asarray(keys), return_inverse = True)
+    values = np.asarray(values, dtype = float)
+
+    if values.ndim == 1:
+        return uniqueKeys, np.bincount(inverse, weights = values,
+                                       minlength = len(uniqueKeys))
+
+    sums = np.zeros((len(uniqueKeys), values.shape[1]))
+    np.add.at(sums, inverse, values)
+
+    return uniqueKeys, sums
+
+
+# This function aligns "values" (indexed by the sorted array "sourceKeys")
+# to the keys in "targetKeys". This is a vectorized left join: keys that
+# are missing from sourceKeys get fillValue.
+#
+def alignToKeys(targetKeys, sourceKeys, values, fillValue = np.nan):
+    targetKeys = np.asarray(targetKeys)
+    sourceKeys = np.asarray(sourceKeys)
+    values = np.asarray(values, dtype = float)
+
+    positions = np.searchsorted(sourceKeys, targetKeys)
+    positions = np.clip(positions, 0, max(len(sourceKeys) - 1, 0))
+    found = (len(sourceKeys) > 0) & (sourceKeys[positions] == targetKeys)
+
+    aligned = np.full((len(targetKeys),) + values.shape[1:], fillValue)
+    aligned[found] = values[positions[found]]
+
+    return aligned
+
+
+# This function returns the columns of a polling station vote file, like
+# getCsvColumns(), but without the stations that aren't assigned to a
+# province (see UNASSIGNED_PROVINCE). Everything that reads polling
+# stations from a file goes through this, so that every module counts the
+# same stations. The columns are cached.
+#
+def getStationColumns(votesFile):
+    def readStationColumns():
+        columns = getCsvColumns(votesFile)
+        provinceColumn = [name for name in columns
+                          if name.lower() == "province"][0]
+        assigned = columns[provinceColumn] != UNASSIGNED_PROVINCE
+
+        return dict((name, column[assigned])
+                    for name, column in columns.items())
+
+    return getCachedData(("StationColumns", votesFile), readStationColumns)
+
+
+# This function returns the cached dictionary that maps province numbers to
+# province names (see getProvinceNumToName()).
+#
+def populateProvinceNumToName():
+    return getCachedData("ProvinceNumToName", getProvinceNumToName)
+
+
+# This function returns the cached dictionary that maps province names to
+# their populations (see getProvinceNameToPop()).
+#
+def populateProvinceNameToPop():
+    return getCachedData("ProvinceNameToPop", getProvinceNameToPop)
+
+
+# This function returns the cached dictionary that maps (Province,
+# District) tuples to their populations (see getProvinceDistrictToPop()).
+#
+def populateProvinceDistrictToPop():
+    return getCachedData("ProvinceDistrictToPop", getProvinceDistrictToPop)
 
 
 # This function returns a dictionary that maps province numbers to province
 # names. The number for each province is assigned by finding its index in a
 # list of sorted province names. This requires using the data in
-# RUNOFF_TURNOUT_FILE.
+# RUNOFF_TURNOUT_FILE (or the store, see setDataBackend()).
 #
 def getProvinceNumToName():
+    if dataBackend == "store":
+        return electionStore.getProvinceNumToName()
+
     provinceSet = set()
 
     # Populate provinceSet by parsing RUNOFF_TURNOUT_FILE
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceSet.add(row['Province'])
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceSet.add(row['Province'])
 
     # Sort the list of provinces. Each province's number is just its index
     # in this sorted list.
@@ -108,23 +255,23 @@ def getProvinceNumToName():
 
 
 # This function returns a dictionary that maps province names to their
-# populations. This uses the data in RUNOFF_TURNOUT_FILE.
+# populations. This uses the data in RUNOFF_TURNOUT_FILE (or the store).
 #
 def getProvinceNameToPop():
+    if dataBackend == "store":
+        return electionStore.getProvinceNameToPop()
+
     provinceNameToPop = dict()
 
     # Populate provinceNameToPop by parsing RUNOFF_TURNOUT_FILE
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceName = row['Province']
+        districtPop = int(row['TotalPopulation'])
 
-        for row in csvReader:
-            provinceName = row['Province']
-            districtPop = int(row['TotalPopulation'])
-
-            if provinceName in provinceNameToPop:
-                provinceNameToPop[provinceName] += districtPop
-            else:
-                provinceNameToPop[provinceName] = districtPop
+        if provinceName in provinceNameToPop:
+            provinceNameToPop[provinceName] += districtPop
+        else:
+            provinceNameToPop[provinceName] = districtPop
 
     return provinceNameToPop
 
@@ -132,30 +279,30 @@ def getProvinceNameToPop():
 # This function returns a dictionary that maps (Province, District) tuples
 # to their populations. This is used to look up the population of a given
 # district (where the "Province" field is used for disambiguation
-# purposes).
+# purposes). This uses the data in RUNOFF_TURNOUT_FILE (or the store).
 #
 def getProvinceDistrictToPop():
+    if dataBackend == "store":
+        return electionStore.getProvinceDistrictToPop()
+
     provinceDistrictToPop = dict()
 
     # Populate provinceDistrictToPop by parsing RUNOFF_TURNOUT_FILE
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province']
-            districtName = row['District']
-            districtPop = int(row['TotalPopulation'])
-
-            if (provinceName, districtName) in provinceDistrictToPop:
-                # (Province, District) tuples shouldn't repeat in this
-                # dictionary.
-                raise Exception("Repeated (province, district)" +\
-                        "tuple (" + provinceName + ", " +\
-                        districtName + ") in " +\
-                        RUNOFF_TURNOUT_FILE + "!")
-            else:
-                provinceDistrictToPop[(provinceName, districtName)] = \
-                        districtPop
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceName = row['Province']
+        districtName = row['District']
+        districtPop = int(row['TotalPopulation'])
+
+        if (provinceName, districtName) in provinceDistrictToPop:
+            # (Province, District) tuples shouldn't repeat in this
+            # dictionary.
+            raise Exception("Repeated (province, district)" +\
+                    "tuple (" + provinceName + ", " +\
+                    districtName + ") in " +\
+                    RUNOFF_TURNOUT_FILE + "!")
+        else:
+            provinceDistrictToPop[(provinceName, districtName)] = \
+                    districtPop
 
     return provinceDistrictToPop
 
@@ -164,25 +311,24 @@ def getProvinceDistrictToPop():
 # turnout in that province (for the runoff election).
 #
 def getProvinceNumToTurnoutRunoff():
-    # Make sure provinceNumToName and provinceNameToPop are populated.
-    global provinceNumToName, provinceNameToPop
-    populateProvinceNumToName()
-    populateProvinceNameToPop()
+    if dataBackend == "store":
+        return electionStore.getProvinceNumToTurnoutRunoff()
+
+    # Get the (cached) province names and populations.
+    provinceNumToName = populateProvinceNumToName()
+    provinceNameToPop = populateProvinceNameToPop()
 
     # Get the number of people who voted in each province.
     provinceNameToNumVotes = dict()
 
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province']
-            numVoted = int(row['PopulationVoted'])
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceName = row['Province']
+        numVoted = int(row['PopulationVoted'])
 
-            if provinceName in provinceNameToNumVotes:
-                provinceNameToNumVotes[provinceName] += numVoted
-            else:
-                provinceNameToNumVotes[provinceName] = numVoted
+        if provinceName in provinceNameToNumVotes:
+            provinceNameToNumVotes[provinceName] += numVoted
+        else:
+            provinceNameToNumVotes[provinceName] = numVoted
 
     # Get the turnout in each province by dividing the number of votes in
     # that province by (its population times VOTING_FRACTION) and
@@ -206,29 +352,28 @@ def getProvinceNumToTurnoutRunoff():
 # to the turnout in that province (for the runoff election).
 #
 def getProvinceDistrictToTurnoutRunoff():
-    # Make sure provinceDistrictToPop is populated.
-    global provinceDistrictToPop
-    populateProvinceDistrictToPop()
+    if dataBackend == "store":
+        return electionStore.getProvinceDistrictToTurnoutRunoff()
+
+    # Get the (cached) district populations.
+    provinceDistrictToPop = populateProvinceDistrictToPop()
 
     # Get the number of people who voted in each district. This dictionary
     # maps (Province, District) tuples to the number of votes in that
     # district.
     provinceDistrictToNumVotes = dict()
 
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province']
-            districtName = row['District']
-            numVoted = int(row['PopulationVoted'])
-
-            if (provinceName, districtName) in provinceDistrictToNumVotes:
-                provinceDistrictToNumVotes[\
-                        (provinceName, districtName)] += numVoted
-            else:
-                provinceDistrictToNumVotes[\
-                        (provinceName, districtName)] = numVoted
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceName = row['Province']
+        districtName = row['District']
+        numVoted = int(row['PopulationVoted'])
+
+        if (provinceName, districtName) in provinceDistrictToNumVotes:
+            provinceDistrictToNumVotes[\
+                    (provinceName, districtName)] += numVoted
+        else:
+            provinceDistrictToNumVotes[\
+                    (provinceName, districtName)] = numVoted
 
     # Get the turnout in each district by dividing the number of votes in
     # that distrit by (its population times VOTING_FRACTION) and
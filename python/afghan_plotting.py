@@ -0,0 +1,107 @@
+# Description: Plotting functions that are shared by the analysis scripts.
+# These used to be copied into each script that needed them (with small
+# differences in colors and legend placement, which are now arguments).
+# Figures whose data and parameters haven't changed since they were last
+# saved aren't redrawn (see figure_cache.py).
+#
+
+
+import numpy as np
+from lazy_imports import lazyImport
+
+# Import some convenience functions
+from figure_cache import getFigureHash, isFigureCurrent, saveFigure
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+
+
+# Constants
+
+# The default bar colors of plotAndSaveBarGraph() and
+# plotAndSaveCombinedBarGraphs().
+BAR_COLOR = '#0000FF'
+COMBINED_BAR_COLORS = ('#FFFF00', '#3333FF')
+
+
+# This function plots the various kinds of bar graphs that the scripts
+# produce. It takes a dictionary of data, and various plot-related
+# parameters (e.g. axis labels), as well as the output file to which the
+# plot will be saved.
+#
+# Note: It is assumed that a figure has already been created via
+# plt.figure().
+#
+def plotAndSaveBarGraph(dataDict, xLabel, yLabel, plotTitle, outputFile,
+                        color = BAR_COLOR):
+
+    figureHash = getFigureHash(plotAndSaveBarGraph, dataDict, xLabel, yLabel,
+                               plotTitle, color,
+                               plt.gcf().get_size_inches())
+
+    if isFigureCurrent(outputFile, figureHash):
+        print("Bar graph in " + outputFile + " is up to date")
+        return
+
+    # Unpack the data into x and y (height).
+    keyValuePairs = np.array(list(dataDict.items()))
+    xValues = keyValuePairs[:, 0]
+    heights = keyValuePairs[:, 1]
+
+    plt.bar(xValues, heights, 1.0, color = color)
+    plt.xlabel(xLabel)
+    plt.ylabel(yLabel)
+    plt.title(plotTitle)
+
+    # Save plot and inform user.
+    saveFigure(outputFile, figureHash, bbox_inches = 'tight')
+
+    print("Saved bar graph to " + outputFile)
+
+
+# This function plots and saves two bar graphs that have the same x-axis.
+# It also includes a legend. The two bars for each x-value are separated by
+# "width" along the x-axis, and are drawn in the two "colors".
+#
+# Note: It is assumed that a figure has already been created via
+# plt.figure(). The figure and axes are passed in as arguments.
+#
+def plotAndSaveCombinedBarGraphs(fig, ax, firstDict, secondDict, width,
+        xLabel, yLabel, legendLabel1, legendLabel2, plotTitle, outputFile,
+        colors = COMBINED_BAR_COLORS, legendLocation = "upper right"):
+
+    figureHash = getFigureHash(plotAndSaveCombinedBarGraphs, firstDict,
+                               secondDict, width, xLabel, yLabel,
+                               legendLabel1, legendLabel2, plotTitle, colors,
+                               legendLocation, fig.get_size_inches())
+
+    if isFigureCurrent(outputFile, figureHash):
+        print("Combined bar graph in " + outputFile + " is up to date")
+        return
+
+    # Unpack the first dictionary to get the common x-values
+    keyValuePairs = np.array(list(firstDict.items()))
+    xValues = keyValuePairs[:, 0]
+    firstBarGraphHeights = list()
+    secondBarGraphHeights = list()
+
+    for xVal in xValues:
+        firstBarGraphHeights.append(firstDict[xVal])
+        secondBarGraphHeights.append(secondDict[xVal])
+
+    rects1 = ax.bar(xValues, firstBarGraphHeights, width,
+                    color = colors[0])
+    rects2 = ax.bar(xValues + width, secondBarGraphHeights,
+                    width, color = colors[1])
+    ax.set_xlabel(xLabel)
+    ax.set_ylabel(yLabel)
+    ax.set_title(plotTitle)
+
+    ax.legend((rects1[0], rects2[0]), \
+              (legendLabel1, legendLabel2),
+              loc = legendLocation,
+              prop = {"size": 10})
+
+    saveFigure(outputFile, figureHash, bbox_inches = 'tight')
+    print("Saved combined bar graph to\n" + outputFile)
@@ -0,0 +1,536 @@
+# Description: A bulk, parallel CSV parser for the large polling station
+# files. The readers elsewhere parse a whole file in one process, with one
+# Python object per cell. Here, a file is memory mapped and split into
+# chunks of whole lines, and each chunk is parsed into typed NumPy columns
+# in a worker process (each worker maps the file itself, so only the chunk
+# offsets and the finished columns are sent between processes). The
+# chunks' columns are then concatenated in order.
+#
+# Within a chunk, the fields are found with array operations on its bytes
+# (the positions of its commas and line ends), and integer columns are
+# parsed with integrity_check.parseIntegers(), so there is no Python object
+# per cell. Only columns that aren't all integers (floats and strings) go
+# through toTypedColumn(), and chunks with quoting beyond whole quoted
+# fields (e.g. a comma or an escaped quote inside one) are parsed with
+# csv.reader instead.
+#
+# Column types are inferred like columnar_tables.py always has (see
+# toTypedColumn()), one chunk at a time: integer chunks of different widths
+# and float chunks are promoted when they are concatenated, and if any
+# chunk of a column turns out to hold strings, that column is re-parsed as
+# strings in its other chunks, so that the result is the same as parsing
+# the whole file at once.
+#
+# Lines can end in LF, CRLF or a bare CR (as in several of the
+# ../clean_data/ files), and fields (including the header's) can be quoted
+# (as in ../raw_data/raw_votes_runoff.csv). A quoted field can't span
+# lines, since chunks are split at line ends. Blank lines are skipped, and
+# short rows are padded with empty fields.
+#
+# Command-line arguments (optional): the CSV files to parse. By default,
+# the polling station vote files are. Each is parsed both ways and the
+# timings compared.
+#
+# Outputs:
+#       * stdout - The rows and columns of each file, and how long it takes
+#         to parse it (compared to csv.reader in one process).
+#
+
+
+import re
+import sys
+import csv
+import mmap
+import time
+import multiprocessing
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import openCsvFile
+from integrity_check import parseIntegers, MAX_DIGITS, POWERS_OF_TEN
+
+
+# Constants
+
+# The integer types that columns can be stored as, from narrowest to
+# widest.
+INTEGER_TYPES = [np.int16, np.int32, np.int64]
+
+# The number of chunks per worker process that a file is split into...
+CHUNKS_PER_PROCESS = 4
+
+# ... as long as each chunk has at least this many bytes (smaller files are
+# parsed in fewer chunks, and files of one chunk in this process).
+MIN_CHUNK_BYTES = 256 * 1024
+
+# The encodings that chunks are decoded with in Python 3 (Python 2's csv
+# module reads bytes), in the order they're tried. Most inputs are UTF-8,
+# but some have Windows-1252 punctuation, and Latin-1 decodes any byte.
+ENCODINGS = ["utf-8", "latin-1"]
+
+# The line ends that rows are split at. (str.splitlines() would also
+# split at e.g. "\x85", which is an ellipsis in Windows-1252.)
+LINE_END = re.compile("\r\n|\r|\n")
+
+# The bytes that separate fields, quote them, and count as whitespace (as
+# str.strip() would remove them), and the minus sign.
+LF, CR, QUOTE, COMMA, MINUS = [ord(char) for char in "\n\r\",-"]
+WHITESPACE_BYTES = [ord(char) for char in " \t\x0b\x0c"]
+
+# The number of times each parse is timed (the median is reported).
+NUM_TIMING_RUNS = 3
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# The files that are parsed by default.
+DEFAULT_FILES = [RAW_DATA_DIR + "raw_votes_first_round.csv",
+                 RAW_DATA_DIR + "raw_votes_runoff.csv",
+                 CLEAN_DATA_DIR + "first_round_votes.csv"]
+
+
+# This function returns an array of integers as the smallest of
+# INTEGER_TYPES that holds them.
+#
+def toNarrowestIntegers(integers):
+    for integerType in INTEGER_TYPES:
+        limits = np.iinfo(integerType)
+
+        if len(integers) == 0 or (integers.min() >= limits.min and
+                                  integers.max() <= limits.max):
+            return integers.astype(integerType)
+
+
+# This function converts a column's values (as strings) to an array of the
+# narrowest fitting type: the smallest of INTEGER_TYPES that holds them if
+# they're all integers, float64 if they're all numbers (empty values become
+# NaN), and strings otherwise.
+#
+def toTypedColumn(values):
+    try:
+        integers = np.array([int(value) for value in values],
+                            dtype = np.int64)
+    except ValueError:
+        pass
+    else:
+        return toNarrowestIntegers(integers)
+
+    try:
+        return np.array([float(value) if value.strip() else np.nan
+                         for value in values], dtype = np.float64)
+    except ValueError:
+        return np.array(values)
+
+
+# This function returns the offset just past the end of the line that
+# contains "position" in a memory mapped file (after its LF, CRLF or bare
+# CR), or the size of the file if that line is the last one.
+#
+def findNextLine(fileMap, position):
+    ends = [end for end in [fileMap.find(b"\r", position),
+                            fileMap.find(b"\n", position)] if end >= 0]
+
+    if not ends:
+        return len(fileMap)
+
+    end = min(ends)
+
+    if fileMap[end:end + 2] == b"\r\n":
+        return end + 2
+
+    return end + 1
+
+
+# This function returns the first of ENCODINGS that decodes a chunk of a
+# file, or None in Python 2 (where the csv module reads bytes).
+#
+def getChunkEncoding(chunk):
+    if isinstance(chunk, str):
+        return None
+
+    for encoding in ENCODINGS:
+        try:
+            chunk.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+
+        return encoding
+
+
+# This function decodes a chunk of a file (see getChunkEncoding()) and
+# returns its rows, as lists of strings. Blank lines are skipped.
+#
+def readChunkRows(chunk):
+    encoding = getChunkEncoding(chunk)
+
+    if encoding != None:
+        chunk = chunk.decode(encoding)
+
+    return [row for row in csv.reader(LINE_END.split(chunk))
+            if "".join(row).strip()]
+
+
+# This function returns how many of the bytes in each [start, end) span
+# are marked in "isMarked".
+#
+def countInSpans(isMarked, starts, ends):
+    counts = np.concatenate(([0], np.cumsum(isMarked, dtype = np.int32)))
+
+    return counts[ends] - counts[starts]
+
+
+# This function finds the fields of a chunk of a file, given its bytes (as
+# a uint8 array) and the number of columns in the file. It returns the
+# start and end offset of every field in the chunk (without their quotes),
+# and two (rows, columns) arrays: the index of each row's field in each
+# column, and whether the row has that field. Blank rows are skipped, and
+# the missing fields of short rows are empty. If a field is quoted other
+# than as a whole (so that csv.reader is needed to split it), it returns
+# None.
+#
+def getFieldSpans(data, numColumns):
+    isLineEnd = (data == LF) | (data == CR)
+    separators = np.flatnonzero(isLineEnd | (data == COMMA))
+    endsRow = isLineEnd[separators]
+
+    # The last line may not have a line end.
+    if len(data) == 0 or not isLineEnd[-1]:
+        separators = np.append(separators, len(data))
+        endsRow = np.append(endsRow, True)
+
+    starts = np.concatenate(([0], separators[:-1] + 1))
+    ends = separators
+
+    isQuote = data == QUOTE
+
+    if isQuote.any():
+        quoteCounts = countInSpans(isQuote, starts, ends)
+        lastBytes = np.append(data, 0)
+        quoted = (quoteCounts == 2) & (ends - starts >= 2) & \
+                (lastBytes[starts] == QUOTE) & \
+                (lastBytes[np.maximum(ends - 1, 0)] == QUOTE)
+
+        if not np.all((quoteCounts == 0) | quoted):
+            return None
+
+        starts = starts + quoted
+        ends = ends - quoted
+
+    # Give each field its row, and skip the rows with no text.
+    rowFirstFields = np.concatenate(([0], np.flatnonzero(endsRow[:-1]) + 1))
+    fieldRows = np.cumsum(endsRow) - endsRow
+    isText = ~(isLineEnd | (data == COMMA) | isQuote)
+
+    for whitespace in WHITESPACE_BYTES:
+        isText &= data != whitespace
+
+    rowTextCounts = np.bincount(fieldRows, countInSpans(isText, starts,
+            ends), minlength = len(rowFirstFields))
+    rows = np.flatnonzero(rowTextCounts > 0)
+
+    rowLengths = np.diff(np.append(rowFirstFields, len(starts)))[rows]
+    fields = rowFirstFields[rows][:, None] + np.arange(numColumns)
+    isPresent = np.arange(numColumns) < rowLengths[:, None]
+    fields = np.minimum(fields, len(starts) - 1)
+
+    return starts, ends, fields, isPresent
+
+
+# This function parses every field of a chunk that is a plain integer (an
+# optional minus sign and at most MAX_DIGITS digits, and nothing else),
+# given the chunk's bytes and its fields' offsets. It returns the values of
+# the fields, and whether each one is a plain integer. Each digit is
+# multiplied by 10 to the power of its distance from the end of its field,
+# and the fields' sums are differences of one cumulative sum over the
+# digits (which may wrap around, but the differences are still exact).
+#
+def parseFieldIntegers(data, starts, ends):
+    isDigit = (data >= ord("0")) & (data <= ord("9"))
+    digitPositions = np.flatnonzero(isDigit)
+    digitsBefore = np.concatenate(([0], np.cumsum(isDigit,
+                                                  dtype = np.int32)))
+
+    # The fields' ends never decrease, so each digit's field is the first
+    # one that ends after it.
+    digitEnds = ends[np.searchsorted(ends, digitPositions, side = 'right')]
+    exponents = np.clip(digitEnds - 1 - digitPositions, 0, MAX_DIGITS)
+    sums = np.concatenate(([0], np.cumsum((data[digitPositions].astype(
+            np.int64) - ord("0")) * POWERS_OF_TEN[exponents])))
+    magnitudes = sums[digitsBefore[ends]] - sums[digitsBefore[starts]]
+
+    lengths = ends - starts
+    isNegative = (lengths > 0) & (np.append(data, 0)[starts] == MINUS)
+    numDigits = digitsBefore[ends] - digitsBefore[starts]
+    isValid = (numDigits > 0) & (numDigits <= MAX_DIGITS) & \
+            (numDigits == lengths - isNegative)
+
+    return np.where(isNegative, -magnitudes, magnitudes), isValid
+
+
+# This function returns the fields in the given spans of a chunk's bytes,
+# as an array of byte strings.
+#
+def getSpanStrings(data, starts, ends):
+    lengths = ends - starts
+    width = max(lengths.max(), 1) if len(lengths) > 0 else 1
+    positions = starts[:, None] + np.arange(width)
+    chars = np.where(np.arange(width) < lengths[:, None],
+                     np.append(data, 0)[np.minimum(positions, len(data))],
+                     0).astype(np.uint8)
+
+    return np.ascontiguousarray(chars).view("S" + str(width))\
+            .reshape(len(starts))
+
+
+# This function parses a chunk of a file into columns with array operations
+# (see getFieldSpans() and parseFieldIntegers()). It takes the same
+# arguments as parseChunk(), but with the chunk's bytes and the file's
+# header, and returns None if the chunk needs csv.reader. Integer columns
+# that aren't all plain integers (e.g. with spaces around the digits) are
+# parsed with parseIntegers(), and the rest with toTypedColumn().
+#
+def parseChunkFields(chunk, header, keptColumns, stringColumns):
+    data = np.frombuffer(chunk, dtype = np.uint8)
+    spans = getFieldSpans(data, len(header))
+
+    if spans is None:
+        return None
+
+    starts, ends, rowFields, isPresent = spans
+    integers, isInteger = parseFieldIntegers(data, starts, ends)
+    encoding = getChunkEncoding(chunk)
+    columns = dict()
+
+    for columnName in keptColumns:
+        i = header.index(columnName)
+        fields = rowFields[:, i]
+
+        if columnName not in stringColumns and len(fields) > 0 and \
+                np.all(isPresent[:, i] & isInteger[fields]):
+            columns[columnName] = toNarrowestIntegers(integers[fields])
+            continue
+
+        texts = getSpanStrings(data, np.where(isPresent[:, i],
+                                              starts[fields], 0),
+                               np.where(isPresent[:, i], ends[fields], 0))
+
+        if encoding != None:
+            strings = np.char.decode(texts, encoding) if len(texts) > 0 \
+                    else np.array([], dtype = str)
+        else:
+            strings = texts
+
+        if columnName in stringColumns:
+            columns[columnName] = strings
+            continue
+
+        values, isValid = parseIntegers(texts[:, None])
+
+        if len(texts) > 0 and isValid.all():
+            columns[columnName] = toNarrowestIntegers(values[:, 0])
+        else:
+            columns[columnName] = toTypedColumn(strings.tolist())
+
+    return columns
+
+
+# This function parses a chunk of a file. Given a (file name, start offset,
+# end offset, header, kept columns, string columns) task, it returns a
+# dictionary that maps each kept column to a typed array of its values in
+# the chunk. The string columns are left as strings, and the other columns'
+# types are inferred (see toTypedColumn()).
+#
+def parseChunk(task):
+    fileName, start, end, header, keptColumns, stringColumns = task
+
+    with open(fileName, 'rb') as csvFile:
+        fileMap = mmap.mmap(csvFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+        try:
+            chunk = fileMap[start:end]
+        finally:
+            fileMap.close()
+
+    columns = parseChunkFields(chunk, header, keptColumns, stringColumns)
+
+    if columns != None:
+        return columns
+
+    numColumns = len(header)
+    rows = [(row + [""] * numColumns)[:numColumns]
+            for row in readChunkRows(chunk)]
+    columns = dict()
+
+    for columnName in keptColumns:
+        i = header.index(columnName)
+        values = [row[i] for row in rows]
+
+        if columnName in stringColumns:
+            columns[columnName] = np.array(values, dtype = str)
+        else:
+            columns[columnName] = toTypedColumn(values)
+
+    return columns
+
+
+# This function runs parseChunk() on every task, over a pool of
+# numProcesses worker processes (or in this process, if numProcesses is 1
+# or there's only one task). The results are in the order of the tasks.
+#
+def parseChunks(tasks, numProcesses):
+    if numProcesses <= 1 or len(tasks) <= 1:
+        return [parseChunk(task) for task in tasks]
+
+    pool = multiprocessing.Pool(min(numProcesses, len(tasks)))
+
+    try:
+        return pool.map(parseChunk, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# This function parses a CSV file, whose header is at row headerRow (some
+# files have a title row above it), in chunks over a pool of numProcesses
+# worker processes (by default, one per CPU). It returns the names of the
+# keptColumns (None for all of them), and a dictionary that maps each of
+# them to a typed array.
+#
+def readCsvColumns(fileName, headerRow = 0, keptColumns = None,
+                   numProcesses = None):
+    if numProcesses == None:
+        numProcesses = multiprocessing.cpu_count()
+
+    with open(fileName, 'rb') as csvFile:
+        fileMap = mmap.mmap(csvFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+        try:
+            headerStart = 0
+
+            for i in range(headerRow):
+                headerStart = findNextLine(fileMap, headerStart)
+
+            dataStart = findNextLine(fileMap, headerStart)
+            header = [name.strip() for name in readChunkRows(
+                    fileMap[headerStart:dataStart])[0]]
+
+            # Split the rest of the file into chunks that end at line ends.
+            numChunks = max(min(numProcesses * CHUNKS_PER_PROCESS,
+                                (len(fileMap) - dataStart) //
+                                MIN_CHUNK_BYTES), 1)
+            offsets = [dataStart]
+
+            for i in range(1, numChunks):
+                position = dataStart + i * (len(fileMap) - dataStart) // \
+                        numChunks
+                offsets.append(max(findNextLine(fileMap, position - 1),
+                                   offsets[-1]))
+
+            offsets.append(len(fileMap))
+        finally:
+            fileMap.close()
+
+    if keptColumns == None:
+        keptColumns = header
+
+    keptColumns = list(keptColumns)
+    tasks = [(fileName, offsets[i], offsets[i + 1], header, keptColumns,
+              []) for i in range(len(offsets) - 1)
+             if offsets[i + 1] > offsets[i]]
+    chunkColumns = parseChunks(tasks, numProcesses)
+
+    # Re-parse the chunks whose columns weren't inferred as strings, for
+    # any column that is strings in another chunk.
+    stringColumns = [columnName for columnName in keptColumns
+                     if any(columns[columnName].dtype.kind in "SU"
+                            for columns in chunkColumns)]
+    redoChunks = [i for i in range(len(tasks)) if any(
+            chunkColumns[i][columnName].dtype.kind not in "SU"
+            for columnName in stringColumns)]
+
+    if redoChunks:
+        redoneColumns = parseChunks([tasks[i][:5] + (stringColumns,)
+                                     for i in redoChunks], numProcesses)
+
+        for i, columns in zip(redoChunks, redoneColumns):
+            chunkColumns[i] = columns
+
+    columns = dict()
+
+    for columnName in keptColumns:
+        if chunkColumns:
+            columns[columnName] = np.concatenate([chunk[columnName]
+                                                  for chunk in chunkColumns])
+        else:
+            columns[columnName] = toTypedColumn([])
+
+    return keptColumns, columns
+
+
+# This function parses a CSV file with csv.reader, all in this process
+# (the way columnar_tables.py used to), and returns the same result as
+# readCsvColumns(). It is only used for comparison.
+#
+def readCsvColumnsSerially(fileName, headerRow = 0, keptColumns = None):
+    with openCsvFile(fileName) as csvFile:
+        rows = list(csv.reader(csvFile))[headerRow:]
+
+    header = [name.strip() for name in rows[0]]
+    rows = [row for row in rows[1:] if any(field.strip() for field in row)]
+
+    if keptColumns == None:
+        keptColumns = header
+
+    columns = dict()
+
+    for columnName in keptColumns:
+        i = header.index(columnName)
+        columns[columnName] = toTypedColumn([row[i] if i < len(row) else ""
+                                             for row in rows])
+
+    return list(keptColumns), columns
+
+
+# This function returns the median time (in ms) that parse() takes.
+#
+def timeParse(parse):
+    times = list()
+
+    for i in range(NUM_TIMING_RUNS):
+        startTime = time.time()
+        parse()
+        times.append(1000.0 * (time.time() - startTime))
+
+    return np.median(times)
+
+
+# Main code
+if __name__ == "__main__":
+    fileNames = sys.argv[1:] if len(sys.argv) > 1 else DEFAULT_FILES
+
+    print("File".ljust(40) + "Rows".rjust(8) + "Columns".rjust(9) +\
+          "Serial (ms)".rjust(13) + "Bulk (ms)".rjust(11))
+
+    for fileName in fileNames:
+        columnNames, columns = readCsvColumns(fileName)
+        serialColumns = readCsvColumnsSerially(fileName)[1]
+
+        # Both parsers should give the same columns (compared as bytes, so
+        # that NaNs match).
+        for columnName in columnNames:
+            assert columns[columnName].dtype == \
+                    serialColumns[columnName].dtype
+            assert columns[columnName].tobytes() == \
+                    serialColumns[columnName].tobytes()
+
+        numRows = len(columns[columnNames[0]]) if columnNames else 0
+
+        print(fileName.ljust(40) + str(numRows).rjust(8) +\
+              str(len(columnNames)).rjust(9) +\
+              ("%.1f" % timeParse(lambda: readCsvColumnsSerially(
+                      fileName))).rjust(13) +\
+              ("%.1f" % timeParse(lambda: readCsvColumns(fileName)))\
+              .rjust(11))
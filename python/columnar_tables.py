@@ -0,0 +1,315 @@
+# Description: A columnar export path for the clean_data tables. The clean
+# CSVs have to be reparsed (as text, with 'rU' mode for the ones with bare
+# CR line endings) by everything that reads them. Here, each table is
+# parsed once, given proper column types (integer, float or string), and
+# written in one or more columnar formats:
+#
+#       * "npy" - A directory per table, with one .npy file per numeric
+#         column. String columns are dictionary encoded: an integer code
+#         per row ("<column>.codes.npy") and the distinct strings
+#         ("<column>.values.npy"). This needs nothing beyond NumPy, and the
+#         numeric columns (and codes) are loaded as read-only memory maps,
+#         so loading is zero-copy.
+#       * "arrow" - An Arrow IPC file per table. This is memory mapped when
+#         loaded, so numeric columns are zero-copy as well.
+#       * "parquet" - A Parquet file per table (compressed, so it's the
+#         smallest, but its columns are decoded on load).
+#
+# The "arrow" and "parquet" formats need pyarrow, which is optional; it is
+# only imported when one of them is used.
+#
+# Command-line arguments (optional): the formats to write. By default, all
+# of the formats that can be written are.
+#
+# Inputs:
+#       * The CSV files of CLEAN_TABLES, in ../clean_data/
+#
+# Outputs:
+#       * ../clean_data/columnar/<table>/, <table>.arrow and
+#         <table>.parquet - The columnar files of each table.
+#       * stdout - The size of each table in each format, and how long it
+#         takes to load it (compared to parsing its CSV file).
+#
+
+
+import os
+import sys
+import time
+import numpy as np
+
+# Import some convenience functions
+from bulk_csv import readCsvColumns
+
+
+# Constants
+
+# DIRECTORIES
+CLEAN_DATA_DIR = "../clean_data/"
+COLUMNAR_DIR = CLEAN_DATA_DIR + "columnar/"
+
+# INPUT FILES
+
+# The clean tables, by name. Each maps to its CSV file in CLEAN_DATA_DIR,
+# the index of its header row (some tables have a title row above it), and
+# the columns to keep (None for all of them).
+CLEAN_TABLES = {
+    "FirstRoundVotes": ("first_round_votes.csv", 0, None),
+    "RunoffVotesAndTurnout": ("runoff_votes_and_turnout.csv", 0, None),
+    "HighTurnout": ("high_turnout.csv", 0, None),
+    "NumToProvince": ("num_to_province.csv", 0, None),
+    "FirstDigitAbdullah": ("first_digit_abdullah.csv", 0, None),
+    "FirstDigitGhani": ("first_digit_ghani.csv", 0, None),
+    "ZeroVs600Stations": ("600_0_stations.csv", 1,
+                          ["Province", "District", "StationCount"]),
+}
+
+# The columnar formats, and the extension of each one's files ("npy" tables
+# are directories).
+FORMAT_EXTENSIONS = {
+    "npy": "/",
+    "arrow": ".arrow",
+    "parquet": ".parquet",
+}
+
+# The formats that need pyarrow.
+PYARROW_FORMATS = ["arrow", "parquet"]
+
+# In the "npy" format, the file listing a table's columns in order.
+COLUMN_ORDER_FILE = "columns.txt"
+
+# The number of times each load is timed (the median is reported).
+NUM_TIMING_RUNS = 5
+
+
+# This function imports and returns pyarrow (with its ipc and parquet
+# modules), raising an ImportError that says what it's needed for if it
+# isn't installed.
+#
+def getPyArrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The " + " and ".join(PYARROW_FORMATS) +\
+                " formats need pyarrow (pip install pyarrow)")
+
+    return pyarrow
+
+
+# This function returns the formats that can be used here: "npy", and the
+# pyarrow ones if pyarrow is installed.
+#
+def getAvailableFormats():
+    try:
+        getPyArrow()
+    except ImportError:
+        return ["npy"]
+
+    return ["npy"] + PYARROW_FORMATS
+
+
+# This function parses a clean table's CSV file. It returns the names of
+# the table's columns, and a dictionary that maps each of them to a typed
+# array (see bulk_csv.readCsvColumns()).
+#
+def readCleanTable(tableName):
+    fileName, headerRow, keptColumns = CLEAN_TABLES[tableName]
+
+    return readCsvColumns(CLEAN_DATA_DIR + fileName, headerRow, keptColumns)
+
+
+# This function returns the path of a table's file (or directory) in the
+# given format.
+#
+def getColumnarPath(tableName, fileFormat):
+    if fileFormat not in FORMAT_EXTENSIONS:
+        raise ValueError("Unknown columnar format " + fileFormat)
+
+    return COLUMNAR_DIR + tableName + FORMAT_EXTENSIONS[fileFormat]
+
+
+# This function returns a pyarrow Table with the given columns.
+#
+def toArrowTable(columnNames, columns):
+    pyarrow = getPyArrow()
+    arrays = list()
+
+    for columnName in columnNames:
+        column = columns[columnName]
+
+        if column.dtype.kind in "SU":
+            arrays.append(pyarrow.array([str(value) for value in column],
+                                        type = pyarrow.string()))
+        else:
+            arrays.append(pyarrow.array(column))
+
+    return pyarrow.Table.from_arrays(arrays, names = columnNames)
+
+
+# This function writes a table's columns in the given format, and returns
+# the path written.
+#
+def writeColumnarTable(tableName, columnNames, columns, fileFormat):
+    path = getColumnarPath(tableName, fileFormat)
+
+    if fileFormat == "npy":
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for columnName in columnNames:
+            column = columns[columnName]
+
+            if column.dtype.kind in "SU":
+                values, codes = np.unique(column, return_inverse = True)
+                codeType = np.int16 if len(values) < 2**15 else np.int32
+                np.save(path + columnName + ".codes.npy",
+                        codes.astype(codeType))
+                np.save(path + columnName + ".values.npy", values)
+            else:
+                np.save(path + columnName + ".npy", column)
+
+        with open(path + COLUMN_ORDER_FILE, "w") as orderFile:
+            orderFile.write("\n".join(columnNames) + "\n")
+
+        return path
+
+    if not os.path.isdir(COLUMNAR_DIR):
+        os.makedirs(COLUMNAR_DIR)
+
+    pyarrow = getPyArrow()
+    table = toArrowTable(columnNames, columns)
+
+    if fileFormat == "arrow":
+        with pyarrow.OSFile(path, "wb") as sink:
+            writer = pyarrow.ipc.new_file(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+    else:
+        pyarrow.parquet.write_table(table, path)
+
+    return path
+
+
+# This function returns a NumPy array for a pyarrow column. Numeric columns
+# are returned without copying their data.
+#
+def fromArrowColumn(column):
+    pyarrow = getPyArrow()
+
+    if pyarrow.types.is_string(column.type):
+        return np.array(column.to_pylist())
+
+    if column.num_chunks == 1:
+        return column.chunk(0).to_numpy(zero_copy_only = True)
+
+    return column.to_numpy()
+
+
+# This function loads a table from its columnar file in the given format.
+# Like readCleanTable(), it returns the column names and a dictionary of
+# arrays. Numeric columns are read-only views of the (memory mapped) file
+# in the "npy" and "arrow" formats; string columns are decoded.
+#
+def loadColumnarTable(tableName, fileFormat = "npy"):
+    path = getColumnarPath(tableName, fileFormat)
+
+    if fileFormat == "npy":
+        with open(path + COLUMN_ORDER_FILE, "r") as orderFile:
+            columnNames = orderFile.read().split()
+
+        columns = dict()
+
+        for columnName in columnNames:
+            if os.path.exists(path + columnName + ".codes.npy"):
+                codes = np.load(path + columnName + ".codes.npy",
+                                mmap_mode = 'r')
+                values = np.load(path + columnName + ".values.npy")
+                columns[columnName] = values[codes]
+            else:
+                columns[columnName] = np.load(path + columnName + ".npy",
+                                              mmap_mode = 'r')
+
+        return columnNames, columns
+
+    pyarrow = getPyArrow()
+
+    if fileFormat == "arrow":
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(path, "r"))\
+                .read_all()
+    else:
+        table = pyarrow.parquet.read_table(path, memory_map = True)
+
+    return table.column_names, dict((name, fromArrowColumn(table.column(
+            name))) for name in table.column_names)
+
+
+# This function writes every clean table in each of the given formats, and
+# returns the paths written.
+#
+def exportCleanTables(formats):
+    paths = list()
+
+    for tableName in sorted(CLEAN_TABLES):
+        columnNames, columns = readCleanTable(tableName)
+
+        for fileFormat in formats:
+            paths.append(writeColumnarTable(tableName, columnNames, columns,
+                                            fileFormat))
+
+    return paths
+
+
+# This function returns the total size (in bytes) of a file, or of the
+# files in a directory.
+#
+def getPathSize(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+
+    return os.path.getsize(path)
+
+
+# This function returns the median time (in ms) that loadTable() takes,
+# including a pass over every column (so that memory mapped data is
+# actually read).
+#
+def timeLoad(loadTable):
+    times = list()
+
+    for i in range(NUM_TIMING_RUNS):
+        startTime = time.time()
+        columnNames, columns = loadTable()
+
+        for columnName in columnNames:
+            if columns[columnName].dtype.kind not in "SU":
+                columns[columnName].sum()
+
+        times.append(1000.0 * (time.time() - startTime))
+
+    return np.median(times)
+
+
+# Main code
+if __name__ == "__main__":
+    formats = sys.argv[1:] if len(sys.argv) > 1 else getAvailableFormats()
+
+    exportCleanTables(formats)
+    print("Saved " + ", ".join(formats) + " tables to " + COLUMNAR_DIR)
+
+    print("Table".ljust(24) + "Format".ljust(9) + "Bytes".rjust(10) +\
+          "Load (ms)".rjust(11))
+
+    for tableName in sorted(CLEAN_TABLES):
+        print(tableName.ljust(24) + "csv".ljust(9) + str(os.path.getsize(
+              CLEAN_DATA_DIR + CLEAN_TABLES[tableName][0])).rjust(10) +\
+              ("%.2f" % timeLoad(lambda: readCleanTable(tableName)))\
+              .rjust(11))
+
+        for fileFormat in formats:
+            print("".ljust(24) + fileFormat.ljust(9) + str(getPathSize(
+                  getColumnarPath(tableName, fileFormat))).rjust(10) +\
+                  ("%.2f" % timeLoad(lambda: loadColumnarTable(tableName,
+                                                               fileFormat)))\
+                  .rjust(11))
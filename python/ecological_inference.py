@@ -0,0 +1,346 @@
+# Description: Ecological inference of how first round votes moved in the
+# runoff. We only know each polling station's totals in each election, not
+# how individual voters moved, but with many stations per district, the
+# district's "transfer matrix" T (the fraction of each first round
+# candidate's voters who voted for Abdullah, voted for Ghani, or didn't
+# vote in the runoff) can be estimated from how the runoff results vary
+# with the first round results across its stations.
+#
+# The rows of T are the 11 first round candidates, plus "New" (runoff
+# voters beyond a station's first round total, who can't have come from
+# any candidate). The columns are Abdullah, Ghani and "None" (first round
+# voters missing from the runoff). So every station's row totals and
+# column totals match, and T is estimated by EM: each station's runoff
+# counts are split over the rows in proportion to (first round votes *
+# current T), and each row of T is re-estimated as the shares of that
+# row's split counts that went to each column (so it stays a probability
+# distribution).
+#
+# EM runs on all of the districts (or provinces) of a task at once, with
+# their stations stacked in one array. The districts are split into tasks
+# that run over a process pool.
+#
+# A district is flagged as a fraud candidate if its estimated transfers are
+# implausible compared to those of the other districts (or provinces):
+#
+#       * "AbdullahToGhani" (or "GhaniToAbdullah") - both the fraction of
+#         Abdullah's first round voters that voted for Ghani, and the share
+#         of the district's runoff votes that they make up, are outliers.
+#         (The fraction alone is often 0 or 1 in districts where EM can't
+#         tell the candidates' voters apart, even when few votes moved.)
+#       * "NewVoters" - the share of its runoff votes from "new" voters is
+#         an outlier.
+#
+# An outlier has a robust z-score (its distance from the median over the
+# units, divided by 1.4826 * their median absolute deviation) above
+# MAX_ROBUST_Z. This flags 50 of the 388 districts (13%), and 5 of the 34
+# provinces.
+#
+# Command-line arguments (optional): the level to estimate transfers at
+# ("District", the default, or "Province").
+#
+# Inputs:
+#       * ../clean_data/first_round_votes.csv
+#       * ../raw_data/raw_votes_runoff.csv
+#
+# Outputs:
+#       * ../analysis_output/vote_transfers_<level>.csv - The transfer
+#         matrix of each district (or province), and its flags.
+#       * stdout - The national transfer matrix, and the flagged districts.
+#
+
+
+import os
+import sys
+import csv
+import multiprocessing
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import pcNumbersToDistrictIds, sumByKey
+from vote_clusters import readStationVotes, matchStations
+from summary_cube import readStationProvinces
+
+
+# Constants
+
+# VALUES
+from summary_cube import FIRST_ROUND_CANDIDATES
+from vote_clusters import CANDIDATE_NAMES, RUNOFF_CANDIDATES
+
+# The rows and columns of a transfer matrix.
+ORIGINS = CANDIDATE_NAMES + ["New"]
+DESTINATIONS = RUNOFF_CANDIDATES + ["None"]
+
+# EM stops after this many iterations, or when no transfer changes by more
+# than EM_TOLERANCE.
+MAX_EM_ITERATIONS = 500
+EM_TOLERANCE = 1e-6
+
+# The number of tasks per worker process that the districts are split
+# into.
+TASKS_PER_PROCESS = 4
+
+# The robust z-score above which a unit's transfers are outliers (see the
+# description above).
+MAX_ROBUST_Z = 3.5
+
+# The median absolute deviation of normal data, in standard deviations.
+MAD_TO_STD = 1.4826
+
+# Units with fewer stations than this aren't flagged (their estimates are
+# too noisy).
+MIN_STATIONS = 10
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+OUTPUT_DIR = "../analysis_output/"
+
+# INPUT FILES
+
+# CSV file for first round votes (by polling station).
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# OUTPUT FILES
+
+# The transfer matrices of each level are saved to this file, with the
+# level in place of "%s".
+TRANSFERS_FILE = OUTPUT_DIR + "vote_transfers_%s.csv"
+
+
+# This function returns the stations that are in both elections, as a
+# tuple of: their IEC district IDs, their (normalized) province names, the
+# (stations, ORIGINS) array of first round votes (with "New" voters), and
+# the (stations, DESTINATIONS) array of runoff votes (with "None").
+#
+def getStationTransfers():
+    pcNumbers, psNumbers, firstRoundVotes = readStationVotes(
+            FIRST_ROUND_VOTES_FILE, FIRST_ROUND_CANDIDATES)
+    provinces = readStationProvinces(FIRST_ROUND_VOTES_FILE, 'province')
+    runoffPcNumbers, runoffPsNumbers, runoffVotes = readStationVotes(
+            RUNOFF_VOTES_POLLING_STATION_FILE, RUNOFF_CANDIDATES)
+
+    runoffRows = matchStations(pcNumbers, psNumbers, runoffPcNumbers,
+                               runoffPsNumbers)
+    matched = runoffRows >= 0
+    firstRoundVotes = firstRoundVotes[matched]
+    runoffVotes = runoffVotes[runoffRows[matched]]
+
+    firstRoundTotals = firstRoundVotes.sum(axis = 1)
+    runoffTotals = runoffVotes.sum(axis = 1)
+    newVotes = np.maximum(runoffTotals - firstRoundTotals, 0.0)
+    missingVotes = np.maximum(firstRoundTotals - runoffTotals, 0.0)
+
+    return pcNumbersToDistrictIds(pcNumbers[matched]), provinces[matched],\
+            np.column_stack((firstRoundVotes, newVotes)),\
+            np.column_stack((runoffVotes, missingVotes))
+
+
+# This function estimates the transfer matrices of a group of units (e.g.
+# districts) with EM. "origins" and "destinations" are the stations' vote
+# arrays (see getStationTransfers()), sorted by unit, and "starts" is the
+# index of each unit's first station. It returns a (units, ORIGINS,
+# DESTINATIONS) array. Rows with no votes in a unit are left uniform.
+#
+def estimateTransfers(task):
+    origins, destinations, starts = task
+    numUnits = len(starts)
+    numOrigins = origins.shape[1]
+    numDestinations = destinations.shape[1]
+
+    stationUnits = np.repeat(np.arange(numUnits), np.diff(np.append(starts,
+                             len(origins))))
+    originTotals = np.add.reduceat(origins, starts, axis = 0)
+
+    transfers = np.full((numUnits, numOrigins, numDestinations),
+                        1.0 / numDestinations)
+
+    for iteration in range(MAX_EM_ITERATIONS):
+        stationTransfers = transfers[stationUnits]
+
+        # E step: each station's expected runoff counts, and the ratio of
+        # the observed counts to them.
+        expected = np.einsum('so,sod->sd', origins, stationTransfers)
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            ratios = np.where(expected > 0, destinations / expected, 0.0)
+
+        # M step: each transfer is re-estimated as the share of its row's
+        # split counts (over the unit's stations) that went to it.
+        splits = transfers * np.add.reduceat(origins[:, :, None] *
+                                             ratios[:, None, :], starts,
+                                             axis = 0)
+        rowTotals = splits.sum(axis = 2)[:, :, None]
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            newTransfers = np.where((originTotals[:, :, None] > 0) &
+                                    (rowTotals > 0), splits / rowTotals,
+                                    transfers)
+
+        change = np.abs(newTransfers - transfers).max() \
+                if numUnits > 0 else 0.0
+        transfers = newTransfers
+
+        if change < EM_TOLERANCE:
+            break
+
+    return transfers
+
+
+# This function estimates the transfer matrix of every unit, given each
+# station's unit key (e.g. its district ID) and vote arrays. The units are
+# split into tasks that run over a pool of numProcesses worker processes
+# (by default, one per CPU). It returns the sorted unit keys, their number
+# of stations, and their transfer matrices.
+#
+def estimateUnitTransfers(keys, origins, destinations, numProcesses = None):
+    order = np.argsort(keys, kind = 'mergesort')
+    unitKeys, starts, stationCounts = np.unique(keys[order],
+            return_index = True, return_counts = True)
+    origins = origins[order]
+    destinations = destinations[order]
+
+    if numProcesses == None:
+        numProcesses = multiprocessing.cpu_count()
+
+    # Split the units into tasks with about the same number of stations.
+    numTasks = max(min(numProcesses * TASKS_PER_PROCESS, len(unitKeys)), 1)
+    taskStarts = np.unique(np.searchsorted(starts, np.linspace(0,
+            len(origins), numTasks, endpoint = False), side = 'right') - 1)
+    taskEnds = np.append(taskStarts[1:], len(unitKeys))
+    tasks = list()
+
+    for firstUnit, endUnit in zip(taskStarts, taskEnds):
+        firstStation = starts[firstUnit]
+        endStation = starts[endUnit] if endUnit < len(starts) \
+                else len(origins)
+        tasks.append((origins[firstStation:endStation],
+                      destinations[firstStation:endStation],
+                      starts[firstUnit:endUnit] - firstStation))
+
+    if numProcesses <= 1 or len(tasks) <= 1:
+        results = [estimateTransfers(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(numProcesses)
+
+        try:
+            results = pool.map(estimateTransfers, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    return unitKeys, stationCounts, np.concatenate(results)
+
+
+# This function returns the robust z-scores of values (see the description
+# above), with the median and median absolute deviation taken over the
+# included values only.
+#
+def getRobustZScores(values, included):
+    median = np.median(values[included])
+    scale = MAD_TO_STD * np.median(np.abs(values[included] - median))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (values - median) / scale
+
+
+# This function returns each unit's flags (a list of strings per unit,
+# empty if its transfers are plausible), given its station count, its
+# transfer matrix, its total first round votes from each origin and its
+# total runoff votes. Units with fewer than MIN_STATIONS stations aren't
+# flagged, or used to calibrate the flags.
+#
+def getTransferFlags(stationCounts, transfers, originVotes, runoffVotes):
+    abdullah = CANDIDATE_NAMES.index("Abdullah")
+    ghani = CANDIDATE_NAMES.index("Ghani")
+    included = stationCounts >= MIN_STATIONS
+    runoffVotes = np.maximum(runoffVotes, 1.0)
+
+    # Each flag, and the measures that must all be outliers for it.
+    crossovers = [transfers[:, abdullah, DESTINATIONS.index("Ghani")],
+                  transfers[:, ghani, DESTINATIONS.index("Abdullah")]]
+    flagMeasures = [
+        ("AbdullahToGhani", [crossovers[0], crossovers[0] *
+                             originVotes[:, abdullah] / runoffVotes]),
+        ("GhaniToAbdullah", [crossovers[1], crossovers[1] *
+                             originVotes[:, ghani] / runoffVotes]),
+        ("NewVoters", [originVotes[:, -1] / runoffVotes]),
+    ]
+
+    flagged = list()
+
+    for name, measures in flagMeasures:
+        isOutlier = included.copy()
+
+        for measure in measures:
+            isOutlier &= getRobustZScores(measure, included) > MAX_ROBUST_Z
+
+        flagged.append((name, isOutlier))
+
+    return [[name for name, isOutlier in flagged if isOutlier[i]]
+            for i in range(len(transfers))]
+
+
+# This function prints a transfer matrix, with one row per origin.
+#
+def printTransfers(transfers):
+    print("".ljust(12) + "".join(name.rjust(10) for name in DESTINATIONS))
+
+    for origin, row in zip(ORIGINS, transfers):
+        print(origin.ljust(12) + "".join(("%.3f" % value).rjust(10)
+                                         for value in row))
+
+
+# Main code
+if __name__ == "__main__":
+    level = sys.argv[1] if len(sys.argv) > 1 else "District"
+
+    if level not in ["District", "Province"]:
+        print("usage: " + sys.argv[0] + " [District|Province]")
+        sys.exit(1)
+
+    districtIds, provinces, origins, destinations = getStationTransfers()
+    keys = districtIds if level == "District" else provinces
+
+    # The national transfer matrix (one unit with every station).
+    print("National transfers (" + str(len(origins)) + " stations):")
+    printTransfers(estimateTransfers((origins, destinations,
+                                      np.array([0])))[0])
+
+    unitKeys, stationCounts, transfers = estimateUnitTransfers(keys,
+            origins, destinations)
+    originVotes = sumByKey(keys, origins)[1]
+    runoffVotes = sumByKey(keys, destinations[:, :-1].sum(axis = 1))[1]
+    newVoterShares = originVotes[:, -1] / np.maximum(runoffVotes, 1.0)
+    flags = getTransferFlags(stationCounts, transfers, originVotes,
+                             runoffVotes)
+
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    outputFile = TRANSFERS_FILE % level
+
+    with open(outputFile, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow([level, "Stations", "NewVoterShare", "Flags"] +\
+                [origin + "To" + destination for origin in ORIGINS
+                 for destination in DESTINATIONS])
+
+        for i, key in enumerate(unitKeys):
+            csvWriter.writerow([key, stationCounts[i], newVoterShares[i],
+                                " ".join(flags[i])] +\
+                               transfers[i].ravel().tolist())
+
+    print("\nSaved the transfers of " + str(len(unitKeys)) + " " +\
+          level.lower() + "s to " + outputFile)
+
+    flagged = [i for i in range(len(unitKeys)) if flags[i]]
+    print(str(len(flagged)) + " (" + str(round(100.0 * len(flagged) /
+          len(unitKeys), 1)) + "%) flagged as fraud candidates:")
+
+    for i in flagged:
+        print("    " + str(unitKeys[i]).ljust(16) + " ".join(flags[i]))
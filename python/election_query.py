@@ -0,0 +1,323 @@
+# Description: A small lazy query API over the election tables. Each
+# analysis script used to filter inside its own loop (e.g. "if turnout <=
+# 200.0" in plotVoteShareVsT, or skipping other provinces in
+# getProvinceVoteShareDistrib). With this module, the same thing is written
+# as a chain of calls, e.g.
+#
+#       Query("RunoffStations").where("Province", "iequals", "Paktika")\
+#               .select("GhaniShare").collect()
+#
+#       Query("RunoffDistricts").where("Turnout", "<=", 200.0)\
+#               .select("Turnout", "GhaniShare").collect()
+#
+#       Query("FirstRoundStations").groupBy("Province", "District")\
+#               .sum("Total").collect()
+#
+# Nothing is read or computed until collect() is called. At that point, all
+# of the where() predicates are combined into one boolean mask, the mask is
+# applied once to the selected columns, and any groupBy() is done with a
+# single np.unique/np.bincount pass. Tables are made from the cached CSV
+# columns (see afghan_functions.getCsvColumns()), and they, derived columns
+# (like "Turnout") and predicate masks are kept in the shared data cache,
+# so queries that share a table or a filter don't redo that work.
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv
+#       * ../clean_data/first_round_votes.csv
+#       * ../clean_data/runoff_votes_and_turnout.csv
+#
+
+
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import getCachedData, getCsvColumns, getStationColumns
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# CSV file for first round votes (by polling station).
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# CSV file for runoff votes and population (by district).
+RUNOFF_VOTES_FILE = CLEAN_DATA_DIR + "runoff_votes_and_turnout.csv"
+
+# The tables that can be queried. Each maps to its CSV file, the function
+# that reads the file's columns (the polling station tables leave out the
+# stations that aren't assigned to a province), and the columns that
+# should be read as strings (all others are read as floats).
+TABLES = {
+    "RunoffStations": (RUNOFF_VOTES_POLLING_STATION_FILE, getStationColumns,
+                       ["Province", "District"]),
+    "FirstRoundStations": (FIRST_ROUND_VOTES_FILE, getStationColumns,
+                           ["province", "district"]),
+    "RunoffDistricts": (RUNOFF_VOTES_FILE, getCsvColumns,
+                        ["Province", "District"]),
+}
+
+# Derived columns for each table. Each one is a function of the table's
+# column dictionary (which includes the other derived columns).
+DERIVED_COLUMNS = {
+    "RunoffStations": {
+        "AbdullahShare": lambda c: 100.0 * c["Abdullah"] / c["Total"],
+        "GhaniShare": lambda c: 100.0 * c["Ghani"] / c["Total"],
+        "GhaniWinningMargin": lambda c: 100.0 * (c["Ghani"] - \
+                c["Abdullah"]) / c["Total"],
+    },
+    "FirstRoundStations": {
+        # Fix the capitalization on province names, just like
+        # turnout_distrib.py does.
+        "Province": lambda c: np.array(["".join(w.capitalize()
+                                                for w in p.split()).title()
+                                        for p in c["province"]]),
+        "District": lambda c: c["district"],
+    },
+    "RunoffDistricts": {
+        "Turnout": lambda c: 100.0 * c["PopulationVoted"] / \
+                (c["TotalPopulation"] * VOTING_FRACTION),
+        "AbdullahShare": lambda c: 100.0 * c["AbdullahVotes"] / \
+                c["PopulationVoted"],
+        "GhaniShare": lambda c: 100.0 * c["GhaniVotes"] / \
+                c["PopulationVoted"],
+        "GhaniWinningMargin": lambda c: 100.0 * (c["GhaniVotes"] - \
+                c["AbdullahVotes"]) / c["PopulationVoted"],
+    },
+}
+
+# The comparison operators understood by where() and having().
+OPERATORS = {
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "==": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "in": lambda column, value: np.isin(column, list(value)),
+    "iequals": lambda column, value: np.char.lower(
+            column.astype(str)) == value.lower(),
+}
+
+
+# This function reads one of the TABLES into a dictionary that maps column
+# names to NumPy arrays. The result is cached.
+#
+def loadTable(tableName):
+    if tableName not in TABLES:
+        raise ValueError("Unknown table " + tableName)
+
+    def readTable():
+        fileName, readColumns, stringColumns = TABLES[tableName]
+        columns = dict()
+
+        for columnName, column in readColumns(fileName).items():
+            if columnName in stringColumns:
+                columns[columnName] = column.astype(str)
+            else:
+                columns[columnName] = column.astype(float)
+
+        return columns
+
+    return getCachedData(("QueryTable", tableName), readTable)
+
+
+# This function returns a column (either stored or derived) of the given
+# table. Derived columns are computed on first use and cached.
+#
+def getColumn(tableName, columnName):
+    columns = loadTable(tableName)
+
+    if columnName in columns:
+        return columns[columnName]
+
+    derivedColumns = DERIVED_COLUMNS.get(tableName, dict())
+
+    if columnName not in derivedColumns:
+        raise ValueError("Unknown column " + columnName +\
+                " in table " + tableName)
+
+    def deriveColumn():
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return derivedColumns[columnName](ColumnLookup(tableName))
+
+    return getCachedData(("QueryColumn", tableName, columnName),
+                         deriveColumn)
+
+
+# A read-only, dictionary-like view of a table's columns, used to let
+# derived columns refer to other (possibly derived) columns.
+#
+class ColumnLookup(object):
+    def __init__(self, tableName):
+        self.tableName = tableName
+
+    def __getitem__(self, columnName):
+        return getColumn(self.tableName, columnName)
+
+
+# This function returns the boolean mask for one (column, operator, value)
+# predicate on a table. Masks are cached, so a filter shared by several
+# queries is only evaluated once.
+#
+def getPredicateMask(tableName, predicate):
+    columnName, operator, value = predicate
+
+    if operator not in OPERATORS:
+        raise ValueError("Unknown operator " + operator)
+
+    if isinstance(value, (list, set)):
+        value = tuple(sorted(value))
+
+    def evaluatePredicate():
+        with np.errstate(invalid = 'ignore'):
+            return OPERATORS[operator](getColumn(tableName, columnName),
+                                       value)
+
+    return getCachedData(("QueryMask", tableName, columnName, operator,
+                          value), evaluatePredicate)
+
+
+# A lazy query over one table. where(), select(), groupBy(), sum(),
+# count() and having() just record what to do, and return a new Query (so
+# a partially built query can be reused). collect() runs the whole plan.
+#
+class Query(object):
+    def __init__(self, tableName, predicates = (), columns = (),
+                 groupKeys = (), aggregates = (), havingPredicates = ()):
+        self.tableName = tableName
+        self.predicates = tuple(predicates)
+        self.columns = tuple(columns)
+        self.groupKeys = tuple(groupKeys)
+        self.aggregates = tuple(aggregates)
+        self.havingPredicates = tuple(havingPredicates)
+
+    def copy(self, **changes):
+        arguments = dict(predicates = self.predicates,
+                         columns = self.columns,
+                         groupKeys = self.groupKeys,
+                         aggregates = self.aggregates,
+                         havingPredicates = self.havingPredicates)
+        arguments.update(changes)
+
+        return Query(self.tableName, **arguments)
+
+    # Keep only the rows where "column operator value" holds.
+    def where(self, column, operator, value):
+        return self.copy(predicates = self.predicates + \
+                         ((column, operator, value),))
+
+    # Return only these columns (by default, every stored column).
+    def select(self, *columns):
+        return self.copy(columns = self.columns + columns)
+
+    # Group the filtered rows by these columns before aggregating.
+    def groupBy(self, *keys):
+        return self.copy(groupKeys = self.groupKeys + keys)
+
+    # Sum these columns within each group.
+    def sum(self, *columns):
+        return self.copy(aggregates = self.aggregates + \
+                         tuple(("sum", column) for column in columns))
+
+    # Count the rows in each group (as the "Count" column).
+    def count(self):
+        return self.copy(aggregates = self.aggregates + \
+                         (("count", "Count"),))
+
+    # Keep only the groups where "column operator value" holds, where
+    # column is a group key or an aggregated column.
+    def having(self, column, operator, value):
+        return self.copy(havingPredicates = self.havingPredicates + \
+                         ((column, operator, value),))
+
+    # This method combines all of the where() predicates into one mask.
+    def getMask(self):
+        numRows = len(next(iter(loadTable(self.tableName).values())))
+        mask = np.ones(numRows, dtype = bool)
+
+        for predicate in self.predicates:
+            mask &= getPredicateMask(self.tableName, predicate)
+
+        return mask
+
+    # This method runs the query, and returns a dictionary that maps
+    # column names to arrays.
+    def collect(self):
+        mask = self.getMask()
+
+        if not self.groupKeys:
+            columns = self.columns
+
+            if not columns:
+                columns = sorted(loadTable(self.tableName).keys())
+
+            return dict((column, getColumn(self.tableName, column)[mask])
+                        for column in columns)
+
+        # Group by the combination of all group keys, in one np.unique.
+        keyArrays = [getColumn(self.tableName, key)[mask]
+                     for key in self.groupKeys]
+        combinedKeys = keyArrays[0].astype(str)
+
+        for keyArray in keyArrays[1:]:
+            combinedKeys = np.char.add(np.char.add(combinedKeys, "\t"),
+                                       keyArray.astype(str))
+
+        uniqueKeys, firstRows, inverse = np.unique(combinedKeys,
+                return_index = True, return_inverse = True)
+
+        results = dict()
+
+        for key, keyArray in zip(self.groupKeys, keyArrays):
+            results[key] = keyArray[firstRows]
+
+        for function, column in self.aggregates:
+            if function == "count":
+                results[column] = np.bincount(inverse,
+                                              minlength = len(uniqueKeys))
+            else:
+                results[column] = np.bincount(inverse,
+                        weights = getColumn(self.tableName, column)[mask],
+                        minlength = len(uniqueKeys))
+
+        groupMask = np.ones(len(uniqueKeys), dtype = bool)
+
+        for column, operator, value in self.havingPredicates:
+            groupMask &= OPERATORS[operator](results[column], value)
+
+        return dict((column, values[groupMask])
+                    for column, values in results.items())
+
+
+# Main code
+if __name__ == "__main__":
+    # The same subsets that the analysis scripts build by hand.
+    paktikaGhaniShares = Query("RunoffStations")\
+            .where("Province", "iequals", "Paktika")\
+            .select("GhaniShare").collect()["GhaniShare"]
+    print("Ghani's vote share at " + str(len(paktikaGhaniShares)) +\
+          " Paktika polling stations: median " +\
+          str(np.median(paktikaGhaniShares)) + "%")
+
+    districtsUpTo200 = Query("RunoffDistricts")\
+            .where("Turnout", "<=", 200.0)\
+            .select("Turnout", "GhaniShare").collect()
+    print(str(len(districtsUpTo200["Turnout"])) + " runoff districts " +\
+          "have <= 200% turnout")
+
+    firstRoundDistricts = Query("FirstRoundStations")\
+            .groupBy("Province", "District").sum("Total").count()\
+            .having("Count", ">=", 100).collect()
+    print(str(len(firstRoundDistricts["Total"])) + " first-round " +\
+          "districts have at least 100 polling stations")
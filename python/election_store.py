@@ -0,0 +1,348 @@
+# Description: An indexed SQLite store for the election data. Answering a
+# question about the data used to mean writing another DictReader loop
+# over the CSV files, and every lookup (even for a single province) was a
+# full scan. Here, the vote, observer, turnout and CSO population tables
+# are loaded into one SQLite database with bulk executemany() inserts (one
+# transaction per table), with indexes on (province, district), PC_number
+# and PS_number. Province and district names are compared without regard
+# to case, so e.g. "Paktika" matches the upper-case names in the polling
+# station files.
+#
+# The database is rebuilt whenever it is older than any of its input
+# files. This module also has store-backed versions of the getters in
+# afghan_functions.py (they return the same dictionaries, and are what
+# those getters call after afghan_functions.setDataBackend("store")), and
+# getters for filtered lookups (e.g. one province's polling stations) that
+# use the indexes.
+#
+# Command-line arguments (optional): an SQL query to run against the
+# store, e.g.
+#
+#       python election_store.py "SELECT District, SUM(Total) FROM
+#               RunoffStations WHERE Province = 'Paktika' GROUP BY District"
+#
+# Inputs:
+#       * ../clean_data/first_round_votes.csv
+#       * ../clean_data/runoff_votes_and_turnout.csv
+#       * ../raw_data/raw_votes_runoff.csv
+#       * ../raw_data/raw_observers_first_round.csv
+#       * ../raw_data/raw_observers_runoff.csv
+#       * ../raw_data/raw_turnout_first_round.csv
+#       * ../raw_data/raw_cso_pop_13_14.csv
+#
+# Outputs:
+#       * ../clean_data/election_store.sqlite - The SQLite database.
+#       * stdout - The query's results, or (without a query) the number of
+#         rows in each table, and the time an indexed province lookup takes
+#         compared to a scan of the CSV file.
+#
+
+
+import os
+import sys
+import time
+import sqlite3
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import getCachedData, getCsvRows
+from bulk_csv import readCsvColumns
+from turnout_models import CSO_POPULATION_FILE, getDistrictIdToUrbanRuralPop
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# The tables loaded from CSV files. Each maps to its CSV file, its province
+# and district columns (None if it has none), and the other columns to
+# index.
+STORE_TABLES = {
+    "FirstRoundStations": (CLEAN_DATA_DIR + "first_round_votes.csv",
+                           "province", "district",
+                           ["PC_number", "PS_number"]),
+    "RunoffStations": (RAW_DATA_DIR + "raw_votes_runoff.csv",
+                       "Province", "District", ["PC_number", "PS_number"]),
+    "RunoffDistricts": (CLEAN_DATA_DIR + "runoff_votes_and_turnout.csv",
+                        "Province", "District", []),
+    "FirstRoundObservers": (RAW_DATA_DIR + "raw_observers_first_round.csv",
+                            "prov_name", "dist_name", ["iec_id"]),
+    "RunoffObservers": (RAW_DATA_DIR + "raw_observers_runoff.csv",
+                        "prov_name", "dist_name", ["IEC ID"]),
+    "FirstRoundTurnout": (RAW_DATA_DIR + "raw_turnout_first_round.csv",
+                          "province", None, []),
+}
+
+# The table of CSO urban and rural populations (by IEC district ID), which
+# is parsed by turnout_models.py.
+CSO_TABLE = "CsoPopulation"
+
+# The polling station table of each election.
+STATION_TABLES = {
+    "FirstRound": "FirstRoundStations",
+    "Runoff": "RunoffStations",
+}
+
+# The SQL type of each kind of NumPy column.
+SQL_TYPES = {"i": "INTEGER", "f": "REAL", "S": "TEXT", "U": "TEXT"}
+
+# The number of times the lookups in the main code are timed (the median is
+# reported).
+NUM_TIMING_RUNS = 5
+
+# OUTPUT FILES
+
+# The SQLite database.
+DATABASE_FILE = CLEAN_DATA_DIR + "election_store.sqlite"
+
+
+# This function quotes an SQL identifier (some column names have spaces or
+# dashes in them).
+#
+def quoteName(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# This function creates a table from a dictionary of typed columns (see
+# bulk_csv.py), inserts all of its rows with one executemany() in
+# one transaction, and creates its indexes. "indexes" is a list of column
+# lists. Text columns that are used in an index compare without regard to
+# case.
+#
+def createTable(connection, tableName, columnNames, columns, indexes):
+    indexedColumns = set(name for index in indexes for name in index)
+    columnDefinitions = list()
+
+    for columnName in columnNames:
+        definition = quoteName(columnName) + " " + \
+                SQL_TYPES[columns[columnName].dtype.kind]
+
+        if columns[columnName].dtype.kind in "SU" and \
+                columnName in indexedColumns:
+            definition += " COLLATE NOCASE"
+
+        columnDefinitions.append(definition)
+
+    # NaN is stored as NULL.
+    values = [[None if value != value else value for value in
+               columns[columnName].tolist()] for columnName in columnNames]
+
+    with connection:
+        connection.execute("CREATE TABLE " + quoteName(tableName) + " (" +\
+                           ", ".join(columnDefinitions) + ")")
+        connection.executemany("INSERT INTO " + quoteName(tableName) +\
+                " VALUES (" + ", ".join("?" * len(columnNames)) + ")",
+                zip(*values))
+
+        for index in indexes:
+            connection.execute("CREATE INDEX " + quoteName(tableName +\
+                    "_" + "_".join(index).replace(" ", "")) + " ON " +\
+                    quoteName(tableName) + " (" +\
+                    ", ".join(quoteName(name) for name in index) + ")")
+
+
+# This function opens a connection to a database file. Text is stored and
+# returned as str, like the strings read from the CSV files.
+#
+def connectToStore(databaseFile):
+    connection = sqlite3.connect(databaseFile)
+    connection.text_factory = str
+
+    return connection
+
+
+# This function (re)builds the database file from the input files.
+#
+def buildStore(databaseFile = DATABASE_FILE):
+    if os.path.exists(databaseFile):
+        os.remove(databaseFile)
+
+    connection = connectToStore(databaseFile)
+
+    for tableName in sorted(STORE_TABLES):
+        fileName, provinceColumn, districtColumn, indexedColumns = \
+                STORE_TABLES[tableName]
+        columnNames, columns = readCsvColumns(fileName)
+
+        nameColumns = [name for name in [provinceColumn, districtColumn]
+                       if name != None]
+        indexes = [nameColumns] + [[name] for name in indexedColumns]
+
+        createTable(connection, tableName, columnNames, columns, indexes)
+
+    districtIds, pops = getDistrictIdToUrbanRuralPop()
+    createTable(connection, CSO_TABLE,
+                ["DistrictId", "UrbanPopulation", "RuralPopulation"],
+                {"DistrictId": districtIds, "UrbanPopulation": pops[:, 0],
+                 "RuralPopulation": pops[:, 1]},
+                [["DistrictId"]])
+
+    connection.close()
+
+
+# This function returns the input files of the database.
+#
+def getStoreInputFiles():
+    return [STORE_TABLES[tableName][0] for tableName in STORE_TABLES] + \
+            [CSO_POPULATION_FILE]
+
+
+# This function returns a (cached) connection to the database, building it
+# first if it doesn't exist or is older than any of its input files.
+#
+def getStoreConnection():
+    def connect():
+        if not os.path.exists(DATABASE_FILE) or any(
+                os.path.getmtime(DATABASE_FILE) < os.path.getmtime(fileName)
+                for fileName in getStoreInputFiles()):
+            buildStore()
+
+        return connectToStore(DATABASE_FILE)
+
+    return getCachedData("StoreConnection", connect)
+
+
+# This function runs an SQL query against the store, and returns the
+# list of result rows.
+#
+def query(sql, parameters = ()):
+    return getStoreConnection().execute(sql, parameters).fetchall()
+
+
+# This function returns the rows (as tuples, in file column order) of an
+# election's polling stations in the given province (and district, if
+# given). This is an index seek on (province, district).
+#
+def getStations(election, province, district = None):
+    tableName = STATION_TABLES[election]
+    provinceColumn, districtColumn = STORE_TABLES[tableName][1:3]
+    sql = "SELECT * FROM " + quoteName(tableName) + " WHERE " +\
+            quoteName(provinceColumn) + " = ?"
+    parameters = [province]
+
+    if district != None:
+        sql += " AND " + quoteName(districtColumn) + " = ?"
+        parameters.append(district)
+
+    return query(sql, parameters)
+
+
+# This function returns the rows of an election's polling stations in the
+# given polling center. This is an index seek on PC_number.
+#
+def getPollingCenterStations(election, pcNumber):
+    return query("SELECT * FROM " + quoteName(STATION_TABLES[election]) +\
+                 " WHERE PC_number = ?", (pcNumber,))
+
+
+# The following functions are store-backed versions of the getters in
+# afghan_functions.py, and return the same dictionaries. They are used
+# through those getters when the data backend is "store" (see
+# afghan_functions.setDataBackend()).
+
+# This function returns a dictionary that maps province numbers to province
+# names (see afghan_functions.getProvinceNumToName()).
+#
+def getProvinceNumToName():
+    return dict(enumerate(row[0] for row in query(
+            "SELECT DISTINCT Province FROM RunoffDistricts " +\
+            "ORDER BY Province COLLATE BINARY")))
+
+
+# This function returns a dictionary that maps province names to their
+# populations.
+#
+def getProvinceNameToPop():
+    return dict(query("SELECT Province, SUM(TotalPopulation) FROM " +\
+                      "RunoffDistricts GROUP BY Province"))
+
+
+# This function returns a dictionary that maps (Province, District) tuples
+# to their populations.
+#
+def getProvinceDistrictToPop():
+    repeated = query("SELECT Province, District FROM RunoffDistricts " +\
+                     "GROUP BY Province, District HAVING COUNT(*) > 1")
+
+    if repeated:
+        raise Exception("Repeated (province, district) tuple (" +\
+                repeated[0][0] + ", " + repeated[0][1] + ") in " +\
+                STORE_TABLES["RunoffDistricts"][0] + "!")
+
+    return dict(((province, district), pop) for province, district, pop in
+                query("SELECT Province, District, TotalPopulation FROM " +\
+                      "RunoffDistricts"))
+
+
+# This function returns a dictionary that maps province numbers to the
+# runoff turnout in that province.
+#
+def getProvinceNumToTurnoutRunoff():
+    provinceNameToTurnout = dict(query("SELECT Province, 100.0 * " +\
+            "SUM(PopulationVoted) / (SUM(TotalPopulation) * ?) FROM " +\
+            "RunoffDistricts GROUP BY Province", (VOTING_FRACTION,)))
+
+    return dict((provinceNum, provinceNameToTurnout[provinceName])
+                for provinceNum, provinceName in
+                getProvinceNumToName().items())
+
+
+# This function returns a dictionary that maps (Province, District) tuples
+# to the runoff turnout in that district.
+#
+def getProvinceDistrictToTurnoutRunoff():
+    return dict(((province, district), turnout) for province, district,
+                turnout in query("SELECT Province, District, 100.0 * " +\
+                "SUM(PopulationVoted) / (MAX(TotalPopulation) * ?) FROM " +\
+                "RunoffDistricts GROUP BY Province, District",
+                (VOTING_FRACTION,)))
+
+
+# This function returns the median time (in ms) that function() takes.
+#
+def timeCall(function):
+    times = list()
+
+    for i in range(NUM_TIMING_RUNS):
+        startTime = time.time()
+        function()
+        times.append(1000.0 * (time.time() - startTime))
+
+    return np.median(times)
+
+
+# Main code
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for row in query(" ".join(sys.argv[1:])):
+            print("\t".join(str(value) for value in row))
+
+        sys.exit(0)
+
+    getStoreConnection()
+    print("Saved the election store to " + DATABASE_FILE)
+
+    for tableName in sorted(STORE_TABLES) + [CSO_TABLE]:
+        print("    " + tableName.ljust(22) + str(query("SELECT COUNT(*) " +\
+              "FROM " + quoteName(tableName))[0][0]).rjust(7) + " rows")
+
+    # One province's runoff polling stations, from the store and by
+    # scanning the (cached) CSV rows.
+    runoffFile = STORE_TABLES["RunoffStations"][0]
+    storeTime = timeCall(lambda: getStations("Runoff", "Paktika"))
+    scanTime = timeCall(lambda: [row for row in getCsvRows(runoffFile)
+                                 if row['Province'].lower() == "paktika"])
+    plan = query("EXPLAIN QUERY PLAN SELECT * FROM RunoffStations " +\
+                 "WHERE Province = ?", ("Paktika",))
+
+    print(str(len(getStations("Runoff", "Paktika"))) + " Paktika runoff " +\
+          "stations: " + ("%.2f" % storeTime) + " ms from the store, " +\
+          ("%.2f" % scanTime) + " ms scanning the CSV rows")
+    print("Query plan: " + plan[0][-1])
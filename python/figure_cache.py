@@ -0,0 +1,186 @@
+# Description: A content-addressed cache for the saved figures. Every run
+# of the plotting scripts used to redraw and re-encode every PNG under
+# ../figures/, even when the numbers behind it hadn't changed. Now, a
+# plotting function hashes everything that determines its figure (its input
+# arrays, its plot parameters, and the plotting function's own code) with
+# getFigureHash(), and asks isFigureCurrent() whether that figure has
+# already been saved:
+#
+#       * If the output file was saved with the same hash, nothing needs to
+#         be done.
+#       * If another file was saved with the same hash, it is copied to the
+#         output file.
+#       * Otherwise, the figure is drawn, and saveFigure() saves it and
+#         records its hash.
+#
+# The hashes are kept in a manifest (a JSON file that maps each hash to the
+# files saved with it, and each file's size and modification time when it
+# was saved). A file only counts as holding its figure while its size and
+# modification time still match, so figures that were deleted, overwritten
+# or edited since are redrawn.
+#
+# Outputs:
+#       * ../figures/figure_manifest.json - The manifest.
+#
+
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from lazy_imports import lazyImport
+
+# Import some convenience functions
+from afghan_functions import getCachedData
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+
+
+# Constants
+
+# DIRECTORIES
+FIGURES_DIR = "../figures/"
+
+# OUTPUT FILES
+
+# The manifest of saved figures.
+MANIFEST_FILE = FIGURES_DIR + "figure_manifest.json"
+
+
+# This function feeds a value into a hashlib hash. NumPy arrays are hashed
+# by their type, shape and bytes, dictionaries by their (sorted) items, and
+# lists and tuples item by item. Anything else is hashed by its repr().
+#
+def updateHash(hasher, value):
+    if isinstance(value, np.ndarray) and value.dtype.kind != 'O':
+        hasher.update((str(value.dtype) + str(value.shape)).encode("utf-8"))
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.ndarray):
+        updateHash(hasher, value.tolist())
+    elif isinstance(value, dict):
+        hasher.update(b"{")
+
+        for key in sorted(value, key = repr):
+            updateHash(hasher, key)
+            updateHash(hasher, value[key])
+
+        hasher.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"[")
+
+        for item in value:
+            updateHash(hasher, item)
+
+        hasher.update(b"]")
+    else:
+        hasher.update((type(value).__name__ + repr(value) + ";")
+                      .encode("utf-8"))
+
+
+# This function returns the hash of a figure drawn by plotFunction from the
+# given values. The function's name and code are part of the hash, so that
+# changing how a figure is drawn invalidates it.
+#
+def getFigureHash(plotFunction, *values):
+    code = plotFunction.__code__
+    hasher = hashlib.sha1()
+
+    updateHash(hasher, plotFunction.__name__)
+    hasher.update(code.co_code)
+    updateHash(hasher, [const for const in code.co_consts
+                        if not hasattr(const, "co_code")])
+    updateHash(hasher, list(values))
+
+    return hasher.hexdigest()
+
+
+# This function returns the (cached) manifest, a dictionary that maps each
+# figure hash to a dictionary of the files saved with it, and their stamps
+# (see getFileStamp()). Entries from older manifests, which only listed the
+# files, are dropped.
+#
+def getManifest():
+    def loadManifest():
+        if not os.path.exists(MANIFEST_FILE):
+            return dict()
+
+        with open(MANIFEST_FILE, 'r') as manifestFile:
+            return dict((figureHash, files) for figureHash, files in
+                        json.load(manifestFile).items()
+                        if isinstance(files, dict))
+
+    return getCachedData("FigureManifest", loadManifest)
+
+
+# This function returns the [size, modification time] stamp of a file, or
+# None if it doesn't exist.
+#
+def getFileStamp(fileName):
+    if not os.path.exists(fileName):
+        return None
+
+    fileStat = os.stat(fileName)
+
+    return [fileStat.st_size, fileStat.st_mtime]
+
+
+# This function records that outputFile was saved with the given hash (and
+# that it no longer holds whatever figure it held before), along with its
+# current stamp, and writes the manifest.
+#
+def recordFigure(outputFile, figureHash):
+    manifest = getManifest()
+    outputFile = os.path.normpath(outputFile)
+
+    for files in manifest.values():
+        files.pop(outputFile, None)
+
+    manifest.setdefault(figureHash, dict())[outputFile] = \
+            getFileStamp(outputFile)
+
+    for staleHash in [key for key in manifest if not manifest[key]]:
+        del manifest[staleHash]
+
+    if not os.path.isdir(os.path.dirname(MANIFEST_FILE)):
+        os.makedirs(os.path.dirname(MANIFEST_FILE))
+
+    with open(MANIFEST_FILE, 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent = 1, sort_keys = True)
+
+
+# This function returns whether outputFile already holds the figure with
+# the given hash (i.e. it was saved with that hash, and its stamp hasn't
+# changed since). If it doesn't, but another file does, that file is
+# copied to outputFile (and True is returned).
+#
+def isFigureCurrent(outputFile, figureHash):
+    files = getManifest().get(figureHash, dict())
+    fileNames = sorted(fileName for fileName in files
+                       if getFileStamp(fileName) == files[fileName])
+    outputFile = os.path.normpath(outputFile)
+
+    if outputFile in fileNames:
+        return True
+
+    if not fileNames:
+        return False
+
+    if os.path.dirname(outputFile) and \
+            not os.path.isdir(os.path.dirname(outputFile)):
+        os.makedirs(os.path.dirname(outputFile))
+
+    shutil.copyfile(fileNames[0], outputFile)
+    recordFigure(outputFile, figureHash)
+
+    return True
+
+
+# This function saves the current figure to outputFile (with
+# plt.savefig()), and records its hash.
+#
+def saveFigure(outputFile, figureHash, **savefigArguments):
+    plt.savefig(outputFile, **savefigArguments)
+    recordFigure(outputFile, figureHash)
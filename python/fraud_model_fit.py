@@ -0,0 +1,351 @@
+# Description: This script fits the parametric election fraud model of
+# Klimek et al. ("Statistical detection of systematic election
+# irregularities", PNAS 2012) to the runoff polling station data. The model
+# says that a fair election produces a single blob in the (turnout, winner's
+# vote share) plane, and that two kinds of "vote stuffing" pull stations
+# towards 100% turnout and 100% vote share:
+#
+#       * Incremental fraud (with probability fi per station): a fraction
+#         x ~ |N(0, sigmaX)| of the non-voters' ballots go to the winner,
+#         and a fraction x^alpha of the opponent's votes are switched over
+#         to the winner.
+#       * Extreme fraud (with probability fe per station): the same thing,
+#         but with x ~ 1 - |N(0, sigmaX)|, so almost every ballot at the
+#         station is stuffed.
+#
+# We simulate the model's 2D histogram ("fingerprint") for a grid of (fi,
+# fe, sigmaX) values and pick the one closest to the observed fingerprint
+# in the least-squares sense. The fair-election parameters (mean and width
+# of turnout and vote share) are estimated robustly from the data. The
+# random numbers are drawn once and shared by every grid point, so each
+# point is a handful of array operations, and the grid is spread over a
+# process pool.
+#
+# Since we don't know the electorate of each polling station, turnout is
+# approximated by the station's total votes divided by STATION_CAPACITY.
+#
+# Command-line arguments (optional, in this order):
+#       * Candidate's last name ("Ghani" or "Abdullah"); default "Ghani".
+#       * Number of worker processes; default is the number of CPUs.
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv
+#
+# Outputs:
+#       * ../clean_data/fraud_model_fit_<candidate>.csv - The fitted
+#         parameters and the loss at every grid point that was evaluated.
+#
+
+
+import sys
+import csv
+import multiprocessing
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import getStationColumns
+
+
+# Constants
+
+# VALUES
+from afghan_constants import STATION_CAPACITY
+
+# The number of bins along each axis of the (turnout, vote share)
+# fingerprint.
+NUM_FINGERPRINT_BINS = 40
+
+# The number of simulated stations per observed station.
+NUM_REPLICATES = 4
+
+# The exponent alpha in the model: an incremental fraud fraction x also
+# switches x^alpha of the opponent's votes to the winner. Klimek et al. use
+# alpha = 2.
+OPPONENT_STEALING_EXPONENT = 2.0
+
+# The coarse search grid for (fi, fe, sigmaX).
+INCREMENTAL_FRAUD_GRID = np.linspace(0.0, 1.0, 21)
+EXTREME_FRAUD_GRID = np.linspace(0.0, 0.3, 16)
+SIGMA_X_GRID = np.array([0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3])
+
+# The number of points along each axis in the refined (fi, fe) grid around
+# the best coarse point.
+NUM_REFINED_POINTS = 9
+
+# The seed for the shared random numbers, so fits are reproducible.
+RANDOM_SEED = 2014
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# CSV file for runoff votes by polling station.
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+
+# Global variables
+
+# The state shared by every fingerprint simulation in a process. This is
+# set by initSimulation() (in each worker, when using a process pool).
+simulationState = None
+
+
+# This function returns two arrays over the runoff polling stations with at
+# least one vote (and a province, see afghan_functions.getStationColumns()):
+# the turnout proxy (total votes / STATION_CAPACITY) and the given
+# candidate's vote share, both as fractions.
+#
+def getStationTurnoutAndShare(candidate):
+    if candidate != "Abdullah" and candidate != "Ghani":
+        raise ValueError("The input candidate " + candidate + " was " +\
+                "neither Abdullah nor Ghani!")
+
+    columns = getStationColumns(RUNOFF_VOTES_POLLING_STATION_FILE)
+    candidateVotes = columns[candidate].astype(float)
+    totalVotes = columns['Total'].astype(float)
+    voted = totalVotes > 0
+
+    turnouts = np.minimum(totalVotes[voted] / STATION_CAPACITY, 1.0)
+    shares = candidateVotes[voted] / totalVotes[voted]
+
+    return turnouts, shares
+
+
+# This function estimates the fair-election parameters (mean turnout,
+# turnout width, mean vote share, vote share width) from observed turnouts
+# and vote shares. Medians and MAD-based widths are used, so the stuffed
+# stations near (1, 1) don't drag the estimates around.
+#
+def estimateFairParameters(turnouts, shares):
+    def robustWidth(values):
+        return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+    return (np.median(turnouts), robustWidth(turnouts),
+            np.median(shares), robustWidth(shares))
+
+
+# This function returns the flattened (turnout, vote share) fingerprint bin
+# of each station, for turnouts and vote shares in [0, 1].
+#
+def getFingerprintBins(turnouts, shares):
+    turnoutBins = np.minimum((turnouts * NUM_FINGERPRINT_BINS).astype(int),
+                             NUM_FINGERPRINT_BINS - 1)
+    shareBins = np.minimum((shares * NUM_FINGERPRINT_BINS).astype(int),
+                           NUM_FINGERPRINT_BINS - 1)
+
+    return turnoutBins * NUM_FINGERPRINT_BINS + shareBins
+
+
+# This function returns the normalized 2D histogram (a flattened array of
+# NUM_FINGERPRINT_BINS^2 fractions) of turnouts and vote shares in [0, 1].
+# It uses a single bincount rather than np.histogram2d.
+#
+def getFingerprint(turnouts, shares):
+    counts = np.bincount(getFingerprintBins(turnouts, shares),
+                         minlength = NUM_FINGERPRINT_BINS**2)
+
+    return counts / float(len(turnouts))
+
+
+# This function sets up the shared random numbers, fair-election parameters
+# and observed fingerprint used by simulateFingerprint() and
+# getGridLoss(). It is used as the process pool initializer.
+#
+# The fair-election turnouts and vote shares don't depend on the fraud
+# parameters, so they (and their fingerprint counts) are computed once
+# here. The simulated stations are sorted by their fraud uniform draw, so
+# the stations with fraud for a given (fi, fe) are always a prefix of the
+# arrays.
+#
+def initSimulation(fairParameters, observedFingerprint, numUnits):
+    global simulationState
+
+    meanTurnout, turnoutWidth, meanShare, shareWidth = fairParameters
+    randomState = np.random.RandomState(RANDOM_SEED)
+
+    turnouts = np.clip(meanTurnout + turnoutWidth * \
+                       randomState.randn(numUnits), 0.0, 1.0)
+    shares = np.clip(meanShare + shareWidth * randomState.randn(numUnits),
+                     0.0, 1.0)
+    fraudNormals = np.abs(randomState.randn(numUnits))
+    uniforms = randomState.rand(numUnits)
+    order = np.argsort(uniforms)
+
+    simulationState = dict()
+    simulationState["ObservedFingerprint"] = observedFingerprint
+    simulationState["Turnouts"] = turnouts[order]
+    simulationState["Shares"] = shares[order]
+    simulationState["FraudNormals"] = fraudNormals[order]
+    simulationState["FraudUniforms"] = uniforms[order]
+    simulationState["FairBins"] = getFingerprintBins(
+            simulationState["Turnouts"], simulationState["Shares"])
+    simulationState["FairCounts"] = np.bincount(
+            simulationState["FairBins"],
+            minlength = NUM_FINGERPRINT_BINS**2)
+
+
+# This function simulates the model's fingerprint for the given incremental
+# fraud probability fi, extreme fraud probability fe and fraud width
+# sigmaX, using the shared random numbers from initSimulation(). Only the
+# stations with fraud are recomputed; their fair-election counts are
+# swapped out of the precomputed fair fingerprint.
+#
+def simulateFingerprint(fi, fe, sigmaX):
+    uniforms = simulationState["FraudUniforms"]
+    numIncremental = np.searchsorted(uniforms, fi)
+    numFraud = np.searchsorted(uniforms, fi + fe)
+
+    turnouts = simulationState["Turnouts"][:numFraud]
+    shares = simulationState["Shares"][:numFraud]
+    fraudNormals = simulationState["FraudNormals"][:numFraud]
+
+    # The fraction of non-voters' ballots stuffed at each station.
+    stuffed = sigmaX * fraudNormals
+    stuffed[numIncremental:] = 1.0 - stuffed[numIncremental:]
+    stuffed = np.clip(stuffed, 0.0, 1.0)
+    stolen = stuffed**OPPONENT_STEALING_EXPONENT
+
+    # Everything below is a fraction of the station's electorate.
+    fraudTurnouts = turnouts + stuffed * (1.0 - turnouts)
+    winnerVotes = turnouts * shares + stuffed * (1.0 - turnouts) + \
+            stolen * turnouts * (1.0 - shares)
+
+    # Stations with no votes at all keep their fair-election vote share,
+    # just like the stations without fraud.
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        fraudShares = np.where(fraudTurnouts > 0.0,
+                               winnerVotes / fraudTurnouts, shares)
+
+    counts = simulationState["FairCounts"] - np.bincount(
+            simulationState["FairBins"][:numFraud],
+            minlength = NUM_FINGERPRINT_BINS**2)
+    counts += np.bincount(getFingerprintBins(fraudTurnouts,
+                                             np.clip(fraudShares, 0.0, 1.0)),
+                          minlength = NUM_FINGERPRINT_BINS**2)
+
+    return counts / float(len(uniforms))
+
+
+# This function returns the sum of squared differences between the
+# simulated fingerprint for "parameters" (an (fi, fe, sigmaX) tuple) and
+# the observed fingerprint.
+#
+def getGridLoss(parameters):
+    fi, fe, sigmaX = parameters
+
+    # Probabilities that add up to more than 1 aren't meaningful.
+    if fi + fe > 1.0:
+        return np.inf
+
+    difference = simulateFingerprint(fi, fe, sigmaX) - \
+            simulationState["ObservedFingerprint"]
+
+    return float((difference**2.0).sum())
+
+
+# This function evaluates getGridLoss() at every point in "grid", using the
+# given pool (or in this process, if pool is None).
+#
+def getGridLosses(grid, pool):
+    if pool == None:
+        return np.array([getGridLoss(parameters) for parameters in grid])
+
+    chunkSize = max(1, len(grid) // (4 * multiprocessing.cpu_count()))
+
+    return np.array(pool.map(getGridLoss, grid, chunkSize))
+
+
+# This function fits the fraud model for the given candidate (the "winner"
+# in the model) to the runoff polling station data. It first searches the
+# coarse (fi, fe, sigmaX) grid, then a finer (fi, fe) grid around the best
+# point. It returns a dictionary with the best "IncrementalFraud",
+# "ExtremeFraud", "SigmaX" and "Loss", the "FairParameters", and the
+# (parameters, loss) of every grid point in "Grid".
+#
+def fitFraudModel(candidate, numProcesses = None):
+    turnouts, shares = getStationTurnoutAndShare(candidate)
+    fairParameters = estimateFairParameters(turnouts, shares)
+    initArgs = (fairParameters, getFingerprint(turnouts, shares),
+                NUM_REPLICATES * len(turnouts))
+
+    if numProcesses == None:
+        numProcesses = multiprocessing.cpu_count()
+
+    pool = None
+
+    if numProcesses > 1:
+        pool = multiprocessing.Pool(numProcesses, initSimulation, initArgs)
+
+    initSimulation(*initArgs)
+
+    try:
+        # Coarse search over all three parameters.
+        coarseGrid = [(fi, fe, sigmaX) for fi in INCREMENTAL_FRAUD_GRID
+                      for fe in EXTREME_FRAUD_GRID
+                      for sigmaX in SIGMA_X_GRID]
+        coarseLosses = getGridLosses(coarseGrid, pool)
+        bestFi, bestFe, bestSigmaX = coarseGrid[np.argmin(coarseLosses)]
+
+        # Refine (fi, fe) to within one coarse step of the best point.
+        fiStep = INCREMENTAL_FRAUD_GRID[1] - INCREMENTAL_FRAUD_GRID[0]
+        feStep = EXTREME_FRAUD_GRID[1] - EXTREME_FRAUD_GRID[0]
+        refinedGrid = [(fi, fe, bestSigmaX)
+                for fi in np.linspace(max(bestFi - fiStep, 0.0),
+                                      min(bestFi + fiStep, 1.0),
+                                      NUM_REFINED_POINTS)
+                for fe in np.linspace(max(bestFe - feStep, 0.0),
+                                      min(bestFe + feStep, 1.0),
+                                      NUM_REFINED_POINTS)]
+        refinedLosses = getGridLosses(refinedGrid, pool)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    grid = coarseGrid + refinedGrid
+    losses = np.concatenate((coarseLosses, refinedLosses))
+    best = np.argmin(losses)
+
+    results = dict()
+    results["IncrementalFraud"] = grid[best][0]
+    results["ExtremeFraud"] = grid[best][1]
+    results["SigmaX"] = grid[best][2]
+    results["Loss"] = losses[best]
+    results["FairParameters"] = fairParameters
+    results["Grid"] = list(zip(grid, losses))
+
+    return results
+
+
+# Main code
+if __name__ == "__main__":
+    candidate = "Ghani"
+    numProcesses = None
+
+    if len(sys.argv) > 1:
+        candidate = sys.argv[1].strip().title()
+
+    if len(sys.argv) > 2:
+        numProcesses = int(sys.argv[2])
+
+    results = fitFraudModel(candidate, numProcesses)
+
+    print("Fraud model fit for " + candidate + ":")
+    print("    incremental fraud fraction fi = " +\
+          str(results["IncrementalFraud"]))
+    print("    extreme fraud fraction fe = " + str(results["ExtremeFraud"]))
+    print("    fraud width sigmaX = " + str(results["SigmaX"]))
+    print("    fingerprint loss = " + str(results["Loss"]))
+
+    outputFile = CLEAN_DATA_DIR + "fraud_model_fit_" + candidate.lower() +\
+            ".csv"
+    csvWriter = csv.writer(open(outputFile, "w"))
+    csvWriter.writerow(["IncrementalFraud", "ExtremeFraud", "SigmaX",
+                        "Loss"])
+
+    for (fi, fe, sigmaX), loss in results["Grid"]:
+        csvWriter.writerow([fi, fe, sigmaX, loss])
+
+    print("Saved fraud model grid losses to\n" + outputFile)
@@ -0,0 +1,243 @@
+# Description: A histogram engine that keeps binning separate from
+# plotting. The scripts used to call ax.hist/plt.hist straight on their
+# data, so the counts were never saved, every re-styled figure recomputed
+# them, and turnout_distrib.py ended up passing non-integer bin counts
+# (which newer versions of NumPy reject).
+#
+# Here, a histogram is described by a spec: a (name, values, low, high,
+# numBins) tuple, with numBins equal-width bins over [low, high] (the last
+# bin includes "high", like np.histogram; values outside the range or
+# that aren't finite are left out). computeHistograms() bins the values of
+# every spec with one np.bincount over all of them at once. The result is a
+# dictionary of arrays that can be saved to and loaded from an .npz file,
+# and renderHistogram() draws one histogram from it on demand. Saved
+# histograms also hold the parameters they were computed with (see
+# getHistogramParameters()), so getCachedHistograms() recomputes them when
+# those change, and not just when their input files do.
+# renderHistogramFigures() renders and saves several figures at once, over
+# a process pool (skipping the ones that haven't changed since they were
+# last saved).
+#
+
+
+import os
+import json
+import multiprocessing
+import numpy as np
+from lazy_imports import lazyImport
+
+# Import some convenience functions
+from figure_cache import getFigureHash, isFigureCurrent, recordFigure
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+
+
+# This function bins the values of every spec in one pass. It returns a
+# dictionary with the "Names", "Lows", "Highs" and "NumBins" of the specs,
+# the "Offsets" of each histogram's counts (histogram i is
+# Counts[Offsets[i]:Offsets[i + 1]]), and the concatenated "Counts".
+#
+def computeHistograms(specs):
+    names = [spec[0] for spec in specs]
+    valueArrays = [np.asarray(spec[1], dtype = float).ravel()
+                   for spec in specs]
+    lows = np.array([spec[2] for spec in specs], dtype = float)
+    highs = np.array([spec[3] for spec in specs], dtype = float)
+    numBins = np.array([spec[4] for spec in specs], dtype = np.int64)
+
+    if len(set(names)) != len(names):
+        raise ValueError("Histogram names must be unique")
+
+    offsets = np.concatenate([[0], np.cumsum(numBins)])
+    lengths = [len(values) for values in valueArrays]
+
+    # Give every value its histogram's range and offset, so that all of
+    # the values can be binned together.
+    values = np.concatenate(valueArrays) if specs else np.zeros(0)
+    valueLows = np.repeat(lows, lengths)
+    valueHighs = np.repeat(highs, lengths)
+    valueNumBins = np.repeat(numBins, lengths)
+    valueOffsets = np.repeat(offsets[:-1], lengths)
+
+    with np.errstate(invalid = 'ignore'):
+        inRange = np.isfinite(values) & (values >= valueLows) & \
+                (values <= valueHighs)
+
+    values = values[inRange]
+    valueLows = valueLows[inRange]
+    valueNumBins = valueNumBins[inRange]
+    bins = ((values - valueLows) / (valueHighs[inRange] - valueLows) *
+            valueNumBins).astype(np.int64)
+    bins = np.minimum(bins, valueNumBins - 1)
+
+    histograms = dict()
+    histograms["Names"] = np.array(names)
+    histograms["Lows"] = lows
+    histograms["Highs"] = highs
+    histograms["NumBins"] = numBins
+    histograms["Offsets"] = offsets
+    histograms["Counts"] = np.bincount(bins + valueOffsets[inRange],
+                                       minlength = offsets[-1])
+
+    return histograms
+
+
+# This function returns the (counts, bin edges) of the named histogram.
+#
+def getHistogram(histograms, name):
+    matches = np.nonzero(histograms["Names"] == name)[0]
+
+    if len(matches) == 0:
+        raise ValueError("No histogram named " + name)
+
+    i = matches[0]
+    counts = histograms["Counts"][histograms["Offsets"][i]:
+                                  histograms["Offsets"][i + 1]]
+    edges = np.linspace(histograms["Lows"][i], histograms["Highs"][i],
+                        histograms["NumBins"][i] + 1)
+
+    return counts, edges
+
+
+# This function saves histograms to an .npz file.
+#
+def saveHistograms(histograms, fileName):
+    np.savez(fileName, **histograms)
+
+
+# This function loads histograms from an .npz file.
+#
+def loadHistograms(fileName):
+    histogramFile = np.load(fileName)
+    histograms = dict((key, histogramFile[key])
+                      for key in histogramFile.files)
+    histogramFile.close()
+
+    # Files saved by Python 2 hold byte strings.
+    for key in ["Names", "Parameters"]:
+        if key in histograms and histograms[key].dtype.kind == 'S':
+            histograms[key] = histograms[key].astype(str)
+
+    return histograms
+
+
+# This function returns a string that describes everything about a list of
+# specs except for their values: each spec's name, range and number of
+# bins, and the "constants" (a dictionary of anything else that the values
+# depend on, e.g. {"VotingFraction": VOTING_FRACTION}).
+#
+def getHistogramParameters(specs, constants = None):
+    return json.dumps({"Constants": constants if constants != None else {},
+                       "Specs": [[str(spec[0]), float(spec[2]),
+                                  float(spec[3]), int(spec[4])]
+                                 for spec in specs]}, sort_keys = True)
+
+
+# This function returns the histograms saved in fileName if that file is
+# newer than all of the inputFiles, and was computed with the same
+# parameters (see getHistogramParameters()) as the specs that getSpecs() (a
+# function that returns the list of specs) returns now, and the given
+# constants. Otherwise, it computes them from those specs and saves them,
+# along with their parameters, so re-rendering a figure doesn't redo the
+# binning.
+#
+def getCachedHistograms(fileName, inputFiles, getSpecs, constants = None):
+    specs = getSpecs()
+    parameters = getHistogramParameters(specs, constants)
+
+    if os.path.exists(fileName) and all(os.path.getmtime(fileName) >=
+            os.path.getmtime(inputFile) for inputFile in inputFiles):
+        histograms = loadHistograms(fileName)
+
+        if "Parameters" in histograms and \
+                str(histograms["Parameters"]) == parameters:
+            return histograms
+
+    histograms = computeHistograms(specs)
+    histograms["Parameters"] = np.array(parameters)
+    saveHistograms(histograms, fileName)
+
+    return histograms
+
+
+# This function returns the number of bins and the upper limit for a
+# histogram that starts at 0, covers "values" entirely, and has an edge at
+# "split" (so that bars on either side of it can be colored differently).
+# The bin width is about maxValue / numBins.
+#
+def getSplitBinning(values, split, numBins):
+    maxValue = np.nanmax(values)
+    numBinsBelowSplit = max(int(round(numBins * split / maxValue)), 1)
+    binWidth = split / float(numBinsBelowSplit)
+    totalBins = max(int(np.ceil(maxValue / binWidth)), numBinsBelowSplit)
+
+    return totalBins, totalBins * binWidth
+
+
+# This function draws a histogram from its counts and edges on the current
+# figure. "color" may be a single color or one color per bin.
+#
+def renderHistogram(counts, edges, color = 'b'):
+    plt.bar(edges[:-1], counts, np.diff(edges), align = 'edge',
+            color = color, edgecolor = 'k', linewidth = 0.5)
+
+
+# This function renders one histogram figure and saves it. "job" is a
+# dictionary with the histogram's "Counts" and "Edges", its "Color" (as in
+# renderHistogram()), "XLabel", "YLabel" and "Title", an optional "XLim",
+# and the "OutputFile". It returns the output file.
+#
+def renderHistogramFigure(job):
+    fig = plt.figure()
+    fig.set_facecolor('white')
+    renderHistogram(job["Counts"], job["Edges"], job.get("Color", 'b'))
+    plt.xlabel(job["XLabel"])
+    plt.ylabel(job["YLabel"])
+    plt.title(job["Title"])
+
+    if job.get("XLim") != None:
+        plt.xlim(job["XLim"])
+
+    plt.savefig(job["OutputFile"], bbox_inches = "tight")
+    plt.close()
+
+    return job["OutputFile"]
+
+
+# This function renders every job (see renderHistogramFigure()) over a pool
+# of numProcesses worker processes (by default, one per CPU, up to the
+# number of jobs), and returns the output files that were rendered, in
+# order. Each figure is independent, so the slow part (drawing and PNG
+# encoding) runs in parallel. Jobs whose figure is already saved (see
+# figure_cache.py) are skipped.
+#
+def renderHistogramFigures(jobs, numProcesses = None):
+    figureHashes = [getFigureHash(renderHistogramFigure, dict((key, job[key])
+                    for key in job if key != "OutputFile")) for job in jobs]
+    jobs = [(job, figureHash) for job, figureHash in zip(jobs, figureHashes)
+            if not isFigureCurrent(job["OutputFile"], figureHash)]
+
+    if numProcesses == None:
+        numProcesses = multiprocessing.cpu_count()
+
+    numProcesses = min(numProcesses, len(jobs))
+
+    if numProcesses <= 1:
+        outputFiles = [renderHistogramFigure(job) for job, _ in jobs]
+    else:
+        pool = multiprocessing.Pool(numProcesses)
+
+        try:
+            outputFiles = pool.map(renderHistogramFigure,
+                                   [job for job, _ in jobs])
+        finally:
+            pool.close()
+            pool.join()
+
+    # The manifest is only written here, not by the worker processes.
+    for outputFile, (job, figureHash) in zip(outputFiles, jobs):
+        recordFigure(outputFile, figureHash)
+
+    return outputFiles
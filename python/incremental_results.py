@@ -0,0 +1,372 @@
+# Description: This module supports "election night" re-analysis, where
+# polling station results arrive in batches. Rather than recomputing every
+# aggregate from the whole file (as getProvinceDistrictToTurnoutRunoff,
+# getProvinceDistrictToGhaniWinningMargin and turnout_convert.py do), it
+# keeps running accumulators and only touches what a batch affects:
+#
+#       * The district accumulators live in a runoff summary cube (see
+#         summary_cube.py), which is updated with the batch's rows.
+#       * Province accumulators (Abdullah, Ghani and total votes) are
+#         updated with one bincount over the batch's provinces.
+#       * Turnout, Ghani's winning margin and Ghani's vote share are
+#         recomputed only for the districts and provinces in the batch.
+#       * The figures that depend on the changed data are marked dirty, so
+#         the caller knows what to re-render.
+#
+# The cost of ingesting a batch is proportional to the size of the batch
+# (plus the number of districts, when a batch introduces a new district).
+# ingestAppendedRows() remembers how far into a polling station file it
+# has read, so only newly appended rows are parsed.
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv (or any file in its schema)
+#
+
+
+import csv
+import time
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import openCsvFile, pcNumbersToDistrictIds,\
+        alignToKeys
+from observer_district_trends import getDistrictIdToPop
+from summary_cube import ELECTIONS, NUM_TURNOUT_BINS, normalizeProvinceName,\
+        addStationsToCube, buildSummaryCube, getCubeDistrictTurnouts, rollUp
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION
+from afghan_functions import UNASSIGNED_PROVINCE
+
+# The number of rows per batch when replaying a whole file in the main
+# code.
+REPLAY_BATCH_SIZE = 1000
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+FIGURE_DIR = "../figures/"
+
+# INPUT FILES
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# OUTPUT FILES
+
+# The figures that depend on any district-level runoff aggregate.
+NATIONAL_FIGURES = [
+    FIGURE_DIR + "turnout_distribs/runoff_turnout_distrib_entire.png",
+    FIGURE_DIR + "turnout_distribs/runoff_turnout_distrib_restricted.png",
+    FIGURE_DIR + "winning_margin_analysis/wma_by_province.png",
+    FIGURE_DIR + "winning_margin_analysis/wma_by_district.png",
+    FIGURE_DIR + "vote_share_vs_t/runoff_abdullah_vote_share_vs_t.png",
+    FIGURE_DIR + "vote_share_vs_t/runoff_abdullah_vote_share_vs_t_resid.png",
+    FIGURE_DIR + "vote_share_vs_t/runoff_ghani_vote_share_vs_t.png",
+    FIGURE_DIR + "vote_share_vs_t/runoff_ghani_vote_share_vs_t_resid.png",
+    FIGURE_DIR + "v_over_e_vs_t/runoff_abdullah_v_over_e_vs_t.png",
+    FIGURE_DIR + "v_over_e_vs_t/runoff_abdullah_v_over_e_vs_t_resid.png",
+    FIGURE_DIR + "v_over_e_vs_t/runoff_ghani_v_over_e_vs_t.png",
+    FIGURE_DIR + "v_over_e_vs_t/runoff_ghani_v_over_e_vs_t_resid.png",
+    FIGURE_DIR + "heatmap/heatmap_turnout.png",
+]
+
+# The per-province vote share figures (see province_vote_share_hist.py),
+# as a format string taking the candidate and province (both lower case).
+PROVINCE_FIGURE_FORMAT = FIGURE_DIR + \
+        "province_vote_share/%s_%s_distrib.png"
+
+
+# This function returns a new, empty election night state. The keys are:
+#
+#       * "Cube" - the runoff summary cube of everything ingested so far.
+#       * "Provinces", "ProvinceVotes" - the sorted province names, and a
+#         (provinces, 3) array of their Abdullah, Ghani and total votes.
+#       * "DistrictTurnout", "DistrictGhaniMargin", "DistrictGhaniShare" -
+#         per-district percentages, aligned with the cube's districts.
+#       * "ProvinceTurnout", "ProvinceGhaniMargin", "ProvinceGhaniShare" -
+#         per-province percentages, aligned with "Provinces".
+#       * "DirtyFigures" - the set of figure files that are out of date.
+#       * "FileOffsets" - how far into each file ingestAppendedRows() has
+#         read.
+#
+def newIncrementalState():
+    candidates = ELECTIONS["Runoff"][1]
+
+    cube = dict()
+    cube["Candidates"] = np.array(candidates)
+    cube["DistrictIds"] = np.zeros(0, dtype = np.int64)
+    cube["Provinces"] = np.zeros(0, dtype = str)
+    cube["Population"] = np.zeros(0)
+    cube["Observers"] = np.zeros(0)
+    cube["Votes"] = np.zeros((0, NUM_TURNOUT_BINS, len(candidates)))
+    cube["DistrictVotes"] = np.zeros(0)
+    cube["Stations"] = np.zeros((0, NUM_TURNOUT_BINS))
+
+    popIds, pops = getDistrictIdToPop()
+
+    state = dict()
+    state["Cube"] = cube
+    state["PopulationIds"] = popIds
+    state["Populations"] = pops
+    state["Provinces"] = np.zeros(0, dtype = str)
+    state["ProvinceVotes"] = np.zeros((0, 3))
+    state["ProvincePopulation"] = np.zeros(0)
+
+    for key in ["DistrictTurnout", "DistrictGhaniMargin",
+                "DistrictGhaniShare", "ProvinceTurnout",
+                "ProvinceGhaniMargin", "ProvinceGhaniShare"]:
+        state[key] = np.zeros(0)
+
+    state["DirtyFigures"] = set()
+    state["FileOffsets"] = dict()
+
+    return state
+
+
+# This function parses rows in the raw_votes_runoff.csv schema (a list of
+# CSV lines, or an open file, without the header) into a (districtIds,
+# provinces, votes) tuple, where votes is an (N, 2) array of Abdullah and
+# Ghani votes. Stations that aren't assigned to a province are left out,
+# as they are everywhere else (see afghan_functions.getStationColumns()).
+#
+def parseStationRows(lines):
+    pcNumbers = list()
+    provinces = list()
+    votes = list()
+
+    for row in csv.reader(lines):
+        if len(row) < 7 or row[0].strip() == UNASSIGNED_PROVINCE:
+            continue
+
+        provinces.append(normalizeProvinceName(row[0]))
+        pcNumbers.append(int(row[2]))
+        votes.append([float(row[4]), float(row[5])])
+
+    return pcNumbersToDistrictIds(pcNumbers), np.array(provinces),\
+            np.array(votes).reshape(-1, 2)
+
+
+# This function recomputes the derived district percentages for the given
+# cube district indices.
+#
+def updateDistrictPercentages(state, districtIndices):
+    cube = state["Cube"]
+    votes = cube["Votes"][districtIndices].sum(axis = 1)
+    totals = cube["DistrictVotes"][districtIndices]
+    eligible = cube["Population"][districtIndices] * VOTING_FRACTION
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        state["DistrictTurnout"][districtIndices] = 100.0 * totals / eligible
+        state["DistrictGhaniMargin"][districtIndices] = 100.0 * \
+                (votes[:, 1] - votes[:, 0]) / totals
+        state["DistrictGhaniShare"][districtIndices] = 100.0 * \
+                votes[:, 1] / totals
+
+
+# This function recomputes the derived province percentages for the given
+# province indices.
+#
+def updateProvincePercentages(state, provinceIndices):
+    votes = state["ProvinceVotes"][provinceIndices]
+    eligible = state["ProvincePopulation"][provinceIndices] * \
+            VOTING_FRACTION
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        state["ProvinceTurnout"][provinceIndices] = 100.0 * votes[:, 2] / \
+                eligible
+        state["ProvinceGhaniMargin"][provinceIndices] = 100.0 * \
+                (votes[:, 1] - votes[:, 0]) / votes[:, 2]
+        state["ProvinceGhaniShare"][provinceIndices] = 100.0 * \
+                votes[:, 1] / votes[:, 2]
+
+
+# This function is called when a batch introduces districts or provinces
+# that weren't seen before. It realigns the populations and all of the
+# derived arrays with the (re-sorted) cube districts and provinces. This
+# costs O(districts), but only happens the first time a district reports.
+#
+def realignState(state):
+    cube = state["Cube"]
+    cube["Population"] = alignToKeys(cube["DistrictIds"],
+                                     state["PopulationIds"],
+                                     state["Populations"])
+
+    numDistricts = len(cube["DistrictIds"])
+
+    for key in ["DistrictTurnout", "DistrictGhaniMargin",
+                "DistrictGhaniShare"]:
+        state[key] = np.full(numDistricts, np.nan)
+
+    updateDistrictPercentages(state, np.arange(numDistricts))
+
+    # Province populations only count districts with known populations.
+    provinceIndices = np.searchsorted(state["Provinces"], cube["Provinces"])
+    state["ProvincePopulation"] = np.bincount(provinceIndices,
+            np.nan_to_num(cube["Population"]),
+            minlength = len(state["Provinces"]))
+
+    for key in ["ProvinceTurnout", "ProvinceGhaniMargin",
+                "ProvinceGhaniShare"]:
+        state[key] = np.full(len(state["Provinces"]), np.nan)
+
+    updateProvincePercentages(state, np.arange(len(state["Provinces"])))
+
+
+# This function ingests a batch of polling station rows (a (districtIds,
+# provinces, votes) tuple as returned by parseStationRows()) into the
+# state, and marks the affected figures as dirty. It returns the sorted
+# IEC district IDs that were affected.
+#
+def ingestStationBatch(state, rows):
+    districtIds, provinces, votes = rows
+
+    if len(districtIds) == 0:
+        return np.zeros(0, dtype = np.int64)
+
+    cube = state["Cube"]
+    numDistrictsBefore = len(cube["DistrictIds"])
+    addStationsToCube(cube, districtIds, provinces, votes)
+
+    # Update the province accumulators, adding any new provinces.
+    batchProvinces, provinceInverse = np.unique(provinces,
+                                                return_inverse = True)
+    newProvinces = batchProvinces[~np.isin(batchProvinces,
+                                           state["Provinces"])]
+
+    if len(newProvinces) > 0:
+        allProvinces = np.concatenate((state["Provinces"].astype(object),
+                                       newProvinces.astype(object)))
+        order = np.argsort(allProvinces)
+        state["Provinces"] = allProvinces[order].astype(str)
+        state["ProvinceVotes"] = np.concatenate((state["ProvinceVotes"],
+                np.zeros((len(newProvinces), 3))))[order]
+
+    batchProvinceIndices = np.searchsorted(state["Provinces"],
+                                           batchProvinces)
+    batchTotals = np.zeros((len(batchProvinces), 3))
+    np.add.at(batchTotals, provinceInverse,
+              np.column_stack((votes, votes.sum(axis = 1))))
+    state["ProvinceVotes"][batchProvinceIndices] += batchTotals
+
+    # Recompute only what changed (or everything, if the set of districts
+    # or provinces changed).
+    affectedIds = np.unique(districtIds)
+
+    if len(cube["DistrictIds"]) != numDistrictsBefore or \
+            len(newProvinces) > 0:
+        realignState(state)
+    else:
+        updateDistrictPercentages(state, np.searchsorted(
+                cube["DistrictIds"], affectedIds))
+        updateProvincePercentages(state, batchProvinceIndices)
+
+    # Mark the affected figures as dirty.
+    state["DirtyFigures"].update(NATIONAL_FIGURES)
+
+    for provinceName in batchProvinces:
+        for candidate in cube["Candidates"]:
+            state["DirtyFigures"].add(PROVINCE_FIGURE_FORMAT % \
+                    (str(candidate).lower(), str(provinceName).lower()))
+
+    return affectedIds
+
+
+# This function ingests the rows that have been appended to a polling
+# station file since the last call (or the whole file, on the first call),
+# skipping the header. Only complete lines are read, so a row that is
+# still being written is picked up next time. It returns the affected IEC
+# district IDs.
+#
+def ingestAppendedRows(state, fileName):
+    offset = state["FileOffsets"].get(fileName, None)
+
+    with open(fileName, 'rb') as batchFile:
+        if offset == None:
+            batchFile.readline()
+        else:
+            batchFile.seek(offset)
+
+        data = batchFile.read()
+
+        # Only keep complete lines.
+        end = data.rfind(b"\n") + 1
+        state["FileOffsets"][fileName] = batchFile.tell() - len(data) + end
+
+    # The csv module wants bytes in Python 2, and text in Python 3.
+    data = data[:end]
+
+    if not isinstance(data, str):
+        data = data.decode("utf-8")
+
+    return ingestStationBatch(state, parseStationRows(data.splitlines()))
+
+
+# This function returns the set of dirty figure files, and marks them all
+# as clean (the caller is expected to re-render them).
+#
+def popDirtyFigures(state):
+    dirtyFigures = state["DirtyFigures"]
+    state["DirtyFigures"] = set()
+
+    return dirtyFigures
+
+
+# This function returns a dictionary that maps (Province, District ID)
+# tuples to the district turnout percentages in the state, like
+# getProvinceDistrictToTurnoutRunoff() does for names.
+#
+def getProvinceDistrictIdToTurnout(state):
+    cube = state["Cube"]
+
+    return dict(zip(zip(cube["Provinces"], cube["DistrictIds"]),
+                    state["DistrictTurnout"]))
+
+
+# Main code
+if __name__ == "__main__":
+    # Replay the runoff results in batches, as if they were arriving on
+    # election night.
+    with openCsvFile(RUNOFF_VOTES_POLLING_STATION_FILE) as csvFile:
+        lines = csvFile.read().splitlines()[1:]
+
+    state = newIncrementalState()
+    batchTimes = list()
+
+    for start in range(0, len(lines), REPLAY_BATCH_SIZE):
+        rows = parseStationRows(lines[start:start + REPLAY_BATCH_SIZE])
+
+        startTime = time.time()
+        ingestStationBatch(state, rows)
+        batchTimes.append(time.time() - startTime)
+
+    print("Ingested " + str(len(state["Cube"]["DistrictIds"])) +\
+          " districts from " + str(len(lines)) + " polling stations in " +\
+          str(len(batchTimes)) + " batches (median " +\
+          str(1000.0 * np.median(batchTimes)) + " ms per batch)")
+
+    # The incremental results should match the runoff summary cube, which
+    # is built from the whole file at once.
+    cube = buildSummaryCube("Runoff")
+
+    for key in ["DistrictIds", "Provinces"]:
+        assert np.array_equal(state["Cube"][key], cube[key])
+
+    for key in ["Votes", "DistrictVotes", "Stations", "Population"]:
+        assert np.allclose(state["Cube"][key], cube[key], equal_nan = True)
+
+    assert np.allclose(state["DistrictTurnout"],
+                       getCubeDistrictTurnouts(cube), equal_nan = True)
+    assert np.array_equal(state["Provinces"], np.unique(cube["Provinces"]))
+
+    for i, provinceName in enumerate(state["Provinces"]):
+        province = rollUp(cube, provinces = [provinceName])
+        assert np.isclose(state["ProvinceTurnout"][i], province["Turnout"],
+                          equal_nan = True)
+        assert np.isclose(state["ProvinceGhaniMargin"][i],
+                          province["VoteShares"]["Ghani"] -
+                          province["VoteShares"]["Abdullah"])
+
+    print(str(len(popDirtyFigures(state))) + " figures need re-rendering")
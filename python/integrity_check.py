@@ -0,0 +1,402 @@
+# Description: A validation stage for the polling station vote files.
+# Nothing else checks that the rows of these files are consistent, and a
+# malformed value crashes the int() calls in e.g. turnout_convert.py. Each
+# file is parsed once into a (rows, columns) array of strings, and every
+# check is then a whole-column array operation:
+#
+#       * MalformedValue - A vote count, PC_number or PS_number that isn't
+#         an integer (or is missing).
+#       * NegativeCount - A negative vote count.
+#       * TotalMismatch - A "Total" that isn't the sum of the candidates'
+#         votes (11 candidates in the first round, Abdullah + Ghani in the
+#         runoff).
+#       * OverCapacity - A "Total" above STATION_CAPACITY.
+#       * DuplicateStation - A (PC_number, PS_number) key that appears in
+#         an earlier row.
+#
+# The violations are collected in a structured array (VIOLATION_DTYPE),
+# with one record per violation, and written to a CSV report.
+#
+# Command-line arguments (optional): the elections to check (FirstRound
+# and/or Runoff). By default, both are checked.
+#
+# Inputs:
+#       * ../raw_data/raw_votes_first_round.csv
+#       * ../raw_data/raw_votes_runoff.csv
+#
+# Outputs:
+#       * ../analysis_output/integrity_<election>.csv - The violations
+#         found in each file.
+#       * stdout - The number of violations of each type, and how long each
+#         check took.
+#
+
+
+import os
+import sys
+import csv
+import time
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import openCsvFile
+
+
+# Constants
+
+# VALUES
+from afghan_constants import STATION_CAPACITY
+
+# The checks, in the order they are run. A violation's "Check" field is the
+# index of its check in this list.
+VIOLATION_TYPES = ["MalformedValue", "NegativeCount", "TotalMismatch",
+                   "OverCapacity", "DuplicateStation"]
+
+# The layout of one violation. "Row" is the row number in the file (the
+# header is row 1), and "Column" is the index of the offending column (-1
+# if the violation is about the whole row). "Value" and "Expected" depend
+# on the check:
+#
+#       * MalformedValue - 0 and 0 (the text is in the CSV report).
+#       * NegativeCount - The count, and 0.
+#       * TotalMismatch - The "Total", and the sum of the candidates' votes.
+#       * OverCapacity - The "Total", and STATION_CAPACITY.
+#       * DuplicateStation - The PS_number, and the row number of the first
+#         row with the same key.
+VIOLATION_DTYPE = np.dtype([("Check", np.int8), ("Row", np.int64),
+                            ("Column", np.int16), ("PCNumber", np.int64),
+                            ("PSNumber", np.int64), ("Value", np.int64),
+                            ("Expected", np.int64)])
+
+# The columns that identify a polling station, and the column with its
+# total votes. All of the other columns (apart from the province and
+# district names) are candidates.
+KEY_COLUMNS = ["PC_number", "PS_number"]
+NAME_COLUMNS = ["province", "district"]
+TOTAL_COLUMN = "Total"
+
+# The most digits that an integer field can have (so that it fits in an
+# int64).
+MAX_DIGITS = 18
+POWERS_OF_TEN = 10 ** np.arange(MAX_DIGITS + 1, dtype = np.int64)
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+OUTPUT_DIR = "../analysis_output/"
+
+# INPUT FILES
+
+# The polling station vote file of each election.
+VOTE_FILES = {
+    "FirstRound": RAW_DATA_DIR + "raw_votes_first_round.csv",
+    "Runoff": RAW_DATA_DIR + "raw_votes_runoff.csv",
+}
+
+# OUTPUT FILES
+
+# The violation report of each election is saved to this file, with the
+# election's name in place of "%s".
+REPORT_FILE = OUTPUT_DIR + "integrity_%s.csv"
+
+
+# This function reads a CSV file into its header, a (rows, columns) array
+# of its fields, and the row number of each row in the file (the
+# header is row 1). Short rows are padded with empty fields, and blank rows
+# are skipped.
+#
+def readFieldArray(fileName):
+    with openCsvFile(fileName) as csvFile:
+        rows = list(csv.reader(csvFile))
+
+    header = [name.strip() for name in rows[0]]
+    numColumns = len(header)
+    rowNumbers = np.array([i + 1 for i in range(1, len(rows))
+                           if "".join(rows[i]).strip()], dtype = np.int64)
+    fields = np.array([(rows[i - 1] + [""] * numColumns)[:numColumns]
+                       for i in rowNumbers], dtype = str)
+
+    return header, fields.reshape(-1, numColumns), rowNumbers
+
+
+# This function parses an array of integer strings (e.g. "12", " -3"). It
+# returns the values (0 where a string isn't an integer), and a boolean
+# array that is True where it is. The strings are parsed as a (strings,
+# characters) array of bytes, with whole-array operations: a string is an
+# integer if its only characters are one run of (at most MAX_DIGITS)
+# digits, an optional minus sign just before them, and spaces.
+#
+def parseIntegers(fields):
+    fields = np.asarray(fields)
+    values = np.zeros(fields.shape, dtype = np.int64)
+    isValid = np.zeros(fields.shape, dtype = bool)
+
+    # Parse one column at a time, to keep the character arrays small.
+    for j in range(fields.shape[1]):
+        try:
+            column = fields[:, j].astype(bytes)
+        except UnicodeEncodeError:
+            column = np.char.encode(fields[:, j], "utf-8")
+
+        if column.dtype.itemsize == 0:
+            column = column.astype("S1")
+
+        # Drop the padding that all of the strings have (the fields of every
+        # column are as wide as the widest field in the file).
+        chars = np.frombuffer(column.tobytes(), dtype = np.uint8)\
+                .reshape(len(column), column.dtype.itemsize)
+        usedPositions = np.flatnonzero(chars.any(axis = 0))
+        width = usedPositions[-1] + 1 if len(usedPositions) > 0 else 1
+        chars = chars[:, :width]
+
+        isDigit = (chars >= ord("0")) & (chars <= ord("9"))
+        isMinus = chars == ord("-")
+        isOther = ~(isDigit | isMinus | (chars == ord(" ")) | (chars == 0))
+
+        numDigits = isDigit.sum(axis = 1)
+        firstDigit = np.argmax(isDigit, axis = 1)
+        lastDigit = width - 1 - np.argmax(isDigit[:, ::-1], axis = 1)
+        isNegative = isMinus.any(axis = 1)
+        minusBeforeDigits = chars[np.arange(len(column)),
+                                  np.maximum(firstDigit - 1, 0)] == ord("-")
+
+        isValid[:, j] = (numDigits > 0) & (numDigits <= MAX_DIGITS) & \
+                (lastDigit - firstDigit + 1 == numDigits) & \
+                ~isOther.any(axis = 1) & \
+                ((isMinus.sum(axis = 1) == 0) |
+                 ((isMinus.sum(axis = 1) == 1) & (firstDigit > 0) &
+                  minusBeforeDigits))
+
+        # Each digit is multiplied by 10 to the power of its distance from
+        # the last digit.
+        exponents = np.clip(lastDigit[:, None] - np.arange(width), 0,
+                            MAX_DIGITS)
+        digits = np.where(isDigit, chars.astype(np.int64) - ord("0"), 0)
+        magnitudes = (digits * POWERS_OF_TEN[exponents]).sum(axis = 1)
+
+        values[:, j] = np.where(isValid[:, j],
+                                np.where(isNegative, -magnitudes,
+                                         magnitudes), 0)
+
+    return values, isValid
+
+
+# This function returns the structured array of a check's violations, in
+# the given rows of a parsed vote file. The other arguments are arrays with
+# one element per violation (or scalars).
+#
+def makeViolations(check, table, rows, columns, values, expected):
+    violations = np.zeros(len(rows), dtype = VIOLATION_DTYPE)
+    violations["Check"] = VIOLATION_TYPES.index(check)
+    violations["Row"] = table["RowNumbers"][rows]
+    violations["Column"] = columns
+    violations["PCNumber"] = table["PCNumbers"][rows]
+    violations["PSNumber"] = table["PSNumbers"][rows]
+    violations["Value"] = values
+    violations["Expected"] = expected
+
+    return violations
+
+
+# The checks. Each takes a parsed vote file (see parseVoteFile()), and
+# returns a structured array of its violations.
+
+# This function finds the values that aren't integers.
+#
+def checkMalformedValues(table):
+    rows, columns = np.nonzero(~table["IsValid"])
+
+    return makeViolations("MalformedValue", table, rows,
+                          table["IntegerColumns"][columns], 0, 0)
+
+
+# This function finds the negative vote counts.
+#
+def checkNegativeCounts(table):
+    counts = table["Counts"]
+    rows, columns = np.nonzero(counts < 0)
+
+    return makeViolations("NegativeCount", table, rows,
+                          table["CountColumns"][columns],
+                          counts[rows, columns], 0)
+
+
+# This function finds the totals that aren't the sum of the candidates'
+# votes (in rows where all of the counts are valid).
+#
+def checkTotals(table):
+    sums = table["Counts"][:, :-1].sum(axis = 1)
+    totals = table["Counts"][:, -1]
+    rows = np.nonzero((sums != totals) & table["CountsValid"])[0]
+
+    return makeViolations("TotalMismatch", table, rows,
+                          table["CountColumns"][-1], totals[rows],
+                          sums[rows])
+
+
+# This function finds the totals above STATION_CAPACITY.
+#
+def checkCapacity(table):
+    totals = table["Counts"][:, -1]
+    rows = np.nonzero(totals > STATION_CAPACITY)[0]
+
+    return makeViolations("OverCapacity", table, rows,
+                          table["CountColumns"][-1], totals[rows],
+                          STATION_CAPACITY)
+
+
+# This function finds the rows whose (PC_number, PS_number) key appeared in
+# an earlier row (in rows where the key is valid).
+#
+def checkDuplicateStations(table):
+    keyRows = np.nonzero(table["KeysValid"])[0]
+    pcNumbers = table["PCNumbers"][keyRows]
+    psNumbers = table["PSNumbers"][keyRows]
+
+    # Combine the two keys into one integer, and sort it stably (so rows
+    # with equal keys stay in file order, and the first of each run of
+    # equal keys is its first occurrence).
+    if len(keyRows) > 0:
+        psRange = psNumbers.max() - psNumbers.min() + 1
+        keys = (pcNumbers - pcNumbers.min()) * psRange + \
+                (psNumbers - psNumbers.min())
+    else:
+        keys = pcNumbers
+
+    order = np.argsort(keys, kind = 'mergesort')
+    sortedKeys = keys[order]
+    isRepeat = np.zeros(len(order), dtype = bool)
+    isRepeat[1:] = sortedKeys[1:] == sortedKeys[:-1]
+
+    runStarts = np.maximum.accumulate(np.where(isRepeat, 0,
+                                               np.arange(len(order))))
+    rows = keyRows[order][isRepeat]
+    firstRows = keyRows[order][runStarts][isRepeat]
+
+    return makeViolations("DuplicateStation", table, rows, -1,
+                          table["PSNumbers"][rows],
+                          table["RowNumbers"][firstRows])
+
+
+# The check functions, by violation type.
+CHECKS = {
+    "MalformedValue": checkMalformedValues,
+    "NegativeCount": checkNegativeCounts,
+    "TotalMismatch": checkTotals,
+    "OverCapacity": checkCapacity,
+    "DuplicateStation": checkDuplicateStations,
+}
+
+
+# This function parses a vote file into the dictionary of arrays that the
+# checks use:
+#
+#       * "Header", "Fields" and "RowNumbers" - See readFieldArray().
+#       * "IntegerColumns" - The indices of the key and count columns, and
+#         "IsValid", a (rows, columns) array that is True where they're
+#         integers.
+#       * "PCNumbers" and "PSNumbers" - The keys (0 if malformed), and
+#         "KeysValid", which is True in rows where both are valid.
+#       * "CountColumns" - The indices of the candidate columns and (last)
+#         the "Total" column, and "Counts", a (rows, columns) array of their
+#         values (0 if malformed). "CountsValid" is True in rows where all
+#         of them are valid.
+#
+def parseVoteFile(fileName):
+    header, fields, rowNumbers = readFieldArray(fileName)
+    lowerHeader = [name.lower() for name in header]
+
+    keyColumns = [header.index(name) for name in KEY_COLUMNS]
+    totalColumn = header.index(TOTAL_COLUMN)
+    candidateColumns = [i for i in range(len(header)) if i not in
+                        keyColumns and i != totalColumn and
+                        lowerHeader[i] not in NAME_COLUMNS]
+    countColumns = candidateColumns + [totalColumn]
+    integerColumns = np.array(keyColumns + countColumns)
+
+    values, isValid = parseIntegers(fields[:, integerColumns])
+    numKeys = len(keyColumns)
+
+    return {
+        "Header": header,
+        "Fields": fields,
+        "RowNumbers": rowNumbers,
+        "IntegerColumns": integerColumns,
+        "IsValid": isValid,
+        "PCNumbers": values[:, 0],
+        "PSNumbers": values[:, 1],
+        "KeysValid": isValid[:, :numKeys].all(axis = 1),
+        "CountColumns": np.array(countColumns),
+        "Counts": values[:, numKeys:],
+        "CountsValid": isValid[:, numKeys:].all(axis = 1),
+    }
+
+
+# This function runs every check on a parsed vote file. It returns the
+# violations (sorted by row, then check), and a dictionary that maps each
+# check to the time (in ms) that it took.
+#
+def runChecks(table):
+    violations = list()
+    checkTimes = dict()
+
+    for check in VIOLATION_TYPES:
+        startTime = time.time()
+        violations.append(CHECKS[check](table))
+        checkTimes[check] = 1000.0 * (time.time() - startTime)
+
+    violations = np.concatenate(violations)
+    violations = violations[np.lexsort((violations["Check"],
+                                        violations["Row"]))]
+
+    return violations, checkTimes
+
+
+# This function writes a violation report: one CSV row per violation, with
+# the check's and column's names, and the offending text.
+#
+def writeReport(table, violations, outputFile):
+    header = table["Header"]
+    fields = table["Fields"]
+
+    with open(outputFile, 'w') as reportFile:
+        reportWriter = csv.writer(reportFile)
+        reportWriter.writerow(["Check", "Row", "Column", "PC_number",
+                               "PS_number", "Text", "Value", "Expected"])
+
+        for violation in violations:
+            row = np.searchsorted(table["RowNumbers"], violation["Row"])
+            column = violation["Column"]
+
+            reportWriter.writerow([VIOLATION_TYPES[violation["Check"]],
+                    violation["Row"], header[column] if column >= 0 else "",
+                    fields[row, header.index(KEY_COLUMNS[0])],
+                    fields[row, header.index(KEY_COLUMNS[1])],
+                    fields[row, column] if column >= 0 else "",
+                    violation["Value"], violation["Expected"]])
+
+
+# Main code
+if __name__ == "__main__":
+    elections = sys.argv[1:] if len(sys.argv) > 1 else sorted(VOTE_FILES)
+
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    for election in elections:
+        startTime = time.time()
+        table = parseVoteFile(VOTE_FILES[election])
+        parseTime = 1000.0 * (time.time() - startTime)
+
+        violations, checkTimes = runChecks(table)
+        outputFile = REPORT_FILE % election
+        writeReport(table, violations, outputFile)
+
+        print(election + ": " + str(len(table["Fields"])) + " rows (parsed" +\
+              " in " + ("%.1f" % parseTime) + " ms), " +\
+              str(len(violations)) + " violations saved to " + outputFile)
+
+        for check in VIOLATION_TYPES:
+            numViolations = np.sum(violations["Check"] ==
+                                   VIOLATION_TYPES.index(check))
+            print("    " + check.ljust(18) + str(numViolations).rjust(7) +\
+                  ("%.2f" % checkTimes[check]).rjust(10) + " ms")
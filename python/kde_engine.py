@@ -0,0 +1,278 @@
+# Description: A kernel density estimation (KDE) engine, for distributions
+# whose fixed-bin histograms change shape with the bin count (e.g. the
+# turnout and vote share distributions). It works like histogram_engine.py:
+# a KDE is described by a spec, a (name, values, weights, low, high,
+# bandwidth) tuple, and computeKdes() estimates the densities of every spec
+# at once. Each density is evaluated at NUM_GRID_POINTS equally spaced
+# points over [low, high] (values outside the range or that aren't finite
+# are left out):
+#
+#       1. The (weighted) values are linearly binned onto the grid points,
+#          with one np.bincount over all of the specs.
+#       2. Each spec's Gaussian kernel is sampled at the grid spacing, and
+#          convolved with its binned values by FFT (zero-padded, so that
+#          nothing wraps around). All of the specs are transformed together
+#          as the rows of one array.
+#
+# This takes O(n + m log m) time per spec, for n values and m grid points.
+# "weights" may be None (every value counts once), or one weight per value
+# (e.g. the population of each district). "bandwidth" is either a number
+# (in the units of the values), or the name of a rule in BANDWIDTH_RULES.
+#
+# The result is a dictionary of arrays (one density per row) that can be
+# saved to and loaded from an .npz file, and getDensity() returns the grid
+# and density of one spec. Saved KDEs also hold the parameters they were
+# computed with (see getKdeParameters()), so getCachedKdes() recomputes
+# them when those change, and not just when their input files do.
+#
+
+
+import os
+import json
+import numpy as np
+
+
+# Constants
+
+# The number of grid points that each density is evaluated at.
+NUM_GRID_POINTS = 512
+
+# The bandwidth rules, which pick a bandwidth from the (weighted) spread of
+# the values and their effective number, nEff = (sum of weights)^2 / (sum
+# of squared weights):
+#
+#       * "silverman" - 0.9 * min(std, IQR / 1.349) * nEff^(-1/5)
+#       * "scott" - 1.06 * std * nEff^(-1/5)
+BANDWIDTH_RULES = ["silverman", "scott"]
+
+# The interquartile range of a standard normal distribution.
+NORMAL_IQR = 1.349
+
+
+# This function returns the (weighted) quantile q of each row of a binned
+# grid, interpolating linearly between grid points.
+#
+def getGridQuantiles(binned, gridPoints, q):
+    cumulative = np.cumsum(binned, axis = 1)
+    totals = cumulative[:, -1:]
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        cumulative = cumulative / totals
+
+    quantiles = np.zeros(len(binned))
+
+    for i in range(len(binned)):
+        if totals[i, 0] > 0:
+            quantiles[i] = np.interp(q, cumulative[i], gridPoints[i])
+
+    return quantiles
+
+
+# This function returns the bandwidth of each spec, given the specs'
+# bandwidth arguments, the sums of their weights, weighted values, squared
+# weighted values and squared weights, and their binned grids (for the
+# interquartile ranges). If the rule gives no usable bandwidth (e.g. all
+# of the values are the same), one grid spacing is used.
+#
+def getBandwidths(bandwidths, sumWeights, sumValues, sumSquares,
+                  sumSquaredWeights, binned, gridPoints, spacings):
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = sumValues / sumWeights
+        stds = np.sqrt(np.maximum(sumSquares / sumWeights - means**2, 0.0))
+        numEffective = sumWeights**2 / sumSquaredWeights
+
+    iqrs = getGridQuantiles(binned, gridPoints, 0.75) - \
+            getGridQuantiles(binned, gridPoints, 0.25)
+    spreads = np.where(iqrs > 0, np.minimum(stds, iqrs / NORMAL_IQR), stds)
+
+    result = np.zeros(len(bandwidths))
+
+    for i, bandwidth in enumerate(bandwidths):
+        if bandwidth == "silverman":
+            result[i] = 0.9 * spreads[i] * numEffective[i]**-0.2
+        elif bandwidth == "scott":
+            result[i] = 1.06 * stds[i] * numEffective[i]**-0.2
+        elif isinstance(bandwidth, str):
+            raise ValueError("Unknown bandwidth rule " + bandwidth)
+        else:
+            result[i] = bandwidth
+
+    with np.errstate(invalid = 'ignore'):
+        unusable = ~(np.isfinite(result) & (result > 0))
+
+    result[unusable] = spacings[unusable]
+
+    return result
+
+
+# This function estimates the density of every spec in one pass. It
+# returns a dictionary with the "Names", "Lows", "Highs", "Bandwidths" and
+# "TotalWeights" of the specs, and "Densities", a (specs, NUM_GRID_POINTS)
+# array of their densities (each integrates to about 1 over all of the
+# real line, so mass near the ends of [low, high] spills past the grid).
+#
+def computeKdes(specs, numGridPoints = NUM_GRID_POINTS):
+    names = [spec[0] for spec in specs]
+    valueArrays = [np.asarray(spec[1], dtype = float).ravel()
+                   for spec in specs]
+    weightArrays = [np.ones(len(values)) if spec[2] is None else
+                    np.asarray(spec[2], dtype = float).ravel()
+                    for spec, values in zip(specs, valueArrays)]
+    lows = np.array([spec[3] for spec in specs], dtype = float)
+    highs = np.array([spec[4] for spec in specs], dtype = float)
+    numSpecs = len(specs)
+
+    if len(set(names)) != len(names):
+        raise ValueError("KDE names must be unique")
+
+    if any(len(values) != len(weights) for values, weights in
+           zip(valueArrays, weightArrays)):
+        raise ValueError("Each KDE needs one weight per value")
+
+    spacings = (highs - lows) / (numGridPoints - 1)
+    gridPoints = lows[:, None] + spacings[:, None] * np.arange(numGridPoints)
+
+    # Give every value its spec's index, so that all of the values can be
+    # binned together.
+    lengths = [len(values) for values in valueArrays]
+    specIndices = np.repeat(np.arange(numSpecs), lengths)
+    values = np.concatenate(valueArrays) if specs else np.zeros(0)
+    weights = np.concatenate(weightArrays) if specs else np.zeros(0)
+
+    with np.errstate(invalid = 'ignore'):
+        inRange = np.isfinite(values) & np.isfinite(weights) & \
+                (values >= lows[specIndices]) & \
+                (values <= highs[specIndices])
+
+    values = values[inRange]
+    weights = weights[inRange]
+    specIndices = specIndices[inRange]
+
+    # Linear binning: each value's weight is split between the two grid
+    # points around it, in proportion to how close it is to each.
+    positions = (values - lows[specIndices]) / spacings[specIndices]
+    leftPoints = np.clip(np.floor(positions).astype(np.int64), 0,
+                         numGridPoints - 2)
+    fractions = positions - leftPoints
+    flatPoints = specIndices * numGridPoints + leftPoints
+
+    binned = (np.bincount(flatPoints, weights * (1.0 - fractions),
+                          minlength = numSpecs * numGridPoints) +
+              np.bincount(flatPoints + 1, weights * fractions,
+                          minlength = numSpecs * numGridPoints))\
+            .reshape(numSpecs, numGridPoints)
+
+    def sumBySpec(terms):
+        return np.bincount(specIndices, terms, minlength = numSpecs)
+
+    totalWeights = sumBySpec(weights)
+    bandwidths = getBandwidths([spec[5] for spec in specs], totalWeights,
+                               sumBySpec(weights * values),
+                               sumBySpec(weights * values**2),
+                               sumBySpec(weights**2), binned, gridPoints,
+                               spacings)
+
+    # Sample each kernel at every offset (in grid spacings) from -(m - 1)
+    # to m - 1, in circular order, and normalize it so that it sums to 1
+    # (times the spacing), even when the bandwidth is narrow.
+    paddedLength = 2 * numGridPoints
+    offsets = np.arange(paddedLength)
+    offsets = np.minimum(offsets, paddedLength - offsets)
+    kernels = np.exp(-0.5 * (offsets[None, :] * spacings[:, None] /
+                             bandwidths[:, None])**2)
+    kernels /= kernels.sum(axis = 1)[:, None] * spacings[:, None]
+
+    padded = np.zeros((numSpecs, paddedLength))
+    padded[:, :numGridPoints] = binned
+    smoothed = np.fft.irfft(np.fft.rfft(padded, axis = 1) *
+                            np.fft.rfft(kernels, axis = 1),
+                            n = paddedLength, axis = 1)[:, :numGridPoints]
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        densities = np.where(totalWeights[:, None] > 0,
+                             np.maximum(smoothed, 0.0) /
+                             totalWeights[:, None], 0.0)
+
+    kdes = dict()
+    kdes["Names"] = np.array(names)
+    kdes["Lows"] = lows
+    kdes["Highs"] = highs
+    kdes["Bandwidths"] = bandwidths
+    kdes["TotalWeights"] = totalWeights
+    kdes["Densities"] = densities
+
+    return kdes
+
+
+# This function returns the (grid points, density) of the named KDE.
+#
+def getDensity(kdes, name):
+    matches = np.nonzero(kdes["Names"] == name)[0]
+
+    if len(matches) == 0:
+        raise ValueError("No KDE named " + name)
+
+    i = matches[0]
+    numGridPoints = kdes["Densities"].shape[1]
+
+    return np.linspace(kdes["Lows"][i], kdes["Highs"][i], numGridPoints),\
+            kdes["Densities"][i]
+
+
+# This function saves KDEs to an .npz file.
+#
+def saveKdes(kdes, fileName):
+    np.savez(fileName, **kdes)
+
+
+# This function loads KDEs from an .npz file.
+#
+def loadKdes(fileName):
+    kdeFile = np.load(fileName)
+    kdes = dict((key, kdeFile[key]) for key in kdeFile.files)
+    kdeFile.close()
+
+    # Files saved by Python 2 hold byte strings.
+    for key in ["Names", "Parameters"]:
+        if key in kdes and kdes[key].dtype.kind == 'S':
+            kdes[key] = kdes[key].astype(str)
+
+    return kdes
+
+
+# This function returns a string that describes everything about a list of
+# specs except for their values and weights: the number of grid points,
+# and each spec's name, whether it is weighted, its range and its
+# bandwidth (rule).
+#
+def getKdeParameters(specs, numGridPoints = NUM_GRID_POINTS):
+    return json.dumps({"NumGridPoints": numGridPoints,
+                       "Specs": [[str(spec[0]), spec[2] is not None,
+                                  float(spec[3]), float(spec[4]),
+                                  spec[5] if isinstance(spec[5], str)
+                                  else float(spec[5])] for spec in specs]},
+                      sort_keys = True)
+
+
+# This function returns the KDEs saved in fileName if that file is newer
+# than all of the inputFiles, and was computed with the same parameters
+# (see getKdeParameters()) as the specs that getSpecs() (a function that
+# returns the list of specs) returns now. Otherwise, it computes them from
+# those specs and saves them, along with their parameters.
+#
+def getCachedKdes(fileName, inputFiles, getSpecs):
+    specs = getSpecs()
+    parameters = getKdeParameters(specs)
+
+    if os.path.exists(fileName) and all(os.path.getmtime(fileName) >=
+            os.path.getmtime(inputFile) for inputFile in inputFiles):
+        kdes = loadKdes(fileName)
+
+        if "Parameters" in kdes and str(kdes["Parameters"]) == parameters:
+            return kdes
+
+    kdes = computeKdes(specs)
+    kdes["Parameters"] = np.array(parameters)
+    saveKdes(kdes, fileName)
+
+    return kdes
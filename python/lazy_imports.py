@@ -0,0 +1,57 @@
+# Description: Lazy stand-ins for heavy modules. Importing
+# matplotlib.pyplot and scipy.stats takes far longer than anything else an
+# analysis script does at import time, and it was paid even by callers that
+# only want a CSV output or one of the getter functions. Scripts now write
+#
+#       plt = lazyImport("matplotlib.pyplot")
+#       linregress = lazyFunction("scipy.stats", "linregress")
+#
+# instead of importing them at the top, and the real import happens the
+# first time a plot or fit is actually made.
+#
+
+
+import importlib
+
+
+# A module that is imported on first attribute access.
+#
+class LazyModule(object):
+    def __init__(self, moduleName):
+        self.__dict__["moduleName"] = moduleName
+        self.__dict__["module"] = None
+
+    def getModule(self):
+        if self.module == None:
+            self.__dict__["module"] = importlib.import_module(self.moduleName)
+
+        return self.module
+
+    def __getattr__(self, name):
+        return getattr(self.getModule(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.getModule(), name, value)
+
+    def __repr__(self):
+        return "<lazy module " + repr(self.moduleName) + ">"
+
+
+# This function returns a LazyModule for the given module name.
+#
+def lazyImport(moduleName):
+    return LazyModule(moduleName)
+
+
+# This function returns a function that imports moduleName the first time
+# it's called, and then calls moduleName.functionName.
+#
+def lazyFunction(moduleName, functionName):
+    module = LazyModule(moduleName)
+
+    def callFunction(*args, **kwargs):
+        return getattr(module, functionName)(*args, **kwargs)
+
+    callFunction.__name__ = functionName
+
+    return callFunction
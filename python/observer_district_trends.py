@@ -0,0 +1,321 @@
+# Description: This script is the district-level counterpart of
+# observer_turnout_trends.py. Instead of summing observers into
+# province-level dicts, it joins both observer deployment files to the
+# polling-station vote files on the IEC district ID (the leading digits of
+# each station's PC_number), so every quantity below is an array with one
+# entry per district. This lets us look at observer deployment density,
+# the breakdown by observer group (FEFA, TEFA, ANPO, AYNSO and NLO), and
+# a regression of the change in turnout on the change in observer density.
+#
+# Inputs:
+#       * ../raw_data/raw_observers_first_round.csv
+#       * ../raw_data/raw_observers_runoff.csv
+#       * ../raw_data/raw_votes_runoff.csv
+#       * ../clean_data/first_round_votes.csv
+#       * ../clean_data/runoff_votes_and_turnout.csv
+#
+# Outputs:
+#       * ../figures/observer_dep_and_turnout/district_turnout_change_vs_
+#         obs_dep_change.png - A scatterplot of the change in turnout in
+#         each district vs the change in its observer deployment density,
+#         including the least-squares fit.
+#       * ../clean_data/district_observers.csv - A CSV file with one row
+#         per district, containing its turnouts, observer densities and
+#         runoff observer counts by group.
+#
+# Notes:
+#       * The first-round file only has counts for TEFA, ANPO and AYNSO
+#         (its all_observers column is their sum). FEFA is only recorded as
+#         a presence flag (hasfefa), and NLO was not deployed, so both of
+#         these groups have zero first-round counts below.
+#       * A few first-round rows have non-numeric IEC IDs (e.g. "30XX");
+#         these can't be joined to anything, so they are skipped.
+#
+
+
+import csv
+import numpy as np
+from lazy_imports import lazyImport
+
+# Import some convenience functions
+from afghan_functions import getCsvRows, getStationColumns,\
+        populateProvinceDistrictToPop, pcNumbersToDistrictIds, sumByKey,\
+        alignToKeys
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION
+from afghan_functions import POLLING_CENTER_DIGITS
+
+# The observer groups that appear in the runoff observer file, in the order
+# used for the per-group arrays below.
+OBSERVER_GROUPS = ["FEFA", "TEFA", "ANPO", "AYNSO", "NLO"]
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+FIGURE_DIR = "../figures/observer_dep_and_turnout/"
+
+# INPUT FILES
+
+# CSV file for first-round election observer deployment (by district).
+FIRST_ROUND_OBS_DEP_FILE = RAW_DATA_DIR + "raw_observers_first_round.csv"
+
+# CSV file for runoff election observer deployment (by district).
+RUNOFF_OBS_DEP_FILE = RAW_DATA_DIR + "raw_observers_runoff.csv"
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# CSV file for first round votes (by polling station). Its province and
+# district names match the ones used for population data.
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# OUTPUT FILES
+
+# Scatterplot of the district-level turnout change vs the district-level
+# observer deployment density change.
+SCATTER_TURNOUT_CHANGE_OBS_DEP_CHANGE = FIGURE_DIR +\
+        "district_turnout_change_vs_obs_dep_change.png"
+
+# CSV file with the joined district-level observer and turnout data.
+DISTRICT_OBSERVERS_FILE = CLEAN_DATA_DIR + "district_observers.csv"
+
+
+# This function reads a polling station file and returns the sorted IEC
+# district IDs in that file, along with the total votes cast in each of
+# those districts. Stations that aren't assigned to a province are left
+# out (see afghan_functions.getStationColumns()).
+#
+def getDistrictIdToTotalVotes(votesFile, totalColumn = 'Total'):
+    columns = getStationColumns(votesFile)
+
+    return sumByKey(pcNumbersToDistrictIds(columns['PC_number']),
+                    columns[totalColumn])
+
+
+# This function returns the sorted IEC district IDs that appear in
+# FIRST_ROUND_VOTES_FILE, along with an array of the populations of those
+# districts. Districts whose (Province, District) names have no population
+# data get NaN.
+#
+def getDistrictIdToPop():
+    provinceDistrictToPop = populateProvinceDistrictToPop()
+    districtIdToProvinceDistrict = dict()
+
+    for row in getCsvRows(FIRST_ROUND_VOTES_FILE):
+        # Fix the capitalization on province names, just like
+        # turnout_distrib.py does.
+        provinceName = "".join(w.capitalize() for w in \
+                               row['province'].split())
+        provinceName = provinceName.title()
+
+        districtId = int(row['PC_number']) // 10**POLLING_CENTER_DIGITS
+        districtIdToProvinceDistrict[districtId] = \
+                (provinceName, row['district'])
+
+    districtIds = np.array(sorted(districtIdToProvinceDistrict.keys()))
+    districtPops = np.array([provinceDistrictToPop.get(
+            districtIdToProvinceDistrict[districtId], np.nan)
+            for districtId in districtIds], dtype = float)
+
+    return districtIds, districtPops
+
+
+# This function reads the first-round observer file, and returns the
+# sorted IEC district IDs along with an (N, len(OBSERVER_GROUPS)) array of
+# observer counts per group. Rows with non-numeric IDs are skipped.
+#
+def getFirstRoundDistrictObservers():
+    groupColumns = {"TEFA": 'tefa', "ANPO": 'anpo', "AYNSO": 'aynso'}
+    districtIds = list()
+    counts = list()
+
+    for row in getCsvRows(FIRST_ROUND_OBS_DEP_FILE):
+        if not row['iec_id'].isdigit():
+            continue
+
+        districtIds.append(int(row['iec_id']))
+        counts.append([int(row[groupColumns[group]])
+                       if group in groupColumns else 0
+                       for group in OBSERVER_GROUPS])
+
+    return sumByKey(districtIds, counts)
+
+
+# This function reads the runoff observer file, and returns the sorted IEC
+# district IDs along with an (N, len(OBSERVER_GROUPS)) array of observer
+# counts per group. Districts that were split into several rows (and so
+# share an IEC ID) are summed together.
+#
+def getRunoffDistrictObservers():
+    districtIds = list()
+    counts = list()
+
+    for row in getCsvRows(RUNOFF_OBS_DEP_FILE):
+        districtIds.append(int(row['IEC ID']))
+        counts.append([int(row[group + '_obs_count'])
+                       for group in OBSERVER_GROUPS])
+
+    return sumByKey(districtIds, counts)
+
+
+# This function joins all of the district-level data on IEC district IDs,
+# and returns a dictionary of equal-length arrays (one entry per district
+# that has runoff votes). The keys are:
+#
+#       * "DistrictId" - the IEC district IDs (sorted).
+#       * "Population" - the district populations (NaN if unknown).
+#       * "FirstRoundTurnout", "RunoffTurnout" - turnout percentages.
+#       * "FirstRoundObservers", "RunoffObservers" - (N, G) arrays of
+#         observer counts by group, in the order of OBSERVER_GROUPS.
+#       * "FirstRoundObsDensity", "RunoffObsDensity" - total observers per
+#         1000 people.
+#       * "TurnoutChange", "ObsDensityChange" - the percent changes in the
+#         above quantities between the two rounds.
+#
+def getDistrictObserverTable():
+    districtIds, runoffVotes = \
+            getDistrictIdToTotalVotes(RUNOFF_VOTES_POLLING_STATION_FILE)
+    firstRoundIds, firstRoundVotes = \
+            getDistrictIdToTotalVotes(FIRST_ROUND_VOTES_FILE)
+    popIds, pops = getDistrictIdToPop()
+    firstRoundObsIds, firstRoundObs = getFirstRoundDistrictObservers()
+    runoffObsIds, runoffObs = getRunoffDistrictObservers()
+
+    population = alignToKeys(districtIds, popIds, pops)
+    eligible = population * VOTING_FRACTION
+
+    firstRoundObservers = alignToKeys(districtIds, firstRoundObsIds,
+                                      firstRoundObs)
+    runoffObservers = alignToKeys(districtIds, runoffObsIds, runoffObs)
+
+    table = dict()
+    table["DistrictId"] = districtIds
+    table["Population"] = population
+    table["FirstRoundTurnout"] = 100.0 * alignToKeys(districtIds,
+            firstRoundIds, firstRoundVotes) / eligible
+    table["RunoffTurnout"] = 100.0 * runoffVotes / eligible
+    table["FirstRoundObservers"] = firstRoundObservers
+    table["RunoffObservers"] = runoffObservers
+    table["FirstRoundObsDensity"] = 1000.0 * \
+            firstRoundObservers.sum(axis = 1) / population
+    table["RunoffObsDensity"] = 1000.0 * \
+            runoffObservers.sum(axis = 1) / population
+
+    # Percent changes between the two rounds. Districts with no
+    # first-round observers (or votes) get NaN instead of infinity.
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        table["TurnoutChange"] = 100.0 * (table["RunoffTurnout"] - \
+                table["FirstRoundTurnout"]) / table["FirstRoundTurnout"]
+        table["ObsDensityChange"] = 100.0 * \
+                (table["RunoffObsDensity"] - \
+                 table["FirstRoundObsDensity"]) / \
+                table["FirstRoundObsDensity"]
+
+    for key in ("TurnoutChange", "ObsDensityChange"):
+        table[key][~np.isfinite(table[key])] = np.nan
+
+    return table
+
+
+# This function fits turnout change = slope * observer density change +
+# intercept, by least squares over the districts where both values are
+# finite. It returns (slope, intercept, rSquared, numDistricts).
+#
+def fitTurnoutChangeVsObsChange(table):
+    x = table["ObsDensityChange"]
+    y = table["TurnoutChange"]
+    valid = np.isfinite(x) & np.isfinite(y)
+
+    designMatrix = np.column_stack((x[valid], np.ones(valid.sum())))
+    coefficients = np.linalg.lstsq(designMatrix, y[valid], rcond = None)[0]
+
+    residuals = y[valid] - designMatrix.dot(coefficients)
+    totalSumSquares = ((y[valid] - y[valid].mean())**2).sum()
+    rSquared = 1.0 - (residuals**2).sum() / totalSumSquares
+
+    return coefficients[0], coefficients[1], rSquared, int(valid.sum())
+
+
+# This function regresses the runoff turnout on the runoff observer density
+# of each observer group (observers per 1000 people), plus an intercept.
+# It returns a dictionary mapping each group in OBSERVER_GROUPS (and
+# "Intercept") to its coefficient.
+#
+def fitRunoffTurnoutVsGroupDensities(table):
+    groupDensities = 1000.0 * table["RunoffObservers"] / \
+            table["Population"][:, np.newaxis]
+    y = table["RunoffTurnout"]
+    valid = np.isfinite(groupDensities).all(axis = 1) & np.isfinite(y)
+
+    designMatrix = np.column_stack((groupDensities[valid],
+                                    np.ones(valid.sum())))
+    coefficients = np.linalg.lstsq(designMatrix, y[valid], rcond = None)[0]
+
+    groupToCoefficient = dict(zip(OBSERVER_GROUPS, coefficients[:-1]))
+    groupToCoefficient["Intercept"] = coefficients[-1]
+
+    return groupToCoefficient
+
+
+# This function plots the district turnout changes vs the observer
+# deployment density changes in a table from getDistrictObserverTable(),
+# along with the fitted line, and saves the scatterplot to outputFile.
+#
+def plotTurnoutChangeVsObsChange(table, outputFile):
+    slope, intercept, rSquared, numDistricts = \
+            fitTurnoutChangeVsObsChange(table)
+
+    # Plot and save the scatterplot, along with the fitted line.
+    fig = plt.figure()
+    fig.set_facecolor('white')
+
+    x = table["ObsDensityChange"]
+    y = table["TurnoutChange"]
+    valid = np.isfinite(x) & np.isfinite(y)
+    xValuesFitLine = np.linspace(x[valid].min(), x[valid].max(), 50)
+
+    plt.scatter(x[valid], y[valid], s = 20, color = 'k')
+    plt.plot(xValuesFitLine, slope * xValuesFitLine + intercept, 'r',
+             lw = 1.5)
+    plt.xlabel("% Change in Observer Deployment Density")
+    plt.ylabel("% Change in Turnout")
+    plt.title("District Turnout Change vs Obs. Dep. Density Change " +\
+              r"($r^2 = " + str(rSquared)[0:6] + r"$)")
+    plt.savefig(outputFile, bbox_inches = 'tight')
+    plt.close()
+
+    print("Saved scatterplot of district turnout change vs observer " +\
+          "deployment density change (" + str(numDistricts) +\
+          " districts) to\n" + outputFile)
+
+
+# Main code
+if __name__ == "__main__":
+    table = getDistrictObserverTable()
+    plotTurnoutChangeVsObsChange(table, SCATTER_TURNOUT_CHANGE_OBS_DEP_CHANGE)
+
+    # Output the joined district-level table.
+    csvWriter = csv.writer(open(DISTRICT_OBSERVERS_FILE, "w"))
+    csvWriter.writerow(["DistrictId", "Population", "FirstRoundTurnout",
+                        "RunoffTurnout", "FirstRoundObsDensity",
+                        "RunoffObsDensity"] +\
+                       [group + "Runoff" for group in OBSERVER_GROUPS])
+
+    for i in range(len(table["DistrictId"])):
+        csvWriter.writerow([table["DistrictId"][i], table["Population"][i],
+                            table["FirstRoundTurnout"][i],
+                            table["RunoffTurnout"][i],
+                            table["FirstRoundObsDensity"][i],
+                            table["RunoffObsDensity"][i]] +\
+                           list(table["RunoffObservers"][i]))
+
+    print("Saved district-level observer data to\n" +\
+          DISTRICT_OBSERVERS_FILE)
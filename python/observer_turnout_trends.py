@@ -42,10 +42,15 @@
 
 import csv
 import numpy as np
-import matplotlib.pyplot as plt
+from lazy_imports import lazyImport
 
 # Import some convenience functions
 from afghan_functions import *
+from afghan_plotting import *
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
 
 
 # Constants
@@ -94,93 +99,43 @@ SCATTER_TURNOUT_NORM_OBS_DEP = FIGURE_DIR +\
 NUM_TO_PROV_FILE = CLEAN_DATA_DIR + "num_to_province.csv"
 
 
-# Global variables
-
-# Dicts to track province data (cached to avoid regeneration).
-provinceNumToName = None
-provinceNameToPop = None
-
-
-# This function populates a dictionary that maps province numbers to
-# province names. This dictionary is stored in the global variable
-# provinceNumToName.
-#
-# The number for each province is assigned by finding its index in a list
-# of sorted province names. Note that this function uses the data in
-# RUNOFF_TURNOUT_FILE.
-#
-def populateProvinceNumToName():
-    global provinceNumToName
-
-    # If it's already populated, there's nothing to do.
-    if provinceNumToName != None:
-        return
-
-    provinceNumToName = getProvinceNumToName()
-
-    return
-
-
-# This function populates a dictionary that maps province names to their
-# populations. This uses the data in RUNOFF_TURNOUT_FILE. The dictionary is
-# then stored in the global variable provinceNameToPop.
-#
-def populateProvinceNameToPop():
-    global provinceNameToPop
-
-    # If it's already populated, there's nothing to do.
-    if provinceNameToPop != None:
-        return
-
-    provinceNameToPop = getProvinceNameToPop()
-
-    return
-
-
 # This function returns a dictionary that maps province numbers to the
 # percent change in turnout percentage, from the first-round election to
 # the runoff election.
 #
 def getProvinceNumToTurnoutChange():
-    # Make sure provinceNumToName and provinceNameToPop are populated.
-    global provinceNumToName, provinceNameToPop
-    populateProvinceNumToName()
-    populateProvinceNameToPop()
+    # Get the (cached) province names and populations.
+    provinceNumToName = populateProvinceNumToName()
+    provinceNameToPop = populateProvinceNameToPop()
 
     # Get the number of people who voted in each province in the first
     # round.
     provinceNameToNumVotesFirstRound = dict()
 
-    with open(FIRST_ROUND_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['province']
-            numVoted = int(row['turnout_total'])
+    for row in getCsvRows(FIRST_ROUND_TURNOUT_FILE):
+        provinceName = row['province']
+        numVoted = int(row['turnout_total'])
 
-            if provinceName in provinceNameToNumVotesFirstRound:
-                provinceNameToNumVotesFirstRound[provinceName] += \
-                        numVoted
-            else:
-                provinceNameToNumVotesFirstRound[provinceName] = \
-                        numVoted
+        if provinceName in provinceNameToNumVotesFirstRound:
+            provinceNameToNumVotesFirstRound[provinceName] += \
+                    numVoted
+        else:
+            provinceNameToNumVotesFirstRound[provinceName] = \
+                    numVoted
 
     # Do the same thing for the runoff.
     provinceNameToNumVotesRunoff = dict()
 
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceName = row['Province']
+        numVoted = int(row['PopulationVoted'])
 
-        for row in csvReader:
-            provinceName = row['Province']
-            numVoted = int(row['PopulationVoted'])
-
-            if provinceName in provinceNameToNumVotesRunoff:
-                provinceNameToNumVotesRunoff[provinceName] += \
-                        numVoted
-            else:
-                provinceNameToNumVotesRunoff[provinceName] = \
-                        numVoted
+        if provinceName in provinceNameToNumVotesRunoff:
+            provinceNameToNumVotesRunoff[provinceName] += \
+                    numVoted
+        else:
+            provinceNameToNumVotesRunoff[provinceName] = \
+                    numVoted
 
     # Get the turnout in each province by dividing by (its population times
     # VOTING_FRACTION). Note that these are percentages.
@@ -225,46 +180,39 @@ def getProvinceNumToTurnoutChange():
 # correlates with turnout.
 #
 def getProvinceNumToRelObsDensChange():
-    # Make sure provinceNumToName and provinceNameToPop are populated.
-    global provinceNumToName, provinceNameToPop
-    populateProvinceNumToName()
-    populateProvinceNameToPop()
+    # Get the (cached) province names and populations.
+    provinceNumToName = populateProvinceNumToName()
+    provinceNameToPop = populateProvinceNameToPop()
 
     # Get the observer density for the first round.
     provinceNameToObsDensityFirstRound = dict()
 
-    with open(FIRST_ROUND_OBS_DEP_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['prov_name']
-            provincePop = float(provinceNameToPop[provinceName])
-            numObservers = int(row['all_observers'])
+    for row in getCsvRows(FIRST_ROUND_OBS_DEP_FILE):
+        provinceName = row['prov_name']
+        provincePop = float(provinceNameToPop[provinceName])
+        numObservers = int(row['all_observers'])
 
-            if provinceName in provinceNameToObsDensityFirstRound:
-                provinceNameToObsDensityFirstRound[provinceName] += \
-                        numObservers / provincePop
-            else:
-                provinceNameToObsDensityFirstRound[provinceName] = \
-                        numObservers / provincePop
+        if provinceName in provinceNameToObsDensityFirstRound:
+            provinceNameToObsDensityFirstRound[provinceName] += \
+                    numObservers / provincePop
+        else:
+            provinceNameToObsDensityFirstRound[provinceName] = \
+                    numObservers / provincePop
 
     # Do the same thing for the runoff election.
     provinceNameToObsDensityRunoff = dict()
 
-    with open(RUNOFF_OBS_DEP_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+    for row in getCsvRows(RUNOFF_OBS_DEP_FILE):
+        provinceName = row['prov_name']
+        provincePop = float(provinceNameToPop[provinceName])
+        numObservers = int(row['Total_Observers'])
 
-        for row in csvReader:
-            provinceName = row['prov_name']
-            provincePop = float(provinceNameToPop[provinceName])
-            numObservers = int(row['Total_Observers'])
-
-            if provinceName in provinceNameToObsDensityRunoff:
-                provinceNameToObsDensityRunoff[provinceName] += \
-                        numObservers / provincePop
-            else:
-                provinceNameToObsDensityRunoff[provinceName] = \
-                        numObservers / provincePop
+        if provinceName in provinceNameToObsDensityRunoff:
+            provinceNameToObsDensityRunoff[provinceName] += \
+                    numObservers / provincePop
+        else:
+            provinceNameToObsDensityRunoff[provinceName] = \
+                    numObservers / provincePop
 
     # Get the percent change in the observer deployment densities for each
     # province, and create a dictionary that maps from province *numbers*
@@ -289,7 +237,7 @@ def getProvinceNumToRelObsDensChange():
     # the relative changes in each province.
     provinceNumToRelPctChangeObsDens = dict()
     medianPctObsDensChange = np.median(
-            provinceNumToPctChangeObsDens.values())
+            list(provinceNumToPctChangeObsDens.values()))
 
     for provinceNum in provinceNumToPctChangeObsDens:
         provinceNumToRelPctChangeObsDens[provinceNum] = \
@@ -303,27 +251,23 @@ def getProvinceNumToRelObsDensChange():
 # election turnout percentage.
 #
 def getProvinceNumToRunoffTurnout():
-    # Make sure provinceNumToName and provinceNameToPop are populated.
-    global provinceNumToName, provinceNameToPop
-    populateProvinceNumToName()
-    populateProvinceNameToPop()
+    # Get the (cached) province names and populations.
+    provinceNumToName = populateProvinceNumToName()
+    provinceNameToPop = populateProvinceNameToPop()
 
     # Get the number of people who voted in each province in the runoff.
     provinceNameToNumVotesRunoff = dict()
 
-    with open(RUNOFF_TURNOUT_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province']
-            numVoted = int(row['PopulationVoted'])
+    for row in getCsvRows(RUNOFF_TURNOUT_FILE):
+        provinceName = row['Province']
+        numVoted = int(row['PopulationVoted'])
 
-            if provinceName in provinceNameToNumVotesRunoff:
-                provinceNameToNumVotesRunoff[provinceName] += \
-                        numVoted
-            else:
-                provinceNameToNumVotesRunoff[provinceName] = \
-                        numVoted
+        if provinceName in provinceNameToNumVotesRunoff:
+            provinceNameToNumVotesRunoff[provinceName] += \
+                    numVoted
+        else:
+            provinceNameToNumVotesRunoff[provinceName] = \
+                    numVoted
 
     # We want to return a mapping from the province number to the turnout
     # percentage in that province. This can be found by taking the number
@@ -348,36 +292,33 @@ def getProvinceNumToRunoffTurnout():
 # then normalizing all the densities to a [0, 100] range.
 #
 def getProvinceNumToNormalizedRunoffObsDensity():
-    # Make sure provinceNumToName and provinceNameToPop are populated.
-    global provinceNumToName, provinceNameToPop
-    populateProvinceNumToName()
-    populateProvinceNameToPop()
+    # Get the (cached) province names and populations.
+    provinceNumToName = populateProvinceNumToName()
+    provinceNameToPop = populateProvinceNameToPop()
 
     # This is a mapping from province names to the observer deployment in
     # that province, divided by the population of that province.
     provinceNameToObsRunoffDensity = dict()
 
-    with open(RUNOFF_OBS_DEP_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['prov_name']
-            provincePop = float(provinceNameToPop[provinceName])
-            numObservers = int(row['Total_Observers'])
+    for row in getCsvRows(RUNOFF_OBS_DEP_FILE):
+        provinceName = row['prov_name']
+        provincePop = float(provinceNameToPop[provinceName])
+        numObservers = int(row['Total_Observers'])
 
-            if provinceName in provinceNameToObsRunoffDensity:
-                provinceNameToObsRunoffDensity[provinceName] += \
-                        numObservers/provincePop
-            else:
-                provinceNameToObsRunoffDensity[provinceName] = \
-                        numObservers/provincePop
+        if provinceName in provinceNameToObsRunoffDensity:
+            provinceNameToObsRunoffDensity[provinceName] += \
+                    numObservers/provincePop
+        else:
+            provinceNameToObsRunoffDensity[provinceName] = \
+                    numObservers/provincePop
 
     # We want to normalize the above densities to a [0, 100] range, and
     # then we want to return a mapping from the province number to the
     # normalized densities.
     provinceNumToNormalizedRunoffObsDensity = dict()
 
-    allObsDensities = np.array(provinceNameToObsRunoffDensity.values())
+    allObsDensities = np.array(list(
+            provinceNameToObsRunoffDensity.values()))
     minObsDensity = min(allObsDensities)
     relativeMaxObsDensity = max(allObsDensities) - minObsDensity
 
@@ -394,70 +335,6 @@ def getProvinceNumToNormalizedRunoffObsDensity():
     return provinceNumToNormalizedRunoffObsDensity
 
 
-# This function plots the various kinds of bar graphs that this code
-# produces. It takes a dictionary of data, and various plot-related
-# parameters (e.g. axis labels), as well as the output file to which the
-# plot will be saved.
-#
-# Note: It is assumed that a figure has already been created via
-# plt.figure().
-#
-def plotAndSaveBarGraph(dataDict, xLabel, yLabel, plotTitle, outputFile):
-
-    # Unpack the data into x and y (height).
-    keyValuePairs = np.array(dataDict.items())
-    xValues = keyValuePairs[:, 0]
-    heights = keyValuePairs[:, 1]
-
-    plt.bar(xValues, heights, 1.0, color = '#0000FF')
-    plt.xlabel(xLabel)
-    plt.ylabel(yLabel)
-    plt.title(plotTitle)
-
-    # Save plot and inform user.
-    plt.savefig(outputFile, bbox_inches = 'tight')
-
-    print "Saved bar graph to", outputFile
-
-
-# This function plots and saves two bar graphs that have the same x-axis.
-# It also includes a legend. The two bars for each x-value are separated by
-# "width" along the x-axis.
-#
-# Note: It is assumed that a figure has already been created via
-# plt.figure(). The figure and axes are passed in as arguments.
-#
-def plotAndSaveCombinedBarGraphs(fig, ax, firstDict, secondDict, width,
-        xLabel, yLabel, legendLabel1, legendLabel2, plotTitle, outputFile):
-
-    # Unpack the first dictionary to get the common x-values
-    keyValuePairs = np.array(firstDict.items())
-    xValues = keyValuePairs[:, 0]
-    firstBarGraphHeights = list()
-    secondBarGraphHeights = list()
-
-    for xVal in xValues:
-        firstBarGraphHeights.append(firstDict[xVal])
-        secondBarGraphHeights.append(secondDict[xVal])
-
-    width = 0.4
-    rects1 = ax.bar(xValues, firstBarGraphHeights, width,
-                    color = '#FFFF00')
-    rects2 = ax.bar(xValues + width, secondBarGraphHeights,
-                    width, color = '#3333FF')
-    ax.set_xlabel(xLabel)
-    ax.set_ylabel(yLabel)
-    ax.set_title(plotTitle)
-
-    ax.legend((rects1[0], rects2[0]), \
-              (legendLabel1, legendLabel2),
-              loc = "upper right",
-              prop = {"size": 10})
-
-    plt.savefig(outputFile, bbox_inches = 'tight')
-    print "Saved combined bar graph to", outputFile
-
-
 # Main code
 if __name__ == "__main__":
     # Get the various dicts we want.
@@ -522,15 +399,15 @@ if __name__ == "__main__":
     plt.title("Runoff Turnout vs. Normalized Obs. Dep. Density")
     plt.savefig(SCATTER_TURNOUT_NORM_OBS_DEP, bbox_inches = 'tight')
 
-    print "Saved scatterplot of runoff turnout vs. normalized observer " +\
-            "deployment density to", SCATTER_TURNOUT_NORM_OBS_DEP
+    print("Saved scatterplot of runoff turnout vs. normalized observer " +\
+          "deployment density to " + SCATTER_TURNOUT_NORM_OBS_DEP)
     plt.close()
 
     # Output province num to province name dictionary
     csvWriter = csv.writer(open(NUM_TO_PROV_FILE, "w"))
     csvWriter.writerow(["ProvinceNum", "ProvinceName"])
 
-    for key, val in provinceNumToName.items():
+    for key, val in populateProvinceNumToName().items():
         csvWriter.writerow([key, val])
 
-    print "Saved province num to name mapping to", NUM_TO_PROV_FILE
+    print("Saved province num to name mapping to " + NUM_TO_PROV_FILE)
@@ -0,0 +1,334 @@
+# Description: Province-sharded map-reduce runs of the polling station
+# analyses. Every one of these analyses decomposes by province (e.g. the
+# province vote share distributions of province_vote_share_hist.py, the
+# province roll-ups of winning_margin_analysis.py, and the province turnout
+# of getProvinceNumToTurnoutRunoff()), so the polling stations of an
+# election are split into one shard per province, and:
+#
+#       1. Map: each shard is summarized on its own, over a process pool.
+#          mapShard() returns its partial results: the votes and station
+#          counts of each of its districts and of the province as a whole,
+#          the last-digit counts of each runoff candidate (as in the
+#          "digits" analysis of afghan_analysis.py), and the counts of its
+#          station turnout and vote share histograms (see
+#          histogram_engine.py; every shard uses the same HISTOGRAM_SPECS
+#          bins).
+#       2. Reduce: reduceShards() merges the partial results into the
+#          national ones. Counts and votes are summed (district totals by
+#          district ID, so a district split over shards is still added up
+#          correctly), and the province totals are stacked into one table.
+#
+# The shards are sent to the workers largest first, so that one big
+# province doesn't finish last.
+#
+# Command-line arguments (optional, in this order): the election
+# ("Runoff", the default, or "FirstRound"), and the number of worker
+# processes (by default, one per CPU).
+#
+# Inputs:
+#       * The inputs of summary_cube.py
+#       * ../clean_data/runoff_votes_and_turnout.csv (for the province
+#         populations)
+#
+# Outputs (with the election in place of <election>):
+#       * ../analysis_output/sharded_<election>_districts.csv - The votes
+#         and stations of each district.
+#       * ../analysis_output/sharded_<election>_provinces.csv - The votes,
+#         stations, turnout, vote shares and Ghani's winning margin in each
+#         province.
+#       * ../analysis_output/sharded_<election>_last_digits.csv - The
+#         national last-digit counts of each runoff candidate.
+#       * ../analysis_output/sharded_<election>_histograms.npz - The
+#         national station turnout and vote share histograms.
+#       * stdout - The chi-squared test of each candidate's last digits.
+#
+
+
+import os
+import sys
+import csv
+import timeit
+import multiprocessing
+import numpy as np
+from lazy_imports import lazyFunction
+
+# Import some convenience functions
+from afghan_functions import getProvinceNameToPop
+from summary_cube import getStationRows
+from histogram_engine import computeHistograms, saveHistograms
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+chi2 = lazyFunction("scipy.stats", "chi2")
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION, STATION_CAPACITY,\
+        MIN_DIGIT_VOTES, MAX_DIGIT_VOTES
+from summary_cube import ELECTIONS, CANDIDATE_COLUMNS
+
+# The (name, low, high, numBins) of each station histogram. Station
+# turnout is total votes / STATION_CAPACITY, and vote shares are fractions.
+HISTOGRAM_SPECS = [
+    ("Turnout", 0.0, 2.0, 100),
+    ("AbdullahShare", 0.0, 1.0, 50),
+    ("GhaniShare", 0.0, 1.0, 50),
+]
+
+# DIRECTORIES
+OUTPUT_DIR = "../analysis_output/"
+
+# OUTPUT FILES
+
+# The national results are saved to these files, with the election in
+# place of "%s".
+DISTRICTS_FILE = OUTPUT_DIR + "sharded_%s_districts.csv"
+PROVINCES_FILE = OUTPUT_DIR + "sharded_%s_provinces.csv"
+LAST_DIGITS_FILE = OUTPUT_DIR + "sharded_%s_last_digits.csv"
+HISTOGRAMS_FILE = OUTPUT_DIR + "sharded_%s_histograms.npz"
+
+
+# This function splits an election's polling stations into one shard per
+# province. Each shard is a (province, district IDs, votes) tuple, where
+# votes is the (stations, candidates) array of its stations' votes. The
+# shards are returned largest first.
+#
+def getProvinceShards(election):
+    districtIds, provinces, votes = getStationRows(election)
+    order = np.argsort(provinces, kind = 'mergesort')
+    shardProvinces, starts = np.unique(provinces[order],
+                                       return_index = True)
+    ends = np.append(starts[1:], len(order))
+
+    shards = [(shardProvinces[i], districtIds[order[starts[i]:ends[i]]],
+               votes[order[starts[i]:ends[i]]])
+              for i in range(len(shardProvinces))]
+
+    return sorted(shards, key = lambda shard: -len(shard[2]))
+
+
+# This function returns the last-digit counts of a candidate's votes at the
+# polling stations they won (with between MIN_DIGIT_VOTES and
+# MAX_DIGIT_VOTES votes), as in the "digits" analysis of afghan_analysis.py.
+#
+def getLastDigitCounts(votes, candidateIndex):
+    otherIndices = [index for index in range(votes.shape[1])
+                    if index != candidateIndex]
+    candidateVotes = votes[:, candidateIndex]
+    won = candidateVotes > votes[:, otherIndices].max(axis = 1)
+    used = won & (candidateVotes >= MIN_DIGIT_VOTES) & \
+            (candidateVotes <= MAX_DIGIT_VOTES)
+
+    return np.bincount(candidateVotes[used].astype(int) % 10,
+                       minlength = 10)
+
+
+# This function is the map step. Given a (province, district IDs, votes,
+# candidate indices) task, where the candidate indices map each runoff
+# candidate to their column in votes, it returns the shard's partial
+# results as a dictionary.
+#
+def mapShard(task):
+    province, districtIds, votes, candidateIndices = task
+    totals = votes.sum(axis = 1)
+
+    partial = dict()
+    partial["Province"] = province
+
+    # Aggregation, by district and for the whole province.
+    partial["DistrictIds"], districtIndices = np.unique(districtIds,
+            return_inverse = True)
+    partial["DistrictVotes"] = np.zeros((len(partial["DistrictIds"]),
+                                         votes.shape[1]))
+    np.add.at(partial["DistrictVotes"], districtIndices, votes)
+    partial["DistrictStations"] = np.bincount(districtIndices,
+            minlength = len(partial["DistrictIds"]))
+    partial["ProvinceVotes"] = votes.sum(axis = 0)
+    partial["ProvinceStations"] = len(votes)
+
+    # Last-digit counts.
+    partial["DigitCounts"] = dict((candidate, getLastDigitCounts(votes,
+            candidateIndices[candidate])) for candidate in candidateIndices)
+
+    # Histograms (stations without votes have no vote shares).
+    voted = totals > 0
+    values = {"Turnout": totals / float(STATION_CAPACITY)}
+
+    for candidate in candidateIndices:
+        values[candidate + "Share"] = votes[voted,
+                candidateIndices[candidate]] / totals[voted]
+
+    partial["Histograms"] = computeHistograms([(name, values[name], low,
+            high, numBins) for name, low, high, numBins in HISTOGRAM_SPECS])
+
+    return partial
+
+
+# This function is the reduce step. It merges the partial results of every
+# shard into a dictionary of national results:
+#
+#       * "DistrictIds", "DistrictVotes" and "DistrictStations" - The
+#         summed district totals, sorted by district ID.
+#       * "Provinces", "ProvinceVotes" and "ProvinceStations" - The totals
+#         of each province, sorted by name.
+#       * "DigitCounts" - The summed last-digit counts of each candidate.
+#       * "Histograms" - The merged histograms (with summed counts).
+#
+def reduceShards(partials):
+    results = dict()
+
+    allIds = np.concatenate([partial["DistrictIds"] for partial in partials])
+    results["DistrictIds"], districtIndices = np.unique(allIds,
+            return_inverse = True)
+    results["DistrictVotes"] = np.zeros((len(results["DistrictIds"]),
+            partials[0]["DistrictVotes"].shape[1]))
+    np.add.at(results["DistrictVotes"], districtIndices, np.concatenate(
+            [partial["DistrictVotes"] for partial in partials]))
+    results["DistrictStations"] = np.bincount(districtIndices,
+            np.concatenate([partial["DistrictStations"]
+                            for partial in partials]),
+            minlength = len(results["DistrictIds"])).astype(np.int64)
+
+    partials = sorted(partials, key = lambda partial: partial["Province"])
+    results["Provinces"] = np.array([partial["Province"]
+                                     for partial in partials])
+    results["ProvinceVotes"] = np.array([partial["ProvinceVotes"]
+                                         for partial in partials])
+    results["ProvinceStations"] = np.array([partial["ProvinceStations"]
+                                            for partial in partials])
+
+    results["DigitCounts"] = dict((candidate, sum(partial["DigitCounts"]
+            [candidate] for partial in partials))
+            for candidate in partials[0]["DigitCounts"])
+
+    results["Histograms"] = dict(partials[0]["Histograms"])
+    results["Histograms"]["Counts"] = sum(partial["Histograms"]["Counts"]
+                                          for partial in partials)
+
+    return results
+
+
+# This function runs the map step on every province shard of an election
+# over a pool of numProcesses worker processes (by default, one per CPU),
+# and reduces the partial results to the national ones (see
+# reduceShards()).
+#
+def runShardedAnalyses(election, numProcesses = None):
+    candidates = ELECTIONS[election][1]
+    candidateIndices = dict((candidate, candidates.index(column))
+            for candidate, column in CANDIDATE_COLUMNS[election].items())
+    tasks = [shard + (candidateIndices,)
+             for shard in getProvinceShards(election)]
+
+    if numProcesses == None:
+        numProcesses = multiprocessing.cpu_count()
+
+    if numProcesses <= 1 or len(tasks) <= 1:
+        partials = [mapShard(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(numProcesses)
+
+        try:
+            partials = pool.map(mapShard, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return reduceShards(partials)
+
+
+# This function writes the national results of an election to the output
+# files, and returns their paths.
+#
+def writeResults(election, results):
+    candidates = ELECTIONS[election][1]
+    candidateIndices = dict((candidate, candidates.index(column))
+            for candidate, column in CANDIDATE_COLUMNS[election].items())
+    outputFiles = [fileName % election for fileName in
+                   [DISTRICTS_FILE, PROVINCES_FILE, LAST_DIGITS_FILE,
+                    HISTOGRAMS_FILE]]
+
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    with open(outputFiles[0], "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["DistrictId", "Stations", "TotalVotes"] +
+                           candidates)
+
+        for i, districtId in enumerate(results["DistrictIds"]):
+            csvWriter.writerow([districtId, results["DistrictStations"][i],
+                                results["DistrictVotes"][i].sum()] +
+                               results["DistrictVotes"][i].tolist())
+
+    provinceNameToPop = getProvinceNameToPop()
+
+    with open(outputFiles[1], "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["Province", "Stations", "TotalVotes",
+                            "TurnoutPercent", "AbdullahShare", "GhaniShare",
+                            "GhaniWinningMargin"])
+
+        for i, province in enumerate(results["Provinces"]):
+            votes = results["ProvinceVotes"][i]
+            totalVotes = votes.sum()
+            population = provinceNameToPop.get(province, np.nan)
+            shares = dict((candidate, 100.0 * votes[index] / totalVotes
+                           if totalVotes > 0 else np.nan)
+                          for candidate, index in candidateIndices.items())
+
+            csvWriter.writerow([province, results["ProvinceStations"][i],
+                                totalVotes, 100.0 * totalVotes /
+                                (population * VOTING_FRACTION),
+                                shares["Abdullah"], shares["Ghani"],
+                                shares["Ghani"] - shares["Abdullah"]])
+
+    with open(outputFiles[2], "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["Candidate", "Digit", "Count", "Expected"])
+
+        for candidate in sorted(results["DigitCounts"]):
+            digitCounts = results["DigitCounts"][candidate]
+
+            for digit in range(10):
+                csvWriter.writerow([candidate, digit, digitCounts[digit],
+                                    digitCounts.sum() / 10.0])
+
+    saveHistograms(results["Histograms"], outputFiles[3])
+
+    return outputFiles
+
+
+# Main code
+if __name__ == "__main__":
+    election = sys.argv[1] if len(sys.argv) > 1 else "Runoff"
+    numProcesses = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    if election not in ELECTIONS:
+        print("usage: " + sys.argv[0] + " [Runoff|FirstRound] " +
+              "[numProcesses]")
+        sys.exit(1)
+
+    # Read the stations before timing, so that only the analyses count.
+    getStationRows(election)
+
+    startTime = timeit.default_timer()
+    results = runShardedAnalyses(election, numProcesses)
+    seconds = timeit.default_timer() - startTime
+
+    print("Reduced " + str(len(results["Provinces"])) + " province " +
+          "shards (" + str(int(results["ProvinceStations"].sum())) +
+          " stations) in " + str(seconds) + " s")
+
+    for candidate in sorted(results["DigitCounts"]):
+        digitCounts = results["DigitCounts"][candidate]
+        expected = digitCounts.sum() / 10.0
+        chiSquared = ((digitCounts - expected) ** 2 / expected).sum()
+
+        print(candidate + " last digits: chi-squared " + str(chiSquared) +
+              ", p-value " + str(chi2(9).sf(chiSquared)))
+
+    for outputFile in writeResults(election, results):
+        print("Saved " + outputFile)
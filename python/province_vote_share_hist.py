@@ -9,8 +9,14 @@
 #       * Candidate's last name ("Ghani" or "Abdullah")
 #       * Province name (must match the data).
 #
+# The vote share histograms and densities of every province, for both
+# candidates and both elections, are computed together in one pass (see
+# histogram_engine.py and kde_engine.py) and saved, so later runs only have
+# to render.
+#
 # Inputs:
 #       * ../raw_data/raw_votes_runoff.csv
+#       * ../clean_data/first_round_votes.csv
 #
 # Outputs:
 #       * ../figures/province_vote_share/<candidate>_<province>_
@@ -18,21 +24,41 @@
 #         <candidate> in <province>, where both of these fields are
 #         command-line arguments that are *made* lower case (even if the
 #         inputs weren't).
+#       * ../clean_data/province_vote_share_histograms.npz - The binned
+#         counts for every province, candidate and election.
+#       * ../clean_data/province_vote_share_kdes.npz - The kernel density
+#         estimates of the same distributions (see kde_engine.py), which
+#         are drawn over the histogram.
 #
 
 import sys
-import csv
 import numpy as np
-import matplotlib.pyplot as plt
+from lazy_imports import lazyImport
+
+# Import some convenience functions
+from afghan_functions import getCsvRows
+from histogram_engine import getCachedHistograms, getHistogram,\
+        renderHistogram
+from kde_engine import getCachedKdes, getDensity
+from summary_cube import ELECTIONS, getStationRows, normalizeProvinceName
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
 
 
 # Constants
 
 # VALUES
 from afghan_constants import ABDULLAH_COLOR, GHANI_COLOR
+from summary_cube import CANDIDATE_COLUMNS
+
+# The number of vote share bins (over 0% to 100%).
+NUM_BINS = 25
 
 # DIRECTORIES
 RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
 FIGURE_DIR = "../figures/province_vote_share/"
 
 # INPUT FILES
@@ -40,6 +66,16 @@ FIGURE_DIR = "../figures/province_vote_share/"
 # CSV file for runoff votes by polling station.
 RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
 
+# OUTPUT FILES
+
+# The binned counts for every province, candidate and election.
+PROVINCE_VOTE_SHARE_HISTOGRAMS_FILE = CLEAN_DATA_DIR +\
+        "province_vote_share_histograms.npz"
+
+# The vote share densities for every province, candidate and election.
+PROVINCE_VOTE_SHARE_KDES_FILE = CLEAN_DATA_DIR +\
+        "province_vote_share_kdes.npz"
+
 
 # This function gets the vote share (percentage) distribution for a given
 # candidate in a given province. This involves looking at polling station
@@ -63,20 +99,17 @@ def getProvinceVoteShareDistrib(candidate, province):
     # for this candidate in this province.
     candidateVoteSharesForProvince = list()
 
-    with open(RUNOFF_VOTES_POLLING_STATION_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province'].lower()
+    for row in getCsvRows(RUNOFF_VOTES_POLLING_STATION_FILE):
+        provinceName = row['Province'].lower()
 
-            if provinceName != lowercaseProvince:
-                continue
+        if provinceName != lowercaseProvince:
+            continue
 
-            candidateVotes = float(row[candidateColumn])
-            totalVotes = float(row['Total'])
+        candidateVotes = float(row[candidateColumn])
+        totalVotes = float(row['Total'])
 
-            candidateVoteSharesForProvince.append(100.0 *\
-                    candidateVotes/totalVotes)
+        candidateVoteSharesForProvince.append(100.0 *\
+                candidateVotes/totalVotes)
 
     candidateVoteSharesForProvince = \
             np.array(candidateVoteSharesForProvince)
@@ -89,50 +122,124 @@ def getProvinceVoteShareDistrib(candidate, province):
     return candidateVoteSharesForProvince
 
 
-# Main code
-if __name__ == "__main__":
+# This function returns the polling station vote shares of both candidates
+# in every province, for both elections, as a list of (name, vote shares)
+# tuples. Each is named "<election>/<candidate>/<province>",
+# e.g. "Runoff/Ghani/Paktika", where the province name is normalized as in
+# summary_cube.py.
+#
+def getProvinceVoteShares():
+    provinceVoteShares = list()
 
-    # There should be two command-line arguments in addition to the script
-    # name.
-    if len(sys.argv) != 3:
-        print "usage:", sys.argv[0], "candidate_last_name province_name"
-        sys.exit(1)
+    for election in sorted(ELECTIONS):
+        candidates = ELECTIONS[election][1]
+        districtIds, provinces, votes = getStationRows(election)
+        totals = votes.sum(axis = 1)
 
-    candidate = sys.argv[1].strip()
-    provinceName = sys.argv[2]
+        # Sort the stations by province, so each province is one slice.
+        order = np.argsort(provinces, kind = 'mergesort')
+        provinceNames, starts = np.unique(provinces[order],
+                                          return_index = True)
+        ends = np.append(starts[1:], len(order))
 
-    # Check the candidate. We won't check the province's spelling at this
-    # point since that's too hard.
-    if candidate.lower() != "abdullah" and candidate.lower() != "ghani":
-        raise ValueError("The input candidate " + candidate + " was " +\
-                "neither Abdullah nor Ghani!")
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            for candidate, column in sorted(
+                    CANDIDATE_COLUMNS[election].items()):
+                voteShares = 100.0 * votes[order, candidates.index(column)]\
+                        / totals[order]
+
+                for provinceName, start, end in zip(provinceNames, starts,
+                                                    ends):
+                    provinceVoteShares.append((election + "/" + candidate +\
+                            "/" + provinceName, voteShares[start:end]))
+
+    return provinceVoteShares
+
+
+# This function returns the histogram specs (see histogram_engine.py) for
+# the vote share distributions of getProvinceVoteShares().
+#
+def getProvinceVoteShareSpecs():
+    return [(name, voteShares, 0.0, 100.0, NUM_BINS) for name, voteShares
+            in getProvinceVoteShares()]
+
+
+# This function returns the KDE specs (see kde_engine.py) for the vote
+# share distributions of getProvinceVoteShares(), with every station
+# counting once (like the histograms).
+#
+def getProvinceVoteShareKdeSpecs():
+    return [(name, voteShares, None, 0.0, 100.0, "silverman") for name,
+            voteShares in getProvinceVoteShares()]
 
-    # Configure the plot save files and the colors.
+
+# This function plots the histogram of a candidate's polling station vote
+# shares in a province (with the density over it), for the given election,
+# and saves it to plotSaveFile.
+#
+def plotProvinceVoteShareDistrib(candidate, provinceName, plotSaveFile,
+                                 election = "Runoff"):
+    # Configure the plot color.
     plotColor = GHANI_COLOR
 
     if candidate.lower() == "abdullah":
         plotColor = ABDULLAH_COLOR
 
-    plotSaveFile = FIGURE_DIR + candidate.lower() + "_" +\
-            provinceName.lower() + "_distrib.png"
+    # Get the histogram for this candidate.
+    histograms = getCachedHistograms(PROVINCE_VOTE_SHARE_HISTOGRAMS_FILE,
+            [RUNOFF_VOTES_POLLING_STATION_FILE, ELECTIONS["FirstRound"][0]],
+            getProvinceVoteShareSpecs)
+
+    # If there's no histogram, the province name was probably wrong.
+    histogramName = election + "/" + candidate.title() + "/" +\
+            normalizeProvinceName(provinceName)
 
-    # Get the distribution for this candidate.
-    candidateVoteShareDistrib = getProvinceVoteShareDistrib(\
-            candidate, provinceName)
+    if histogramName not in histograms["Names"]:
+        raise ValueError("No provinces matching " + provinceName +\
+                " were found in " + ELECTIONS[election][0])
 
-    # Plot and save the histogram
-    numBins = 25
+    counts, edges = getHistogram(histograms, histogramName)
 
+    # Get the density too, scaled to the histogram's counts.
+    kdes = getCachedKdes(PROVINCE_VOTE_SHARE_KDES_FILE,
+            [RUNOFF_VOTES_POLLING_STATION_FILE, ELECTIONS["FirstRound"][0]],
+            getProvinceVoteShareKdeSpecs)
+    gridPoints, density = getDensity(kdes, histogramName)
+
+    # Plot and save the histogram, with the density over it.
     fig = plt.figure()
     fig.set_facecolor('white')
-    plt.hist(candidateVoteShareDistrib, numBins, histtype = 'bar',
-             range = [0.0, 100.0], color = plotColor)
+    renderHistogram(counts, edges, plotColor)
+    plt.plot(gridPoints, density * counts.sum() * (edges[1] - edges[0]),
+             'k', lw = 1.5)
     plt.xlabel(candidate + "'s Vote Share")
     plt.ylabel("Number of Polling Stations")
     plt.xlim([0.0, 100.0])
     plt.title(candidate + "'s Vote Share Distribution for " + provinceName)
 
     plt.savefig(plotSaveFile, bbox_inches = "tight")
-    print "Saved " + candidate + "'s vote share distribution to\n" +\
-            plotSaveFile
+    print("Saved " + candidate + "'s vote share distribution to\n" +\
+          plotSaveFile)
     plt.close()
+
+
+# Main code
+if __name__ == "__main__":
+
+    # There should be two command-line arguments in addition to the script
+    # name.
+    if len(sys.argv) != 3:
+        print("usage: " + sys.argv[0] + " candidate_last_name province_name")
+        sys.exit(1)
+
+    candidate = sys.argv[1].strip()
+    provinceName = sys.argv[2]
+
+    # Check the candidate. We won't check the province's spelling at this
+    # point since that's too hard.
+    if candidate.lower() != "abdullah" and candidate.lower() != "ghani":
+        raise ValueError("The input candidate " + candidate + " was " +\
+                "neither Abdullah nor Ghani!")
+
+    plotProvinceVoteShareDistrib(candidate, provinceName, FIGURE_DIR +\
+            candidate.lower() + "_" + provinceName.lower() + "_distrib.png")
@@ -0,0 +1,406 @@
+# Description: An asyncio service that ingests polling station results
+# while they are being published, and keeps the runoff turnout and winning
+# margin aggregates up to date (using incremental_results.py). Batches of
+# rows in the raw_votes_runoff.csv schema (with a header line) come from
+# either
+#
+#       * a directory, where each new *.csv file is one batch, or
+#       * an HTTP feed, where GET /batch/<n> returns batch n (n = 0, 1, ...)
+#         and a 404 means batch n hasn't been published yet.
+#
+# The service is a pipeline of asyncio tasks joined by bounded queues:
+#
+#       poller -> raw batches -> validators (one per worker process) ->
+#       valid batches -> aggregator -> published snapshots
+#
+# Validation is pure Python, so it is done in a pool of worker processes
+# (threads would all wait for the GIL), and batches are validated in
+# parallel while the event loop keeps polling. With one process, the
+# batches are validated one at a time in a worker thread instead.
+#
+# Since the queues are bounded, a slow aggregator makes the validators wait
+# to hand off their batches, which in turn makes the poller stop fetching
+# new batches (backpressure), instead of buffering the whole feed in
+# memory.
+#
+# FakeResultsFeed serves batches over HTTP on localhost, so the whole
+# service can be run and tested without any outside network access. The
+# main code replays raw_votes_runoff.csv through it.
+#
+# This module uses asyncio, so (unlike the other scripts) it needs Python 3.
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv (for the main code's fake feed)
+#
+
+
+import os
+import csv
+import asyncio
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+# Import some convenience functions
+from incremental_results import newIncrementalState, ingestStationBatch,\
+        popDirtyFigures
+from afghan_functions import UNASSIGNED_PROVINCE, pcNumbersToDistrictIds
+from summary_cube import normalizeProvinceName
+
+
+# Constants
+
+# VALUES
+from afghan_constants import STATION_CAPACITY
+
+# The columns of the raw_votes_runoff.csv schema.
+RUNOFF_COLUMNS = ["Province", "District", "PC_number", "PS_number",
+                  "Abdullah", "Ghani", "Total"]
+
+# The maximum number of batches waiting in each queue. These bound the
+# memory used when the aggregator falls behind.
+RAW_QUEUE_SIZE = 4
+VALID_QUEUE_SIZE = 2
+
+# How often (in seconds) to poll for new batches when none are available.
+POLL_INTERVAL = 0.5
+
+# The number of rows per batch in the main code's fake feed.
+FAKE_FEED_BATCH_SIZE = 1000
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+
+# INPUT FILES
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+
+# This function validates and normalizes one batch of CSV text in the
+# raw_votes_runoff.csv schema. It returns the (districtIds, provinces,
+# votes) rows for incremental_results.ingestStationBatch(), and a list of
+# (line number, reason) tuples for the rows that were rejected. A row is
+# rejected if it has the wrong number of fields or non-integer counts, if
+# it has negative counts, if Abdullah + Ghani != Total, if Total is more
+# than STATION_CAPACITY, or if the station isn't assigned to a province
+# (so the snapshots cover the same stations as the summary cube).
+#
+def validateBatch(text):
+    csvReader = csv.reader(text.splitlines())
+    header = next(csvReader, None)
+
+    if header != RUNOFF_COLUMNS:
+        return (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = str),
+                np.zeros((0, 2))), [(1, "unexpected header")]
+
+    pcNumbers = list()
+    provinces = list()
+    votes = list()
+    rejected = list()
+
+    for lineNumber, row in enumerate(csvReader, 2):
+        if len(row) != len(RUNOFF_COLUMNS):
+            rejected.append((lineNumber, "wrong number of fields"))
+            continue
+
+        try:
+            pcNumber = int(row[2])
+            abdullah, ghani, total = int(row[4]), int(row[5]), int(row[6])
+        except ValueError:
+            rejected.append((lineNumber, "non-integer count"))
+            continue
+
+        if row[0].strip() == UNASSIGNED_PROVINCE:
+            rejected.append((lineNumber, "unassigned province"))
+        elif min(abdullah, ghani, total) < 0:
+            rejected.append((lineNumber, "negative count"))
+        elif abdullah + ghani != total:
+            rejected.append((lineNumber, "Abdullah + Ghani != Total"))
+        elif total > STATION_CAPACITY:
+            rejected.append((lineNumber, "Total above station capacity"))
+        else:
+            pcNumbers.append(pcNumber)
+            provinces.append(normalizeProvinceName(row[0]))
+            votes.append([abdullah, ghani])
+
+    rows = (pcNumbersToDistrictIds(pcNumbers), np.array(provinces),
+            np.array(votes, dtype = float).reshape(-1, 2))
+
+    return rows, rejected
+
+
+# This function sends a minimal HTTP/1.0 GET request to host:port, and
+# returns (status code, body text).
+#
+async def httpGet(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        writer.write(("GET " + path + " HTTP/1.0\r\nHost: " + host +\
+                      "\r\n\r\n").encode("ascii"))
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, body = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ")[1])
+
+    return status, body.decode("utf-8")
+
+
+# The ingestion service. Call run() to process batches until stop() is
+# called (or until "expectedBatches" batches have been aggregated, if
+# that's given). Published snapshots go to self.snapshots. Batches are
+# validated by numProcesses worker processes (by default, one per CPU).
+#
+class ResultsFeedService(object):
+    def __init__(self, directory = None, host = None, port = None,
+                 expectedBatches = None, numProcesses = None):
+        if (directory == None) == (host == None):
+            raise ValueError("Exactly one of a directory or an HTTP " +\
+                    "host must be given")
+
+        self.directory = directory
+        self.host = host
+        self.port = port
+        self.expectedBatches = expectedBatches
+        self.numProcesses = numProcesses
+
+        if numProcesses == None:
+            self.numProcesses = multiprocessing.cpu_count()
+
+        self.state = newIncrementalState()
+        self.rawBatches = asyncio.Queue(RAW_QUEUE_SIZE)
+        self.validBatches = asyncio.Queue(VALID_QUEUE_SIZE)
+        self.snapshots = asyncio.Queue()
+        self.stopped = asyncio.Event()
+
+        self.numAggregated = 0
+        self.numRows = 0
+        self.rejectedRows = list()
+
+    # Stop polling and shut the pipeline down.
+    def stop(self):
+        self.stopped.set()
+
+    # Poll the directory for *.csv files that haven't been seen yet, in
+    # sorted order.
+    async def pollDirectory(self):
+        seen = set()
+
+        while not self.stopped.is_set():
+            newFiles = sorted(name for name in os.listdir(self.directory)
+                              if name.endswith(".csv") and name not in seen)
+
+            for name in newFiles:
+                with open(os.path.join(self.directory, name)) as batchFile:
+                    text = batchFile.read()
+
+                seen.add(name)
+
+                # This blocks while the pipeline is full (backpressure).
+                await self.rawBatches.put((name, text))
+
+            if not newFiles:
+                await self.sleepUnlessStopped(POLL_INTERVAL)
+
+    # Poll the HTTP feed for the next batch number.
+    async def pollHttpFeed(self):
+        batchNumber = 0
+
+        while not self.stopped.is_set():
+            status, body = await httpGet(self.host, self.port,
+                                         "/batch/" + str(batchNumber))
+
+            if status == 200:
+                await self.rawBatches.put(("batch " + str(batchNumber),
+                                           body))
+                batchNumber += 1
+            elif status == 404:
+                await self.sleepUnlessStopped(POLL_INTERVAL)
+            else:
+                raise IOError("Results feed returned HTTP " + str(status))
+
+    # Validate raw batches in the executor's workers, and pass them on.
+    async def validate(self, executor):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            name, text = await self.rawBatches.get()
+            rows, rejected = await loop.run_in_executor(executor,
+                                                        validateBatch, text)
+            self.rejectedRows.extend((name, lineNumber, reason)
+                                     for lineNumber, reason in rejected)
+
+            await self.validBatches.put((name, rows))
+            self.rawBatches.task_done()
+
+    # Fold valid batches into the aggregates, and publish a snapshot after
+    # each one.
+    async def aggregate(self):
+        while True:
+            name, rows = await self.validBatches.get()
+
+            ingestStationBatch(self.state, rows)
+            self.numAggregated += 1
+            self.numRows += len(rows[0])
+
+            await self.snapshots.put(self.getSnapshot(name))
+            self.validBatches.task_done()
+
+            if self.expectedBatches != None and \
+                    self.numAggregated >= self.expectedBatches:
+                self.stop()
+
+    # Return a snapshot of the current aggregates.
+    def getSnapshot(self, batchName):
+        snapshot = dict()
+        snapshot["Batch"] = batchName
+        snapshot["NumBatches"] = self.numAggregated
+        snapshot["NumRows"] = self.numRows
+        snapshot["NumRejected"] = len(self.rejectedRows)
+        snapshot["ProvinceTurnout"] = dict(zip(self.state["Provinces"],
+                self.state["ProvinceTurnout"]))
+        snapshot["ProvinceGhaniMargin"] = dict(zip(self.state["Provinces"],
+                self.state["ProvinceGhaniMargin"]))
+        snapshot["DirtyFigures"] = sorted(popDirtyFigures(self.state))
+
+        return snapshot
+
+    async def sleepUnlessStopped(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    # Run the service until it is stopped.
+    async def run(self):
+        if self.numProcesses <= 1:
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                    self.numProcesses)
+
+        if self.directory != None:
+            poller = asyncio.ensure_future(self.pollDirectory())
+        else:
+            poller = asyncio.ensure_future(self.pollHttpFeed())
+
+        tasks = [poller] + [asyncio.ensure_future(self.validate(executor))
+                            for i in range(self.numProcesses)]
+        tasks.append(asyncio.ensure_future(self.aggregate()))
+        stopper = asyncio.ensure_future(self.stopped.wait())
+
+        try:
+            # The pipeline tasks only finish early if they fail (e.g. on a
+            # bad HTTP status), so stop on whichever happens first.
+            await asyncio.wait([stopper] + tasks,
+                               return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            for task in [stopper] + tasks:
+                task.cancel()
+
+            await asyncio.gather(stopper, *tasks, return_exceptions = True)
+            executor.shutdown()
+
+        for task in tasks:
+            if not task.cancelled() and task.exception() != None:
+                raise task.exception()
+
+
+# A local stand-in for the results feed. It serves a list of batch texts
+# over HTTP on localhost; batches are released with publish() (or all at
+# once, if "published" is None).
+#
+class FakeResultsFeed(object):
+    def __init__(self, batches, published = None):
+        self.batches = batches
+        self.published = len(batches) if published == None else published
+        self.server = None
+        self.port = None
+
+    # Make the next "count" batches available.
+    def publish(self, count = 1):
+        self.published = min(self.published + count, len(self.batches))
+
+    async def handle(self, reader, writer):
+        requestLine = (await reader.readline()).decode("ascii").split()
+
+        # Skip the rest of the request headers.
+        while (await reader.readline()).strip():
+            pass
+
+        status, body = "404 Not Found", ""
+
+        if len(requestLine) >= 2 and requestLine[1].startswith("/batch/"):
+            batchNumber = int(requestLine[1][len("/batch/"):])
+
+            if batchNumber < self.published:
+                status, body = "200 OK", self.batches[batchNumber]
+
+        body = body.encode("utf-8")
+        writer.write(("HTTP/1.0 " + status + "\r\nContent-Length: " +\
+                      str(len(body)) + "\r\n\r\n").encode("ascii") + body)
+        await writer.drain()
+        writer.close()
+
+    # Start serving on a free localhost port, and return that port.
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        return self.port
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+# This function splits the lines of a polling station file into batch
+# texts of batchSize rows, each with the header line.
+#
+def splitIntoBatches(fileName, batchSize):
+    with open(fileName) as csvFile:
+        lines = csvFile.read().splitlines()
+
+    return [lines[0] + "\n" + "\n".join(lines[i:i + batchSize]) + "\n"
+            for i in range(1, len(lines), batchSize)]
+
+
+# This function replays the given batches through a FakeResultsFeed and a
+# ResultsFeedService, and returns the service once everything has been
+# aggregated.
+#
+async def replayThroughFakeFeed(batches):
+    feed = FakeResultsFeed(batches)
+    port = await feed.start()
+
+    service = ResultsFeedService(host = "127.0.0.1", port = port,
+                                 expectedBatches = len(batches))
+
+    try:
+        await service.run()
+    finally:
+        await feed.close()
+
+    return service
+
+
+# Main code
+if __name__ == "__main__":
+    batches = splitIntoBatches(RUNOFF_VOTES_POLLING_STATION_FILE,
+                               FAKE_FEED_BATCH_SIZE)
+    service = asyncio.run(replayThroughFakeFeed(batches))
+
+    snapshot = None
+
+    while not service.snapshots.empty():
+        snapshot = service.snapshots.get_nowait()
+
+    print("Ingested " + str(snapshot["NumRows"]) + " polling stations in " +\
+          str(snapshot["NumBatches"]) + " batches from the fake feed (" +\
+          str(snapshot["NumRejected"]) + " rows rejected)")
+    print("Runoff turnout in Paktika: " +\
+          str(snapshot["ProvinceTurnout"]["Paktika"]) + "%")
@@ -0,0 +1,81 @@
+# Description: A startup-time benchmark for the analysis entry points. For
+# each module, it starts a fresh Python interpreter several times, times
+# "import <module>", and records whether matplotlib.pyplot or scipy.stats
+# got loaded along the way. Since those are imported lazily now (see
+# lazy_imports.py), importing a script for its getter functions shouldn't
+# load either of them. The cost of importing them eagerly is measured too,
+# for comparison.
+#
+# Scripts that do their work at import time (turnout_convert.py and
+# cso_pop_convert.py) aren't included.
+#
+# Outputs:
+#       * stdout - The median import time (in ms) of each module, and which
+#         heavy modules it loaded.
+#
+
+
+import sys
+import subprocess
+import numpy as np
+
+
+# Constants
+
+# The modules to time.
+ENTRY_MODULES = ["afghan_functions", "afghan_plotting",
+                 "observer_district_trends",
+                 "observer_turnout_trends", "province_vote_share_hist",
+                 "turnout_distrib", "v_over_e_vs_t", "vote_share_vs_t",
+                 "winning_margin_analysis", "turnout_regression",
+                 "fraud_model_fit", "election_query", "summary_cube",
+                 "incremental_results", "station_records"]
+
+# The heavy modules to check for, and to time on their own.
+HEAVY_MODULES = ["matplotlib.pyplot", "scipy.stats"]
+
+# The number of fresh interpreters per module.
+NUM_RUNS = 5
+
+# The code run in each fresh interpreter. It prints the import time in
+# seconds, followed by the heavy modules that were loaded.
+TIMING_CODE = """
+import sys, time
+startTime = time.time()
+%s
+elapsed = time.time() - startTime
+print(" ".join([repr(elapsed)] + [name for name in %r
+                                  if name in sys.modules]))
+"""
+
+
+# This function imports the given statement in NUM_RUNS fresh
+# interpreters, and returns (median time in ms, list of heavy modules that
+# were loaded).
+#
+def timeImport(importStatement):
+    times = list()
+
+    for i in range(NUM_RUNS):
+        output = subprocess.check_output([sys.executable, "-c",
+                TIMING_CODE % (importStatement, HEAVY_MODULES)])
+        fields = output.decode("ascii").split()
+        times.append(1000.0 * float(fields[0]))
+
+    return np.median(times), fields[1:]
+
+
+# Main code
+if __name__ == "__main__":
+    print("Median import time over " + str(NUM_RUNS) + " runs (ms):")
+
+    for moduleName in ENTRY_MODULES:
+        importTime, loaded = timeImport("import " + moduleName)
+        print("    " + moduleName.ljust(28) + ("%.1f" % importTime).rjust(8) +\
+              "    " + (", ".join(loaded) if loaded else "-"))
+
+    print("For comparison, eager imports of the heavy modules (ms):")
+
+    for moduleName in HEAVY_MODULES:
+        importTime, loaded = timeImport("import " + moduleName)
+        print("    " + moduleName.ljust(28) + ("%.1f" % importTime).rjust(8))
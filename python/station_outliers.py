@@ -0,0 +1,313 @@
+# Description: Multivariate outlier scores for polling stations. The other
+# anomaly checks look at one number at a time (e.g. the 0 vs. 600 votes
+# rule in turnout_convert.py, or the > 100% turnout list in
+# turnout_distrib.py). Here, each station's vector of
+#
+#       * its turnout proxy (total votes / STATION_CAPACITY),
+#       * the log ratios of its candidates' votes to the last candidate's
+#         (each plus LOG_RATIO_PSEUDOCOUNT, so that a candidate can get no
+#         votes), and
+#       * (in the runoff) the change in its total votes since the first
+#         round (also / STATION_CAPACITY; stations that aren't in the first
+#         round file aren't scored)
+#
+# is compared to those of the other stations in its district (or
+# province), by its squared Mahalanobis distance from their mean. The
+# means and covariances are robust: they are re-estimated ROBUST_ITERATIONS
+# times from only the stations within the OUTLIER_QUANTILE of the
+# chi-squared distribution, so the outliers themselves don't inflate them.
+# Since that also leaves out the normal stations in the tails, the
+# trimmed covariances are scaled up by the usual consistency factor
+# (OUTLIER_QUANTILE / P(chi-squared with two more degrees of freedom <=
+# the threshold)), which makes them unbiased for normal features.
+# Stations that aren't assigned to a province (see
+# afghan_functions.getStationColumns()) aren't scored either, nor are
+# stations with fewer than MIN_STATION_VOTES votes.
+#
+# Vote shares are bounded, so in districts where a candidate gets (almost)
+# all or none of the votes, their spread is tiny and a station that
+# differs by a few votes gets a huge distance. The log ratios don't have
+# that problem, and with the pseudocount, a station with only a few votes
+# can't get extreme ratios. With them, about as many stations as expected
+# are beyond the median and the 90% quantile of the chi-squared
+# distribution; more than 1 - OUTLIER_QUANTILE of them are beyond
+# OUTLIER_QUANTILE (about 1% by district, and up to 3.5% by province),
+# since the tails of real stations are heavier than normal. Note that a
+# district where most stations have 0 vs. 600 votes makes its 0 vs. 600
+# stations typical.
+#
+# All of the groups' means and covariances are computed together: the
+# stations are sorted by group, and the (weighted) sums of their vectors
+# and outer products are added up with np.add.reduceat over the group
+# offsets. Groups with fewer than MIN_GROUP_STATIONS stations use the
+# national mean and covariance instead.
+#
+# Command-line arguments (optional, in this order): the election
+# ("Runoff", the default, or "FirstRound"), and the group level
+# ("District", the default, or "Province").
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv
+#       * ../clean_data/first_round_votes.csv
+#
+# Outputs:
+#       * ../analysis_output/station_outliers_<election>_<level>.csv - The
+#         outlying stations (beyond OUTLIER_QUANTILE), most outlying first.
+#       * stdout - The number of outliers, and how many of them the 0 vs.
+#         600 votes rule finds.
+#
+
+
+import os
+import sys
+import csv
+import numpy as np
+from lazy_imports import lazyFunction
+
+# Import some convenience functions
+from afghan_functions import pcNumbersToDistrictIds
+from vote_clusters import readStationVotes, matchStations
+from summary_cube import readStationProvinces
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+chi2 = lazyFunction("scipy.stats", "chi2")
+
+
+# Constants
+
+# VALUES
+from afghan_constants import STATION_CAPACITY
+from summary_cube import FIRST_ROUND_CANDIDATES
+from vote_clusters import CANDIDATE_NAMES, RUNOFF_CANDIDATES
+
+# The number of times the robust means and covariances are re-estimated.
+ROBUST_ITERATIONS = 3
+
+# The quantile of the chi-squared distribution beyond which a station is
+# left out of the robust estimates, and reported as an outlier.
+OUTLIER_QUANTILE = 0.999
+
+# Groups with fewer stations than this use the national estimates.
+MIN_GROUP_STATIONS = 20
+
+# Stations with fewer votes than this aren't scored (their vote shares are
+# mostly counting noise).
+MIN_STATION_VOTES = 10
+
+# The number of votes added to every candidate's votes before their log
+# ratios are taken.
+LOG_RATIO_PSEUDOCOUNT = 0.5
+
+# The fraction of each feature's national variance that is added to the
+# diagonal of every covariance, so that groups in which a feature doesn't
+# vary can still be inverted (and tiny differences in it don't dominate).
+COVARIANCE_RIDGE = 0.01
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+OUTPUT_DIR = "../analysis_output/"
+
+# INPUT FILES
+
+# CSV file for first round votes (by polling station).
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# The polling station vote file of each election, its province column, its
+# candidate columns, and the candidates' short names.
+ELECTION_FILES = {
+    "Runoff": (RUNOFF_VOTES_POLLING_STATION_FILE, 'Province',
+               RUNOFF_CANDIDATES, RUNOFF_CANDIDATES),
+    "FirstRound": (FIRST_ROUND_VOTES_FILE, 'province',
+                   FIRST_ROUND_CANDIDATES, CANDIDATE_NAMES),
+}
+
+# OUTPUT FILES
+
+# The outliers are saved to this file, with the election and level in
+# place of the "%s"s.
+OUTLIERS_FILE = OUTPUT_DIR + "station_outliers_%s_%s.csv"
+
+
+# This function returns the stations of an election that can be scored, as
+# a tuple of: their PC and PS numbers, their IEC district IDs, their
+# (normalized) province names, their (stations, candidates) array of
+# votes, the names of their features, and their (stations, features) array
+# of features (see the description above).
+#
+def getStationFeatures(election):
+    votesFile, provinceColumn, candidates, names = ELECTION_FILES[election]
+    pcNumbers, psNumbers, votes = readStationVotes(votesFile, candidates)
+    provinces = readStationProvinces(votesFile, provinceColumn)
+
+    totals = votes.sum(axis = 1)
+    logVotes = np.log(votes + LOG_RATIO_PSEUDOCOUNT)
+    featureNames = ["Turnout"] + [name + "LogRatio" for name in names[:-1]]
+    features = [totals[:, None] / STATION_CAPACITY,
+                logVotes[:, :-1] - logVotes[:, -1:]]
+    scored = totals >= MIN_STATION_VOTES
+
+    if election == "Runoff":
+        firstRoundPcNumbers, firstRoundPsNumbers, firstRoundVotes = \
+                readStationVotes(FIRST_ROUND_VOTES_FILE,
+                                 FIRST_ROUND_CANDIDATES)
+        firstRoundRows = matchStations(pcNumbers, psNumbers,
+                                       firstRoundPcNumbers,
+                                       firstRoundPsNumbers)
+        scored &= firstRoundRows >= 0
+
+        featureNames.append("TotalChange")
+        features.append((totals - firstRoundVotes.sum(axis = 1)[
+                firstRoundRows])[:, None] / STATION_CAPACITY)
+
+    features = np.hstack(features)[scored]
+
+    return pcNumbers[scored], psNumbers[scored],\
+            pcNumbersToDistrictIds(pcNumbers[scored]), provinces[scored],\
+            votes[scored], featureNames, features
+
+
+# This function estimates the weighted mean and covariance of the
+# features of every group at once. The features are sorted by group, and
+# "starts" is the index of each group's first station. It returns a
+# (groups, features) array of means, a (groups, features, features) array
+# of covariances, and each group's total weight.
+#
+def getGroupEstimates(features, weights, starts):
+    totalWeights = np.add.reduceat(weights, starts)
+    sums = np.add.reduceat(weights[:, None] * features, starts, axis = 0)
+    products = np.add.reduceat(weights[:, None, None] *
+                               features[:, :, None] * features[:, None, :],
+                               starts, axis = 0)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = sums / totalWeights[:, None]
+        covariances = products / totalWeights[:, None, None] - \
+                means[:, :, None] * means[:, None, :]
+
+    return means, covariances, totalWeights
+
+
+# This function returns each station's squared Mahalanobis distance from
+# its group's mean, given its group's mean and inverse covariance.
+#
+def getScores(features, means, inverses):
+    differences = features - means
+
+    return np.einsum('si,sij,sj->s', differences, inverses, differences)
+
+
+# This function returns the robust mean and covariance of every group (see
+# the description above), given the stations' features sorted by group
+# and the index of each group's first station. Groups with fewer than
+# MIN_GROUP_STATIONS stations inside the OUTLIER_QUANTILE get the national
+# estimates. It returns the (groups, features) means, and the (groups,
+# features, features) inverses of the covariances.
+#
+def getRobustEstimates(features, starts):
+    numFeatures = features.shape[1]
+    groupIndices = np.repeat(np.arange(len(starts)), np.diff(np.append(
+            starts, len(features))))
+    threshold = chi2(numFeatures).ppf(OUTLIER_QUANTILE)
+    consistency = OUTLIER_QUANTILE / chi2(numFeatures + 2).cdf(threshold)
+    weights = np.ones(len(features))
+
+    for iteration in range(ROBUST_ITERATIONS + 1):
+        means, covariances, totalWeights = getGroupEstimates(features,
+                weights, starts)
+        nationalMean, nationalCovariance, _ = getGroupEstimates(features,
+                weights, np.array([0]))
+
+        small = totalWeights < MIN_GROUP_STATIONS
+        means[small] = nationalMean
+        covariances[small] = nationalCovariance
+
+        # Undo the shrinkage from leaving out the tails (see above).
+        if iteration > 0:
+            covariances *= consistency
+
+        ridge = COVARIANCE_RIDGE * np.diag(np.diag(nationalCovariance[0]))
+        inverses = np.linalg.inv(covariances + ridge)
+
+        # Leave the stations beyond the quantile out of the next estimates.
+        if iteration < ROBUST_ITERATIONS:
+            scores = getScores(features, means[groupIndices],
+                               inverses[groupIndices])
+            weights = (scores <= threshold).astype(float)
+
+    return means, inverses
+
+
+# This function scores every station, relative to the other stations with
+# the same key (e.g. district ID). It returns the squared Mahalanobis
+# distances, and their p-values under the chi-squared distribution.
+#
+def scoreStations(keys, features):
+    order = np.argsort(keys, kind = 'mergesort')
+    groupKeys, starts = np.unique(keys[order], return_index = True)
+    groupIndices = np.searchsorted(groupKeys, keys)
+
+    # Center the features first, so that the covariances (computed from
+    # sums of products) don't lose precision.
+    features = features - features.mean(axis = 0)
+    means, inverses = getRobustEstimates(features[order], starts)
+    scores = getScores(features, means[groupIndices],
+                       inverses[groupIndices])
+
+    return scores, chi2(features.shape[1]).sf(scores)
+
+
+# Main code
+if __name__ == "__main__":
+    election = sys.argv[1] if len(sys.argv) > 1 else "Runoff"
+    level = sys.argv[2] if len(sys.argv) > 2 else "District"
+
+    if election not in ELECTION_FILES or \
+            level not in ["District", "Province"]:
+        print("usage: " + sys.argv[0] + " [Runoff|FirstRound] "
+              "[District|Province]")
+        sys.exit(1)
+
+    pcNumbers, psNumbers, districtIds, provinces, votes, featureNames, \
+            features = getStationFeatures(election)
+    keys = districtIds if level == "District" else provinces
+    scores, pValues = scoreStations(keys, features)
+
+    outliers = np.nonzero(pValues < 1.0 - OUTLIER_QUANTILE)[0]
+    outliers = outliers[np.argsort(-scores[outliers], kind = 'mergesort')]
+
+    # The stations that the 0 vs. 600 votes rule finds (see
+    # turnout_convert.py).
+    exactRule = np.zeros(len(votes), dtype = bool)
+
+    if election == "Runoff":
+        exactRule = (votes.min(axis = 1) == 0) & \
+                (votes.max(axis = 1) == STATION_CAPACITY)
+
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    outputFile = OUTLIERS_FILE % (election, level)
+
+    with open(outputFile, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["PC_number", "PS_number", "DistrictId",
+                            "Province", "Score", "PValue"] + featureNames)
+
+        for i in outliers:
+            csvWriter.writerow([pcNumbers[i], psNumbers[i], districtIds[i],
+                                provinces[i], scores[i], pValues[i]] +
+                               features[i].tolist())
+
+    print("Scored " + str(len(scores)) + " stations by " +
+          level.lower() + " (" + ", ".join(featureNames) + ")")
+    print(str(len(outliers)) + " outliers saved to " + outputFile)
+
+    if election == "Runoff":
+        print(str(np.count_nonzero(exactRule[outliers])) + " of them (of " +
+              str(np.count_nonzero(exactRule)) + " stations) have 0 vs. " +
+              str(STATION_CAPACITY) + " votes")
@@ -0,0 +1,258 @@
+# Description: Compact representations of polling station results. The
+# analysis scripts keep stations as csv.DictReader dicts of strings, or (in
+# turnout_convert.py) sum them into [abdullah, ghanhi, total] lists. That
+# is fine for the 22,469 runoff stations, but a dict of strings costs
+# hundreds of bytes per station, which adds up for bigger or repeated
+# datasets. This module provides
+#
+#       * StationRecord, a __slots__ record for code that works one row
+#         at a time (it keeps all seven fields of a row, so it is somewhat
+#         bigger than turnout_convert.py's three-count lists, but it is
+#         still far smaller than a dict of strings),
+#       * a structured NumPy array (STATION_DTYPE, 22 bytes per station)
+#         for bulk code, with the province and district names stored as
+#         small integer codes into name arrays (it is filled from the typed
+#         columns that the other polling station readers share, so it
+#         adds little to them), and
+#       * a district table, i.e. a dictionary of NumPy columns with one
+#         row per district, built from the station array with bincount.
+#
+# The main code prints a memory report comparing the per-station footprint
+# of each representation.
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv
+#
+
+
+import sys
+import csv
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import openCsvFile, getStationColumns, alignToKeys
+from observer_district_trends import getDistrictIdToPop
+
+# Share one copy of each province and district name between records.
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION, STATION_CAPACITY
+from afghan_functions import POLLING_CENTER_DIGITS
+
+# The layout of one station in the structured array. Vote counts are
+# int32: a station should have at most STATION_CAPACITY ballots, but
+# nothing checks that before the counts are packed (see
+# integrity_check.py). readStationArray() checks that every value fits.
+STATION_DTYPE = np.dtype([("Province", np.int16), ("District", np.int16),
+                          ("PCNumber", np.int32), ("PSNumber", np.int16),
+                          ("Abdullah", np.int32), ("Ghani", np.int32),
+                          ("Total", np.int32)])
+
+# The fields of STATION_DTYPE that are copied from columns of the polling
+# station file, and those columns.
+STATION_COLUMNS = [("PCNumber", "PC_number"), ("PSNumber", "PS_number"),
+                   ("Abdullah", "Abdullah"), ("Ghani", "Ghani"),
+                   ("Total", "Total")]
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+
+# INPUT FILES
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+
+# A single polling station result. Names are interned, so every record in
+# a province shares one copy of the province name.
+#
+class StationRecord(object):
+    __slots__ = ("province", "district", "pcNumber", "psNumber", "abdullah",
+                 "ghani", "total")
+
+    def __init__(self, province, district, pcNumber, psNumber, abdullah,
+                 ghani, total):
+        self.province = intern(province)
+        self.district = intern(district)
+        self.pcNumber = pcNumber
+        self.psNumber = psNumber
+        self.abdullah = abdullah
+        self.ghani = ghani
+        self.total = total
+
+    # The IEC district ID of the station's polling center.
+    def getDistrictId(self):
+        return self.pcNumber // 10 ** POLLING_CENTER_DIGITS
+
+    def __repr__(self):
+        return "StationRecord(" + ", ".join(repr(getattr(self, name))
+                                            for name in self.__slots__) + ")"
+
+
+# This function reads a polling station file in the raw_votes_runoff.csv
+# schema, and yields one StationRecord per row.
+#
+def iterStationRecords(fileName = RUNOFF_VOTES_POLLING_STATION_FILE):
+    with openCsvFile(fileName) as csvFile:
+        csvReader = csv.reader(csvFile)
+        next(csvReader)
+
+        for row in csvReader:
+            if len(row) < 7:
+                continue
+
+            yield StationRecord(row[0], row[1], int(row[2]), int(row[3]),
+                                int(row[4]), int(row[5]), int(row[6]))
+
+
+# This function reads a polling station file in the raw_votes_runoff.csv
+# schema into a structured array of STATION_DTYPE. It returns the array,
+# and the arrays of province and district names that the "Province" and
+# "District" codes index. The array is filled from the cached typed columns
+# (see afghan_functions.getStationColumns(), which leaves out the stations
+# that aren't assigned to a province), so there is no Python object per
+# station along the way. It raises a ValueError if a value doesn't fit its
+# field's type.
+#
+def readStationArray(fileName = RUNOFF_VOTES_POLLING_STATION_FILE):
+    columns = getStationColumns(fileName)
+    provinceNames, provinceCodes = np.unique(columns['Province'],
+                                             return_inverse = True)
+    districtNames, districtCodes = np.unique(columns['District'],
+                                             return_inverse = True)
+
+    values = dict()
+    values["Province"] = provinceCodes
+    values["District"] = districtCodes
+
+    for field, columnName in STATION_COLUMNS:
+        values[field] = columns[columnName]
+
+    stations = np.zeros(len(provinceCodes), dtype = STATION_DTYPE)
+
+    for field in STATION_DTYPE.names:
+        limits = np.iinfo(STATION_DTYPE[field])
+
+        if len(stations) > 0 and (values[field].min() < limits.min or
+                                  values[field].max() > limits.max):
+            raise ValueError("The " + field + " values of " + fileName +
+                             " don't fit in " + str(STATION_DTYPE[field]))
+
+        stations[field] = values[field]
+
+    return stations, provinceNames, districtNames
+
+
+# This function builds the district table from a station array: a
+# dictionary of NumPy columns with one row per IEC district, sorted by
+# DistrictId. Besides the vote totals, it has the number of stations, the
+# number of "0 vs. 600" stations (where one candidate got every ballot, as
+# flagged by turnout_convert.py), the population and the turnout.
+#
+def buildDistrictTable(stations, provinceNames, districtNames):
+    districtIds = stations["PCNumber"] // 10 ** POLLING_CENTER_DIGITS
+    keys, firstRows, inverse = np.unique(districtIds, return_index = True,
+                                         return_inverse = True)
+
+    table = dict()
+    table["DistrictId"] = keys
+    table["Province"] = provinceNames[stations["Province"][firstRows]]
+    table["District"] = districtNames[stations["District"][firstRows]]
+    table["NumStations"] = np.bincount(inverse, minlength = len(keys))
+
+    for column in ["Abdullah", "Ghani", "Total"]:
+        table[column] = np.bincount(inverse, weights = stations[column],
+                minlength = len(keys)).astype(np.int64)
+
+    isZeroVsFull = (stations["Total"] == STATION_CAPACITY) & \
+            ((stations["Abdullah"] == 0) | (stations["Ghani"] == 0))
+    table["ZeroVs600"] = np.bincount(inverse, weights = isZeroVsFull,
+            minlength = len(keys)).astype(np.int64)
+
+    popIds, pops = getDistrictIdToPop()
+    table["Population"] = alignToKeys(keys, popIds, pops)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        table["Turnout"] = 100.0 * table["Total"] / \
+                (table["Population"] * VOTING_FRACTION)
+
+    return table
+
+
+# This function returns the total size in bytes of an object and
+# everything it refers to (through containers and __slots__), counting
+# each object once. Objects already in "seen" aren't counted, so shared
+# objects (like interned names, or the keys that csv.DictReader reuses)
+# are only paid for once across a whole sample.
+#
+def getDeepSize(obj, seen):
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += getDeepSize(key, seen) + getDeepSize(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += getDeepSize(item, seen)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            size += getDeepSize(getattr(obj, name), seen)
+
+    return size
+
+
+# This function measures the average number of bytes per station for each
+# representation of a polling station file, and returns a list of
+# (representation, bytes per station) tuples.
+#
+def getMemoryReport(fileName = RUNOFF_VOTES_POLLING_STATION_FILE):
+    with openCsvFile(fileName) as csvFile:
+        dictRows = [row for row in csv.DictReader(csvFile)
+                    if row.get("Total") != None]
+
+    listRows = [[int(row["Abdullah"]), int(row["Ghani"]), int(row["Total"])]
+                for row in dictRows]
+    records = list(iterStationRecords(fileName))
+    stations, provinceNames, districtNames = readStationArray(fileName)
+    numStations = float(len(stations))
+
+    # Each container (list of rows) is part of the footprint, as is the
+    # structured array's name lookup.
+    report = list()
+    report.append(("csv.DictReader dicts",
+                   getDeepSize(dictRows, set()) / numStations))
+    report.append(("[abdullah, ghanhi, total] lists",
+                   getDeepSize(listRows, set()) / numStations))
+    report.append(("StationRecord (__slots__)",
+                   getDeepSize(records, set()) / numStations))
+    report.append(("Structured array (STATION_DTYPE)",
+                   (stations.nbytes + getDeepSize(list(provinceNames), set())
+                    + getDeepSize(list(districtNames), set())) /
+                   numStations))
+
+    return report
+
+
+# Main code
+if __name__ == "__main__":
+    print("Memory per polling station (bytes):")
+
+    for representation, bytesPerStation in getMemoryReport():
+        print("    " + representation.ljust(36) +\
+              ("%.1f" % bytesPerStation).rjust(8))
+
+    table = buildDistrictTable(*readStationArray())
+    print("District table: " + str(len(table["DistrictId"])) +\
+          " districts, " + str(int(table["ZeroVs600"].sum())) +\
+          " stations with 0 vs. 600 votes")
@@ -0,0 +1,389 @@
+# Description: This module builds a precomputed summary "cube" for each
+# election, so that ad-hoc questions (e.g. "what was Ghani's winning margin
+# in Paktika districts with > 100% turnout?") can be answered without
+# rereading any CSV files. A cube holds, for every district (keyed by IEC
+# district ID):
+#
+#       * "Votes" - a (districts, turnout bins, candidates) array of votes,
+#         where the turnout bin is that of the polling station (total votes
+#         / STATION_CAPACITY, in NUM_TURNOUT_BINS equal bins).
+#       * "Stations" - a (districts, turnout bins) array of polling station
+#         counts.
+#       * "DistrictVotes" - the total votes in each district (the sum of
+#         "Votes" over bins and candidates, kept up to date alongside it).
+#       * "Population" and "Observers" - per-district arrays (NaN and 0
+#         respectively when unknown).
+#       * "Provinces" - the province name of each district.
+#
+# Roll-ups are then just sums of a few hundred numbers under a boolean
+# mask. Cubes are saved to ../clean_data/ as .npz files, and can be updated
+# incrementally when polling station rows change (by subtracting the old
+# rows' contributions and adding the new ones).
+#
+# Inputs:
+#       * ../raw_data/raw_votes_runoff.csv
+#       * ../clean_data/first_round_votes.csv
+#       * (and the observer and population inputs of
+#         observer_district_trends.py)
+#
+# Outputs:
+#       * ../clean_data/summary_cube_runoff.npz
+#       * ../clean_data/summary_cube_first_round.npz
+#
+
+
+import os
+import timeit
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import dataCache, getCachedData, getStationColumns,\
+        pcNumbersToDistrictIds, alignToKeys
+from observer_district_trends import getDistrictIdToPop,\
+        getFirstRoundDistrictObservers, getRunoffDistrictObservers
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION, STATION_CAPACITY
+from afghan_functions import RUNOFF_TURNOUT_FILE
+from observer_district_trends import FIRST_ROUND_OBS_DEP_FILE,\
+        RUNOFF_OBS_DEP_FILE
+
+# The number of polling station turnout bins in a cube.
+NUM_TURNOUT_BINS = 10
+
+# The candidate columns in the first round votes file.
+FIRST_ROUND_CANDIDATES = ["Eng-QutbuddinHilal", "Dr.AbdullahAbdullah",
+        "ZalmaiRassoul", "AbdulRahimWardak", "QuayumKarzai",
+        "Prof-AbdoRabeRasoolSayyaf", "Dr.MohammadAshrafGhaniAhmadzai",
+        "MohammadDaoudSultanzoy", "Mohd.ShafiqGulAghaSherzai",
+        "MohammadNadirNaeem", "HedayatAminArsala"]
+
+# The column of each runoff candidate in each election.
+CANDIDATE_COLUMNS = {
+    "Runoff": {"Abdullah": "Abdullah", "Ghani": "Ghani"},
+    "FirstRound": {"Abdullah": "Dr.AbdullahAbdullah",
+                   "Ghani": "Dr.MohammadAshrafGhaniAhmadzai"},
+}
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# CSV file for first round votes (by polling station).
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# For each election: its polling station file, its candidate columns, its
+# province column, the function that returns its district observers, and
+# the file its cube is saved to.
+ELECTIONS = {
+    "Runoff": (RUNOFF_VOTES_POLLING_STATION_FILE, ["Abdullah", "Ghani"],
+               'Province', getRunoffDistrictObservers,
+               CLEAN_DATA_DIR + "summary_cube_runoff.npz"),
+    "FirstRound": (FIRST_ROUND_VOTES_FILE, FIRST_ROUND_CANDIDATES,
+                   'province', getFirstRoundDistrictObservers,
+                   CLEAN_DATA_DIR + "summary_cube_first_round.npz"),
+}
+
+# All of the files that each election's cube is built from (its polling
+# station file, the population inputs of getDistrictIdToPop(), and its
+# observer file). A saved cube is only used if it is newer than all of them.
+CUBE_INPUT_FILES = {
+    "Runoff": [RUNOFF_VOTES_POLLING_STATION_FILE, FIRST_ROUND_VOTES_FILE,
+               RUNOFF_TURNOUT_FILE, RUNOFF_OBS_DEP_FILE],
+    "FirstRound": [FIRST_ROUND_VOTES_FILE, RUNOFF_TURNOUT_FILE,
+                   FIRST_ROUND_OBS_DEP_FILE],
+}
+
+
+# This function normalizes a province name from a polling station file to
+# the capitalization used by the population data.
+#
+def normalizeProvinceName(provinceName):
+    provinceName = "".join(w.capitalize() for w in provinceName.split())
+
+    return provinceName.title()
+
+
+# This function returns the (normalized) province name of each station in
+# a polling station vote file (see afghan_functions.getStationColumns()),
+# given its province column. Each distinct name is only normalized once.
+#
+def readStationProvinces(votesFile, provinceColumn):
+    names, indices = np.unique(getStationColumns(votesFile)[provinceColumn],
+                               return_inverse = True)
+
+    return np.array([normalizeProvinceName(str(name))
+                     for name in names])[indices]
+
+
+# This function returns an election's polling station rows as three
+# arrays: the IEC district ID of each station, its (normalized) province
+# name, and an (N, candidates) array of its votes. Stations that aren't
+# assigned to a province are left out (see
+# afghan_functions.getStationColumns()). The result is cached.
+#
+def getStationRows(election):
+    return getCachedData(("StationRows", election),
+                         lambda: readStationRows(election))
+
+
+# This function reads the arrays returned by getStationRows().
+#
+def readStationRows(election):
+    votesFile, candidates, provinceColumn = ELECTIONS[election][0:3]
+    columns = getStationColumns(votesFile)
+    votes = np.zeros((len(columns['PC_number']), len(candidates)))
+
+    for i, candidate in enumerate(candidates):
+        votes[:, i] = columns[candidate]
+
+    return pcNumbersToDistrictIds(columns['PC_number']),\
+            readStationProvinces(votesFile, provinceColumn), votes
+
+
+# This function returns the turnout bin of each polling station, given the
+# (N, candidates) array of its votes.
+#
+def getStationTurnoutBins(votes):
+    turnouts = votes.sum(axis = 1) / float(STATION_CAPACITY)
+
+    return np.clip((turnouts * NUM_TURNOUT_BINS).astype(int), 0,
+                   NUM_TURNOUT_BINS - 1)
+
+
+# This function returns the index of each district ID in the cube, adding
+# rows to the cube for district IDs it hasn't seen before. New districts
+# get the given province names, NaN population and no observers.
+#
+def getCubeDistrictIndices(cube, districtIds, provinces):
+    newIds, firstRows = np.unique(districtIds, return_index = True)
+    isNew = ~np.isin(newIds, cube["DistrictIds"])
+
+    if isNew.any():
+        numNew = isNew.sum()
+        allIds = np.concatenate((cube["DistrictIds"], newIds[isNew]))
+        order = np.argsort(allIds, kind = 'mergesort')
+
+        def grow(array, fillValue):
+            newRows = np.full((numNew,) + array.shape[1:], fillValue,
+                              dtype = array.dtype)
+            return np.concatenate((array, newRows))[order]
+
+        cube["DistrictIds"] = allIds[order]
+        cube["Provinces"] = np.concatenate((cube["Provinces"].astype(object),
+                provinces[firstRows[isNew]].astype(object)))[order]\
+                .astype(str)
+        cube["Population"] = grow(cube["Population"], np.nan)
+        cube["Observers"] = grow(cube["Observers"], 0.0)
+        cube["Votes"] = grow(cube["Votes"], 0.0)
+        cube["DistrictVotes"] = grow(cube["DistrictVotes"], 0.0)
+        cube["Stations"] = grow(cube["Stations"], 0.0)
+
+    return np.searchsorted(cube["DistrictIds"], districtIds)
+
+
+# This function adds (sign = 1) or removes (sign = -1) the contributions of
+# a batch of polling station rows to a cube, in place.
+#
+def addStationsToCube(cube, districtIds, provinces, votes, sign = 1.0):
+    if len(districtIds) == 0:
+        return cube
+
+    districtIndices = getCubeDistrictIndices(cube, districtIds, provinces)
+    turnoutBins = getStationTurnoutBins(votes)
+
+    np.add.at(cube["Votes"], (districtIndices, turnoutBins), sign * votes)
+    np.add.at(cube["Stations"], (districtIndices, turnoutBins), sign)
+    np.add.at(cube["DistrictVotes"], districtIndices,
+              sign * votes.sum(axis = 1))
+
+    return cube
+
+
+# This function updates a cube in place when polling station rows change:
+# the old versions of the rows are removed, and the new versions added.
+# Both are (districtIds, provinces, votes) tuples, as returned by
+# getStationRows(). Either can be None (for inserted or deleted rows).
+#
+def updateStationsInCube(cube, oldRows, newRows):
+    if oldRows != None:
+        addStationsToCube(cube, *oldRows, sign = -1.0)
+
+    if newRows != None:
+        addStationsToCube(cube, *newRows, sign = 1.0)
+
+    return cube
+
+
+# This function builds the cube for an election from scratch.
+#
+def buildSummaryCube(election):
+    candidates = ELECTIONS[election][1]
+    getObservers = ELECTIONS[election][3]
+
+    cube = dict()
+    cube["Candidates"] = np.array(candidates)
+    cube["DistrictIds"] = np.zeros(0, dtype = np.int64)
+    cube["Provinces"] = np.zeros(0, dtype = str)
+    cube["Population"] = np.zeros(0)
+    cube["Observers"] = np.zeros(0)
+    cube["Votes"] = np.zeros((0, NUM_TURNOUT_BINS, len(candidates)))
+    cube["DistrictVotes"] = np.zeros(0)
+    cube["Stations"] = np.zeros((0, NUM_TURNOUT_BINS))
+
+    addStationsToCube(cube, *getStationRows(election))
+
+    popIds, pops = getDistrictIdToPop()
+    cube["Population"] = alignToKeys(cube["DistrictIds"], popIds, pops)
+
+    obsIds, obsCounts = getObservers()
+    cube["Observers"] = alignToKeys(cube["DistrictIds"], obsIds,
+                                    obsCounts.sum(axis = 1), 0.0)
+
+    return cube
+
+
+# This function saves a cube to an .npz file.
+#
+def saveSummaryCube(cube, fileName):
+    np.savez(fileName, **cube)
+
+
+# This function loads a cube from an .npz file.
+#
+def loadSummaryCube(fileName):
+    cubeFile = np.load(fileName)
+    cube = dict((key, cubeFile[key]) for key in cubeFile.files)
+    cubeFile.close()
+
+    return cube
+
+
+# This function returns the cube for an election. It is loaded from its
+# .npz file if that exists (and is newer than all of its input files, see
+# CUBE_INPUT_FILES), and is otherwise built (and saved, unless saveCube is
+# False). The result is cached.
+#
+def getSummaryCube(election, saveCube = True):
+    return getCachedData(("SummaryCube", election),
+                         lambda: loadOrBuildSummaryCube(election, saveCube))
+
+
+# This function loads or builds the cube for getSummaryCube().
+#
+def loadOrBuildSummaryCube(election, saveCube = True):
+    cubeFile = ELECTIONS[election][4]
+
+    if os.path.exists(cubeFile) and all(os.path.getmtime(cubeFile) >=
+            os.path.getmtime(inputFile)
+            for inputFile in CUBE_INPUT_FILES[election]):
+        cube = loadSummaryCube(cubeFile)
+    else:
+        cube = buildSummaryCube(election)
+
+        if saveCube:
+            saveSummaryCube(cube, cubeFile)
+
+    return cube
+
+
+# This function returns the turnout percentage of each district in a cube.
+#
+def getCubeDistrictTurnouts(cube):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return 100.0 * cube["DistrictVotes"] / \
+                (cube["Population"] * VOTING_FRACTION)
+
+
+# This function returns the mask over a cube's districts for the given
+# filters. "provinces" is a list of province names (None for all), and
+# minTurnout/maxTurnout bound the *district* turnout percentage.
+#
+def getCubeDistrictMask(cube, provinces = None, minTurnout = None,
+                        maxTurnout = None):
+    mask = np.ones(len(cube["DistrictIds"]), dtype = bool)
+
+    if provinces != None:
+        mask &= np.isin(cube["Provinces"], provinces)
+
+    if minTurnout != None or maxTurnout != None:
+        turnouts = getCubeDistrictTurnouts(cube)
+
+        with np.errstate(invalid = 'ignore'):
+            if minTurnout != None:
+                mask &= turnouts > minTurnout
+            if maxTurnout != None:
+                mask &= turnouts <= maxTurnout
+
+    return mask
+
+
+# This function rolls a cube up over the districts that pass the filters
+# (see getCubeDistrictMask()) and the polling station turnout bins in
+# stationBins (None for all). It returns a dictionary with the total
+# "Votes" (by candidate), "TotalVotes", "Stations", "Population",
+# "Observers", "Turnout" and "VoteShares" (by candidate, in %). Population,
+# observers and turnout always cover the whole of the selected districts.
+#
+def rollUp(cube, provinces = None, minTurnout = None, maxTurnout = None,
+           stationBins = None):
+    mask = getCubeDistrictMask(cube, provinces, minTurnout, maxTurnout)
+
+    votes = cube["Votes"][mask]
+    stations = cube["Stations"][mask]
+
+    if stationBins != None:
+        votes = votes[:, stationBins]
+        stations = stations[:, stationBins]
+
+    candidateVotes = votes.sum(axis = (0, 1))
+    totalVotes = candidateVotes.sum()
+    allVotes = cube["DistrictVotes"][mask].sum()
+    population = np.nansum(cube["Population"][mask])
+
+    results = dict()
+    results["Votes"] = dict(zip(cube["Candidates"], candidateVotes))
+    results["TotalVotes"] = totalVotes
+    results["Stations"] = stations.sum()
+    results["Population"] = population
+    results["Observers"] = cube["Observers"][mask].sum()
+    results["Turnout"] = 100.0 * allVotes / (population * VOTING_FRACTION)\
+            if population > 0 else np.nan
+    results["VoteShares"] = dict(zip(cube["Candidates"],
+            100.0 * candidateVotes / totalVotes if totalVotes > 0 else
+            np.full(len(candidateVotes), np.nan)))
+
+    return results
+
+
+# Main code
+if __name__ == "__main__":
+    for election in ELECTIONS:
+        cube = buildSummaryCube(election)
+        saveSummaryCube(cube, ELECTIONS[election][4])
+        dataCache[("SummaryCube", election)] = cube
+
+        print("Saved " + election + " summary cube (" +\
+              str(len(cube["DistrictIds"])) + " districts) to\n" +\
+              ELECTIONS[election][4])
+
+    # An example roll-up, and how long it takes.
+    cube = getSummaryCube("Runoff")
+    paktika = rollUp(cube, provinces = ["Paktika"], minTurnout = 100.0)
+    margin = paktika["VoteShares"]["Ghani"] - \
+            paktika["VoteShares"]["Abdullah"]
+    seconds = timeit.timeit(lambda: rollUp(cube, provinces = ["Paktika"],
+                                           minTurnout = 100.0),
+                            number = 1000) / 1000
+
+    print("Ghani's winning margin in Paktika districts with > 100% " +\
+          "turnout: " + str(margin) + "% (" + str(paktika["Stations"]) +\
+          " stations; roll-up took " + str(1e6 * seconds) + " us)")
@@ -6,6 +6,12 @@
 # file (which indicates districts with > 100% turnout in the runoff
 # election).
 #
+# Both elections' district turnouts are computed together, as arrays, in
+# one pass over the two input files, and the CSV file and all four
+# histograms are produced from those arrays (the figures are rendered in
+# parallel). Kernel density estimates of both distributions (which, unlike
+# the histograms, don't depend on a bin count) are saved as well.
+#
 # Inputs:
 #       * ../clean_data/first_round_votes.csv
 #       * ../clean_data/runoff_votes_and_turnout.csv
@@ -25,15 +31,21 @@
 #         restricted range.
 #       * ../clean_data/high_turnout.csv - A CSV file containing districts
 #         with >= 100.0% turnout in the runoff election.
+#       * ../clean_data/turnout_histograms.npz - The binned counts for the
+#         above histograms (see histogram_engine.py).
+#       * ../clean_data/turnout_kdes.npz - The district turnout densities of
+#         both elections, unweighted and weighted by population (see
+#         kde_engine.py).
 #
 
 import csv
 import numpy as np
-import matplotlib.pyplot as plt
-from operator import itemgetter
 
 # Import convenience functions
 from afghan_functions import *
+from histogram_engine import getCachedHistograms, getHistogram,\
+        getSplitBinning, renderHistogramFigures
+from kde_engine import getCachedKdes
 
 
 # Constants
@@ -41,10 +53,18 @@ from afghan_functions import *
 # VALUES
 from afghan_constants import VOTING_FRACTION
 
+# The approximate number of bins over the entire turnout range, and the
+# number of bins over the restricted (0% to 100%) range.
+NUM_BINS_ENTIRE_RANGE = 100
+NUM_BINS_RESTRICTED_RANGE = 30
+
 # DIRECTORIES
 CLEAN_DATA_DIR = "../clean_data/"
 FIGURE_DIR = "../figures/turnout_distribs/"
 
+# The elections, in the order their turnouts are computed.
+ELECTIONS = ["FirstRound", "Runoff"]
+
 # INPUT FILES
 
 # CSV file for first round votes (by polling station)
@@ -73,232 +93,235 @@ RUNOFF_ELECTION_TURNOUT_DISTRIB_ENTIRE = FIGURE_DIR +\
 RUNOFF_ELECTION_TURNOUT_DISTRIB_RESTR = FIGURE_DIR +\
         "runoff_turnout_distrib_restricted.png"
 
+# The (entire range, restricted range) histograms of each election.
+TURNOUT_FIGURE_FILES = {
+    "FirstRound": (FIRST_ROUND_TURNOUT_DISTRIB_ENTIRE,
+                   FIRST_ROUND_TURNOUT_DISTRIB_RESTR),
+    "Runoff": (RUNOFF_ELECTION_TURNOUT_DISTRIB_ENTIRE,
+               RUNOFF_ELECTION_TURNOUT_DISTRIB_RESTR),
+}
+
 # The CSV file containing districts with high turnouts in the runoff
 # election.
 HIGH_TURNOUT_FILE = CLEAN_DATA_DIR + "high_turnout.csv"
 
+# The binned counts behind the four histograms above.
+TURNOUT_HISTOGRAMS_FILE = CLEAN_DATA_DIR + "turnout_histograms.npz"
 
-# Global variables
+# The turnout densities of both elections.
+TURNOUT_KDES_FILE = CLEAN_DATA_DIR + "turnout_kdes.npz"
 
-# Dicts to track district-level data (cached to avoid regeneration).
-provinceDistrictToPop = None
+
+# This function returns the district turnouts of both elections. The
+# result is a dictionary that maps each election in ELECTIONS to a
+# dictionary of parallel "Provinces", "Districts", "Populations" and
+# "Turnouts" arrays.
+#
+# The station rows of FIRST_ROUND_VOTES_FILE and the district rows of
+# RUNOFF_VOTES_FILE are read once each, and each row gets an (election,
+# Province, District) key. All of the vote counts are then added up by key
+# with a single bincount, and divided by (that district's population *
+# VOTING_FRACTION), with the population looked up once per district. The
+# result is cached.
+#
+def getDistrictTurnoutArrays():
+    return getCachedData("DistrictTurnoutArrays",
+                         computeDistrictTurnoutArrays)
 
 
-# This function populates a dictionary that maps (Province, District)
-# tuples to their populations.
+# This function computes the arrays returned by getDistrictTurnoutArrays().
 #
-def populateProvinceDistrictToPop():
-    global provinceDistrictToPop
+def computeDistrictTurnoutArrays():
+    provinceDistrictToPop = populateProvinceDistrictToPop()
 
-    # If it's already populated, just return.
-    if provinceDistrictToPop != None:
-        return
+    keys = list()
+    totalVotes = list()
 
-    provinceDistrictToPop = getProvinceDistrictToPop()
+    for row in getCsvRows(FIRST_ROUND_VOTES_FILE):
+        # Fix the capitalization on province names. This just capitalizes
+        # the first letter of each word and gets rid of spaces (if any).
+        # This also includes capitalization around dashes.
+        provinceName = "".join(w.capitalize() for w in \
+                               row['province'].split()).title()
 
+        keys.append((0, provinceName, row['district']))
+        totalVotes.append(float(row['Total']))
 
-# This function returns a dictionary that maps (Province, District) tuples
-# to their turnouts for the first round election.
-#
-def getProvinceDistrictToFirstRoundTurnout():
-    global provinceDistrictToPop
-    populateProvinceDistrictToPop()
+    for row in getCsvRows(RUNOFF_VOTES_FILE):
+        keys.append((1, row['Province'], row['District']))
+        totalVotes.append(float(row['PopulationVoted']))
+
+    # Number the distinct keys, and add up the votes of each one.
+    keyToIndex = dict()
+    indices = np.array([keyToIndex.setdefault(key, len(keyToIndex))
+                        for key in keys])
+    uniqueKeys = sorted(keyToIndex, key = keyToIndex.get)
+    districtVotes = np.bincount(indices, weights = totalVotes)
+
+    elections = np.array([key[0] for key in uniqueKeys])
+    provinces = np.array([key[1] for key in uniqueKeys])
+    districts = np.array([key[2] for key in uniqueKeys])
+    pops = np.array([provinceDistrictToPop[(key[1], key[2])]
+                     for key in uniqueKeys])
 
-    # Go through FIRST_ROUND_VOTES_FILE, add up all of the total vote
-    # counts in each district, and divide by (that district's population *
-    # VOTING_FRACTION). This will be stored in the dict below.
-    provinceDistrictToFirstRoundTurnout = dict()
+    turnouts = 100.0 * districtVotes / (VOTING_FRACTION * pops)
 
-    with open(FIRST_ROUND_VOTES_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+    districtTurnoutArrays = dict()
 
-        for row in csvReader:
-            provinceName = row['province']
-            districtName = row['district']
-            totalVotes = float(row['Total'])
+    for i, election in enumerate(ELECTIONS):
+        inElection = elections == i
+        districtTurnoutArrays[election] = {
+            "Provinces": provinces[inElection],
+            "Districts": districts[inElection],
+            "Populations": pops[inElection],
+            "Turnouts": turnouts[inElection],
+        }
 
-            # Fix the capitalization on province names. This just
-            # capitalizes the first letter of each word and gets rid of
-            # spaces (if any). This also includes capitalization around
-            # dashes.
-            provinceName = "".join(w.capitalize() for w in \
-                                   provinceName.split())
-            provinceName = provinceName.title()
+    return districtTurnoutArrays
 
-            districtPop = provinceDistrictToPop[(provinceName,
-                                                 districtName)]
 
-            if (provinceName, districtName) in \
-                    provinceDistrictToFirstRoundTurnout:
+# This function returns a dictionary that maps (Province, District) tuples
+# to the turnouts of the given election (see getDistrictTurnoutArrays()).
+#
+def getProvinceDistrictToTurnout(election):
+    arrays = getDistrictTurnoutArrays()[election]
 
-                provinceDistrictToFirstRoundTurnout[\
-                        (provinceName, districtName)] += 100.0 *\
-                        totalVotes / (VOTING_FRACTION * districtPop)
+    return dict(zip(zip(arrays["Provinces"], arrays["Districts"]),
+                    arrays["Turnouts"]))
 
-            else:
-                provinceDistrictToFirstRoundTurnout[\
-                        (provinceName, districtName)] = 100.0 *\
-                        totalVotes / (VOTING_FRACTION * districtPop)
 
-    return provinceDistrictToFirstRoundTurnout
+# This function returns a dictionary that maps (Province, District) tuples
+# to their turnouts for the first round election.
+#
+def getProvinceDistrictToFirstRoundTurnout():
+    return getProvinceDistrictToTurnout("FirstRound")
 
 
 # This function returns a dictionary that maps (Province, District) tuples
 # to their turnouts for the runoff election.
 #
 def getProvinceDistrictToRunoffTurnout():
-    global provinceDistrictToPop
-    populateProvinceDistrictToPop()
+    return getProvinceDistrictToTurnout("Runoff")
 
-    # Go through RUNOFF_VOTES_FILE, add up all of the total vote counts
-    # in each district, and divide by (that district's population *
-    # VOTING_FRACTION). This will be stored in the dict below.
-    provinceDistrictToRunoffTurnout = dict()
 
-    with open(RUNOFF_VOTES_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+# This function returns the histogram specs (see histogram_engine.py) for
+# the turnout distributions of both elections, given the arrays from
+# getDistrictTurnoutArrays(). Each election gets an "Entire" histogram that
+# covers all of its data (with a bin edge at 100%), and a "Restricted" one
+# over 0% to 100%.
+#
+def getTurnoutHistogramSpecs(turnoutArrays):
+    specs = list()
 
-        for row in csvReader:
-            provinceName = row['Province']
-            districtName = row['District']
-            totalVotes = float(row['PopulationVoted'])
+    for election in ELECTIONS:
+        turnouts = turnoutArrays[election]["Turnouts"]
+        numBins, maxTurnout = getSplitBinning(turnouts, 100.0,
+                                              NUM_BINS_ENTIRE_RANGE)
 
-            districtPop = provinceDistrictToPop[(provinceName,
-                                                 districtName)]
+        specs.append((election + "/Entire", turnouts, 0.0, maxTurnout,
+                      numBins))
+        specs.append((election + "/Restricted", turnouts, 0.0, 100.0,
+                      NUM_BINS_RESTRICTED_RANGE))
 
-            if (provinceName, districtName) in \
-                    provinceDistrictToRunoffTurnout:
+    return specs
 
-                provinceDistrictToRunoffTurnout[\
-                        (provinceName, districtName)] += 100.0 *\
-                        totalVotes / (VOTING_FRACTION * districtPop)
 
-            else:
-                provinceDistrictToRunoffTurnout[\
-                        (provinceName, districtName)] = 100.0 *\
-                        totalVotes / (VOTING_FRACTION * districtPop)
+# This function returns the KDE specs (see kde_engine.py) for the turnout
+# distributions of both elections, given the arrays from
+# getDistrictTurnoutArrays(). Each election gets a "Districts" density
+# (every district counts once), and a "Population" density (each district
+# is weighted by its population), both over all of its data.
+#
+def getTurnoutKdeSpecs(turnoutArrays):
+    specs = list()
+
+    for election in ELECTIONS:
+        turnouts = turnoutArrays[election]["Turnouts"]
+        maxTurnout = np.nanmax(turnouts)
+
+        specs.append((election + "/Districts", turnouts, None, 0.0,
+                      maxTurnout, "silverman"))
+        specs.append((election + "/Population", turnouts,
+                      turnoutArrays[election]["Populations"], 0.0,
+                      maxTurnout, "silverman"))
 
-    return provinceDistrictToRunoffTurnout
+    return specs
+
+
+# This function returns the render jobs (see histogram_engine.py) for the
+# turnout distribution figures. figureFiles maps each election to draw to
+# its (entire range, restricted range) output files.
+#
+def getTurnoutFigureJobs(histograms, figureFiles = TURNOUT_FIGURE_FILES):
+    jobs = list()
+
+    for election, electionTitle in [("FirstRound", "First Round"),
+                                    ("Runoff", "Runoff Election")]:
+        if election not in figureFiles:
+            continue
+
+        entireFile, restrictedFile = figureFiles[election]
+
+        # In plotting the entire distribution, use different colors for
+        # < 100% and >= 100% turnout.
+        counts, edges = getHistogram(histograms, election + "/Entire")
+        jobs.append({"Counts": counts, "Edges": edges,
+                     "Color": np.where(edges[:-1] < 100.0, 'b', 'r'),
+                     "XLabel": "Turnout Percentage",
+                     "YLabel": "Number of Districts",
+                     "Title": electionTitle + " Turnout Distribution",
+                     "OutputFile": entireFile})
+
+        counts, edges = getHistogram(histograms, election + "/Restricted")
+        jobs.append({"Counts": counts, "Edges": edges,
+                     "XLabel": "Turnout Percentage",
+                     "YLabel": "Number of Districts",
+                     "Title": electionTitle +\
+                             " Turnout Distribution (Restricted Range)",
+                     "XLim": [0.0, 100.0],
+                     "OutputFile": restrictedFile})
+
+    return jobs
 
 
 # Main code
 if __name__ == "__main__":
-    # Get the various dicts that contain turnout data.
-    provinceDistrictToFirstRoundTurnout = \
-            getProvinceDistrictToFirstRoundTurnout()
-    provinceDistrictToRunoffTurnout = getProvinceDistrictToRunoffTurnout()
-
-
-    # Output the districts with greater than 100.0% turnout. We'll store
-    # the rows to output (to the CSV file) in this list. The three columns
-    # in this list will represent province name, district name, and turnout
-    # rate (%).
-    highTurnoutRows = list()
-
-    for provinceDistrict in provinceDistrictToRunoffTurnout:
-        provinceName = provinceDistrict[0]
-        districtName = provinceDistrict[1]
-        turnout = provinceDistrictToRunoffTurnout[provinceDistrict]
-
-        highTurnoutRows.append([provinceName, districtName, turnout])
-
-    # Sort by turnout, in descending order.
-    highTurnoutRows = sorted(highTurnoutRows, key = itemgetter(2),
-                             reverse = True)
-
-    # Output to the "high turnout" CSV file.
-    csvWriter = csv.writer(open(HIGH_TURNOUT_FILE, "w"))
-    csvWriter.writerow(["ProvinceName", "DistrictName", "TurnoutPercent"])
-    csvWriter.writerows(highTurnoutRows)
-    print "Saved high turnout district data to\n", HIGH_TURNOUT_FILE, "\n"
-
-    # Histogram creation.
-    # We only care about the dicts' values if we want to create histograms.
-    firstRoundTurnouts = \
-            np.array(provinceDistrictToFirstRoundTurnout.values())
-    runoffTurnouts = \
-            np.array(provinceDistrictToRunoffTurnout.values())
-
-    # Plot histograms and save them to file. Do one histogram that extends
-    # over all the data, and one from 0% to 100%.
-    numBinsEntireRange = 100
-    numBinsRestrictedRange = 30
-
-    # Plot the two first-round histograms.
-    fig, ax = plt.subplots()
-    fig.set_facecolor('white')
-
-    # In plotting the entire distribution, use different colors for
-    # < 100% and >= 100% turnout.
-    ax.hist(firstRoundTurnouts[firstRoundTurnouts < 100.0],
-            numBinsEntireRange*100.0/max(firstRoundTurnouts),
-            histtype = 'bar',
-            range = None, color = 'b')
-    ax.hist(firstRoundTurnouts[firstRoundTurnouts >= 100.0],
-            numBinsEntireRange*(1.0 - 100.0/max(firstRoundTurnouts)),
-            histtype = 'bar',
-            range = None, color = 'r')
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("Number of Districts")
-    plt.title("First Round Turnout Distribution")
-
-    plt.savefig(FIRST_ROUND_TURNOUT_DISTRIB_ENTIRE,
-                bbox_inches = "tight")
-    print "Saved entire first-round turnout distribution to\n", \
-            FIRST_ROUND_TURNOUT_DISTRIB_ENTIRE
-    plt.close()
-
-    fig = plt.figure()
-    fig.set_facecolor('white')
-    plt.hist(firstRoundTurnouts, numBinsRestrictedRange, histtype = 'bar',
-             range = [0.0, 100.0])
-    plt.xlabel("Turnout Percentage")
-    plt.xlim([0.0, 100.0])
-    plt.ylabel("Number of Districts")
-    plt.title("First Round Turnout Distribution (Restricted Range)")
-
-    plt.savefig(FIRST_ROUND_TURNOUT_DISTRIB_RESTR,
-                bbox_inches = "tight")
-    print "Saved restricted first-round turnout distribution to\n", \
-            FIRST_ROUND_TURNOUT_DISTRIB_RESTR, "\n"
-    plt.close()
-
-
-    # Plot the two runoff-election histograms.
-    fig, ax = plt.subplots()
-    fig.set_facecolor('white')
-
-    # In plotting the entire distribution, use different colors for
-    # < 100% and >= 100% turnout.
-    ax.hist(runoffTurnouts[runoffTurnouts < 100.0],
-            numBinsEntireRange*100.0/max(runoffTurnouts),
-            histtype = 'bar',
-            range = None, color = 'b')
-    ax.hist(runoffTurnouts[runoffTurnouts >= 100.0],
-            numBinsEntireRange*(1.0 - 100.0/max(runoffTurnouts)),
-            histtype = 'bar',
-            range = None, color = 'r')
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("Number of Districts")
-    plt.title("Runoff Election Turnout Distribution")
-
-    plt.savefig(RUNOFF_ELECTION_TURNOUT_DISTRIB_ENTIRE,
-                bbox_inches = "tight")
-    print "Saved entire runoff turnout distribution to\n", \
-            RUNOFF_ELECTION_TURNOUT_DISTRIB_ENTIRE
-    plt.close()
-
-    fig = plt.figure()
-    fig.set_facecolor('white')
-    plt.hist(runoffTurnouts, numBinsRestrictedRange, histtype = 'bar',
-             range = [0.0, 100.0])
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("Number of Districts")
-    plt.xlim([0.0, 100.0])
-    plt.title("Runoff Election Turnout Distribution (Restricted Range)")
-
-    plt.savefig(RUNOFF_ELECTION_TURNOUT_DISTRIB_RESTR,
-                bbox_inches = "tight")
-    print "Saved restricted runoff turnout distribution to\n", \
-            RUNOFF_ELECTION_TURNOUT_DISTRIB_RESTR
-    plt.close()
+    # Get the turnout arrays of both elections.
+    turnoutArrays = getDistrictTurnoutArrays()
+    runoff = turnoutArrays["Runoff"]
+
+    # Output the runoff districts, sorted by turnout in descending order
+    # (ties keep their file order). The three columns represent province
+    # name, district name, and turnout rate (%).
+    order = np.argsort(-runoff["Turnouts"], kind = 'mergesort')
+
+    with open(HIGH_TURNOUT_FILE, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["ProvinceName", "DistrictName",
+                            "TurnoutPercent"])
+        csvWriter.writerows(zip(runoff["Provinces"][order],
+                                runoff["Districts"][order],
+                                runoff["Turnouts"][order].tolist()))
+
+    print("Saved high turnout district data to\n" + HIGH_TURNOUT_FILE +\
+          "\n")
+
+    # Histogram creation. The counts are computed in one pass by
+    # histogram_engine.py and saved, so only the rendering below is redone
+    # when the inputs haven't changed.
+    histograms = getCachedHistograms(TURNOUT_HISTOGRAMS_FILE,
+            [FIRST_ROUND_VOTES_FILE, RUNOFF_VOTES_FILE],
+            lambda: getTurnoutHistogramSpecs(turnoutArrays),
+            {"VotingFraction": VOTING_FRACTION})
+
+    # Render the first-round and runoff histograms (one over all the data,
+    # and one from 0% to 100%, for each) together, and save them to file.
+    for outputFile in renderHistogramFigures(getTurnoutFigureJobs(
+            histograms)):
+        print("Saved turnout distribution to\n" + outputFile)
+
+    # Save the turnout densities (unless they're already saved).
+    getCachedKdes(TURNOUT_KDES_FILE,
+                  [FIRST_ROUND_VOTES_FILE, RUNOFF_VOTES_FILE],
+                  lambda: getTurnoutKdeSpecs(turnoutArrays))
+    print("Saved turnout densities to\n" + TURNOUT_KDES_FILE)
@@ -0,0 +1,263 @@
+# Description: Turnout estimates under different models of each district's
+# eligible (voting-age) population. Every script computes turnout as
+# 100 * votes / (population * VOTING_FRACTION), with VOTING_FRACTION a
+# single national constant, which is where the 1352% turnout rows in
+# high_turnout.csv come from. This module makes the eligible population
+# pluggable, so the sensitivity of turnout to that assumption can be
+# checked. The models are
+#
+#       * "NationalConstant" - population * VOTING_FRACTION, as everywhere
+#         else.
+#       * "UrbanRural" - the urban and rural populations of each district
+#         from the CSO 2013-14 tables, each with its own voting-age
+#         fraction (see URBAN_TO_RURAL_ADULT_RATIO). The two fractions are
+#         chosen so that the national average is still VOTING_FRACTION.
+#       * "BallotAllocation" - the number of polling stations in the
+#         district * STATION_CAPACITY. The IEC planned polling stations
+#         from voter registration figures, and the registration figures
+#         themselves aren't in this repository, so this serves as the
+#         registration-based model. Since no station has more than
+#         STATION_CAPACITY votes, its turnout can't exceed 100%; it measures
+#         how much of the planned capacity was used.
+#
+# Each model is a function of an election's summary cube (see
+# summary_cube.py) that returns the eligible population of every district
+# in it (NaN where unknown), so new models only have to be added to
+# ELIGIBLE_POPULATION_MODELS. All models are evaluated over all districts
+# at once, as a (models, districts) array.
+#
+# Inputs:
+#       * ../raw_data/raw_cso_pop_13_14.csv
+#       * (and the inputs of summary_cube.py)
+#
+# Outputs:
+#       * ../clean_data/turnout_models_runoff.csv and
+#         ../clean_data/turnout_models_first_round.csv - The turnout of
+#         each district under each model.
+#
+
+
+import re
+import csv
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import getCachedData, openCsvFile, alignToKeys
+from summary_cube import getSummaryCube, getCubeDistrictTurnouts
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION, STATION_CAPACITY
+
+# The ratio of the voting-age fraction of urban populations to that of
+# rural populations. Urban populations have proportionally fewer children,
+# but the CSO tables don't break districts down by age, so this is an
+# assumption (1.0 makes "UrbanRural" match "NationalConstant" up to the
+# difference in population figures).
+URBAN_TO_RURAL_ADULT_RATIO = 1.1
+
+# The CSO tables give populations in thousands.
+CSO_POPULATION_UNITS = 1000.0
+
+# The columns of the CSO tables: rural and urban population (both sexes),
+# the district name, and its number within the province.
+CSO_RURAL_COLUMN = 2
+CSO_URBAN_COLUMN = 5
+CSO_NAME_COLUMN = 9
+CSO_NUMBER_COLUMN = 11
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# CSV file for the CSO 2013-14 settled population tables (one table per
+# province, with rural and urban populations by district).
+CSO_POPULATION_FILE = RAW_DATA_DIR + "raw_cso_pop_13_14.csv"
+
+# The CSO file was saved on Windows (it has a few cp1252 dashes).
+CSO_POPULATION_ENCODING = "cp1252"
+
+# OUTPUT FILES
+
+# The turnout of each district under each model, by election.
+TURNOUT_MODELS_FILES = {
+    "Runoff": CLEAN_DATA_DIR + "turnout_models_runoff.csv",
+    "FirstRound": CLEAN_DATA_DIR + "turnout_models_first_round.csv",
+}
+
+
+# This function reads the CSO tables, and returns the sorted IEC district
+# IDs along with an (N, 2) array of their (urban, rural) populations. The
+# provinces appear in the tables in IEC province number order, and each
+# district's number within its province matches its IEC district ID (e.g.
+# Paghman, district 02 of Kabul, is 102). Missing figures ("__") are 0.
+# The result is cached.
+#
+def getDistrictIdToUrbanRuralPop():
+    return getCachedData("DistrictIdToUrbanRuralPop",
+                         readDistrictIdToUrbanRuralPop)
+
+
+# This function reads the tables for getDistrictIdToUrbanRuralPop().
+#
+def readDistrictIdToUrbanRuralPop():
+    provinceNames = list()
+    districtIds = list()
+    pops = list()
+
+    def toPop(field):
+        field = field.strip()
+
+        return float(field) * CSO_POPULATION_UNITS if field and \
+                field != "__" else 0.0
+
+    with openCsvFile(CSO_POPULATION_FILE,
+                     CSO_POPULATION_ENCODING) as csvFile:
+        for row in csv.reader(csvFile):
+            # A new table starts with its title. Some provinces have more
+            # than one title row.
+            match = re.search("Settled Population of (.*?) province",
+                              row[0] if row else "", re.IGNORECASE)
+
+            if match != None:
+                provinceName = match.group(1).strip().lower()
+
+                if provinceName not in provinceNames:
+                    provinceNames.append(provinceName)
+
+                continue
+
+            if len(row) <= CSO_NUMBER_COLUMN or \
+                    not row[CSO_NUMBER_COLUMN].strip().isdigit() or \
+                    not row[CSO_NAME_COLUMN].strip():
+                continue
+
+            districtIds.append(100 * len(provinceNames) +
+                               int(row[CSO_NUMBER_COLUMN]))
+            pops.append([toPop(row[CSO_URBAN_COLUMN]),
+                         toPop(row[CSO_RURAL_COLUMN])])
+
+    order = np.argsort(districtIds)
+
+    return np.array(districtIds)[order], np.array(pops)[order]
+
+
+# The "NationalConstant" model.
+#
+def getNationalConstantEligible(cube):
+    return cube["Population"] * VOTING_FRACTION
+
+
+# The "UrbanRural" model.
+#
+def getUrbanRuralEligible(cube):
+    districtIds, pops = getDistrictIdToUrbanRuralPop()
+
+    # Solve for the rural fraction that keeps the national average at
+    # VOTING_FRACTION, given the national urban share.
+    urbanShare = pops[:, 0].sum() / pops.sum()
+    ruralFraction = VOTING_FRACTION / \
+            (urbanShare * URBAN_TO_RURAL_ADULT_RATIO + 1.0 - urbanShare)
+    urbanFraction = ruralFraction * URBAN_TO_RURAL_ADULT_RATIO
+
+    eligible = pops[:, 0] * urbanFraction + pops[:, 1] * ruralFraction
+
+    return alignToKeys(cube["DistrictIds"], districtIds, eligible)
+
+
+# The "BallotAllocation" model.
+#
+def getBallotAllocationEligible(cube):
+    return cube["Stations"].sum(axis = 1) * float(STATION_CAPACITY)
+
+
+# The eligible population models, by name.
+ELIGIBLE_POPULATION_MODELS = {
+    "NationalConstant": getNationalConstantEligible,
+    "UrbanRural": getUrbanRuralEligible,
+    "BallotAllocation": getBallotAllocationEligible,
+}
+
+
+# This function evaluates the given models (by default, all of them) for
+# an election. It returns the list of model names, and a (models,
+# districts) array of turnout percentages for the districts of the
+# election's cube.
+#
+def getModelTurnouts(election, modelNames = None):
+    if modelNames == None:
+        modelNames = sorted(ELIGIBLE_POPULATION_MODELS)
+
+    cube = getSummaryCube(election)
+    eligible = np.array([ELIGIBLE_POPULATION_MODELS[modelName](cube)
+                         for modelName in modelNames])
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        turnouts = 100.0 * cube["DistrictVotes"][np.newaxis, :] / eligible
+
+    return modelNames, turnouts
+
+
+# This function summarizes the sensitivity of turnout to the model. For
+# each model, it returns a dictionary with the number of districts it has
+# data for ("NumDistricts"), the number of those over 100% turnout
+# ("NumOver100"), and the median turnout ("MedianTurnout"). It also returns
+# the median, over districts with data under every model, of the ratio of
+# the highest model turnout to the lowest.
+#
+def summarizeModelTurnouts(modelNames, turnouts):
+    with np.errstate(invalid = 'ignore'):
+        valid = np.isfinite(turnouts) & (turnouts > 0.0)
+
+    summaries = dict()
+
+    for i, modelName in enumerate(modelNames):
+        summaries[modelName] = {
+            "NumDistricts": int(valid[i].sum()),
+            "NumOver100": int((turnouts[i][valid[i]] > 100.0).sum()),
+            "MedianTurnout": np.median(turnouts[i][valid[i]]),
+        }
+
+    allValid = valid.all(axis = 0)
+    spread = turnouts[:, allValid].max(axis = 0) / \
+            turnouts[:, allValid].min(axis = 0)
+
+    return summaries, np.median(spread)
+
+
+# Main code
+if __name__ == "__main__":
+    for election in sorted(TURNOUT_MODELS_FILES):
+        modelNames, turnouts = getModelTurnouts(election)
+        cube = getSummaryCube(election)
+
+        # Check the national constant model against the cube's turnout.
+        nationalConstant = turnouts[modelNames.index("NationalConstant")]
+        assert np.allclose(nationalConstant, getCubeDistrictTurnouts(cube),
+                           equal_nan = True)
+
+        with open(TURNOUT_MODELS_FILES[election], "w") as csvFile:
+            csvWriter = csv.writer(csvFile)
+            csvWriter.writerow(["DistrictId", "Province"] + modelNames)
+            csvWriter.writerows(zip(cube["DistrictIds"], cube["Provinces"],
+                                    *turnouts))
+
+        summaries, medianSpread = summarizeModelTurnouts(modelNames,
+                                                         turnouts)
+
+        print(election + " turnout by eligible population model:")
+
+        for modelName in modelNames:
+            print("    " + modelName.ljust(18) + str(summaries[modelName][
+                  "NumOver100"]).rjust(4) + " of " + str(summaries[
+                  modelName]["NumDistricts"]) + " districts over 100%, " +\
+                  "median turnout " + ("%.1f" % summaries[modelName][
+                  "MedianTurnout"]) + "%")
+
+        print("    Median ratio of highest to lowest model turnout per " +\
+              "district: " + ("%.2f" % medianSpread))
+        print("Saved to " + TURNOUT_MODELS_FILES[election])
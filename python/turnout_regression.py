@@ -0,0 +1,406 @@
+# Description: This module contains the regression engine for the
+# vote-share-vs-T and V/E-vs-T analyses. vote_share_vs_t.py and
+# v_over_e_vs_t.py fit plain OLS lines with linregress, after dropping
+# districts with > 200% turnout, and they give every district the same
+# weight. The functions here offer population-weighted least squares,
+# robust fits (Huber and Theil-Sen) and per-province fixed effects instead.
+#
+# Every fitting function works on a *batch* of K fits at once: the inputs
+# are (K, N) arrays over the same N districts, and a weight of 0 removes a
+# district from a particular fit. This way, all of the candidate/round/
+# subset combinations are solved together with array operations, rather
+# than one linregress call at a time.
+#
+# Inputs:
+#       * ../clean_data/runoff_votes_and_turnout.csv
+#       * ../clean_data/first_round_votes.csv
+#
+# Outputs:
+#       * ../clean_data/regression_fits.csv - A CSV file with one row per
+#         (fit specification, method), containing the slope, intercept,
+#         r^2 and number of districts used.
+#
+
+
+import csv
+import numpy as np
+
+# Import some convenience functions
+from afghan_functions import getCachedData, getCsvRows, sumByKey,\
+        alignToKeys
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION
+
+# The tuning constant for Huber's loss, in units of the residual scale.
+# 1.345 gives 95% efficiency when the residuals are actually normal.
+HUBER_DELTA = 1.345
+
+# The maximum number of iteratively-reweighted least squares iterations
+# for Huber fits, and the tolerance on the change in coefficients.
+HUBER_MAX_ITERATIONS = 50
+HUBER_TOLERANCE = 1e-8
+
+# The fitting methods understood by fitBatch().
+FIT_METHODS = ["OLS", "WLS", "Huber", "TheilSen", "FixedEffects"]
+
+# The first-round CSV columns for the two runoff candidates.
+FIRST_ROUND_CANDIDATE_COLUMNS = {"Abdullah": "Dr.AbdullahAbdullah",
+                                 "Ghani": "Dr.MohammadAshrafGhaniAhmadzai"}
+
+# DIRECTORIES
+CLEAN_DATA_DIR = "../clean_data/"
+
+# INPUT FILES
+
+# CSV file for runoff votes and population (by district).
+RUNOFF_VOTES_FILE = CLEAN_DATA_DIR + "runoff_votes_and_turnout.csv"
+
+# CSV file for first round votes (by polling station).
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# OUTPUT FILES
+
+# CSV file containing the results of all of the fits run by the main code.
+REGRESSION_FITS_FILE = CLEAN_DATA_DIR + "regression_fits.csv"
+
+
+# This function returns a dictionary of district-level arrays, all in the
+# order of the (sorted) "Province,District" keys in RUNOFF_VOTES_FILE:
+#
+#       * "Key", "Province" - the district keys and their province names.
+#       * "Population" - the district populations.
+#       * (electionRound, "Total") - the total votes in each district, where
+#         electionRound is "FirstRound" or "Runoff".
+#       * (electionRound, candidate) - the votes for "Abdullah" or "Ghani".
+#
+# First-round districts that don't appear in the runoff file get NaN. The
+# result is cached.
+#
+def getDistrictArrays():
+    return getCachedData("DistrictArrays", computeDistrictArrays)
+
+
+# This function computes the arrays returned by getDistrictArrays().
+#
+def computeDistrictArrays():
+    keys = list()
+    provinces = list()
+    runoffColumns = {"Abdullah": list(), "Ghani": list(), "Total": list()}
+    populations = list()
+
+    for row in getCsvRows(RUNOFF_VOTES_FILE):
+        keys.append(row['Province'] + "," + row['District'])
+        provinces.append(row['Province'])
+        runoffColumns["Abdullah"].append(float(row['AbdullahVotes']))
+        runoffColumns["Ghani"].append(float(row['GhaniVotes']))
+        runoffColumns["Total"].append(float(row['PopulationVoted']))
+        populations.append(float(row['TotalPopulation']))
+
+    order = np.argsort(keys)
+    keys = np.array(keys)[order]
+
+    arrays = dict()
+    arrays["Key"] = keys
+    arrays["Province"] = np.array(provinces)[order]
+    arrays["Population"] = np.array(populations)[order]
+
+    for column in runoffColumns:
+        arrays[("Runoff", column)] = np.array(runoffColumns[column])[order]
+
+    # Sum the first-round polling stations into districts, and align them
+    # to the runoff districts.
+    firstRoundKeys = list()
+    firstRoundVotes = list()
+    columns = [FIRST_ROUND_CANDIDATE_COLUMNS["Abdullah"],
+               FIRST_ROUND_CANDIDATE_COLUMNS["Ghani"], 'Total']
+
+    for row in getCsvRows(FIRST_ROUND_VOTES_FILE):
+        # Fix the capitalization on province names, just like
+        # turnout_distrib.py does.
+        provinceName = "".join(w.capitalize() for w in \
+                               row['province'].split())
+        provinceName = provinceName.title()
+
+        firstRoundKeys.append(provinceName + "," + row['district'])
+        firstRoundVotes.append([float(row[column])
+                                for column in columns])
+
+    firstRoundKeys, firstRoundSums = sumByKey(firstRoundKeys,
+                                              firstRoundVotes)
+    firstRoundSums = alignToKeys(keys, firstRoundKeys, firstRoundSums)
+
+    arrays[("FirstRound", "Abdullah")] = firstRoundSums[:, 0]
+    arrays[("FirstRound", "Ghani")] = firstRoundSums[:, 1]
+    arrays[("FirstRound", "Total")] = firstRoundSums[:, 2]
+
+    return arrays
+
+
+# This function builds the (K, N) X, Y and weight arrays for a batch of fit
+# specifications. Each specification is a tuple
+#
+#       (electionRound, candidate, quantity, maxTurnout, weighting)
+#
+# where quantity is "VoteShare" or "VOverE" (both percentages), maxTurnout
+# is the largest turnout percentage to include (None for no limit), and
+# weighting is "Population" or "Equal". X is always the turnout
+# percentage. Districts that are excluded (or have missing data) get a
+# weight of 0.
+#
+def buildFitBatch(specs):
+    arrays = getDistrictArrays()
+    eligible = arrays["Population"] * VOTING_FRACTION
+
+    numFits = len(specs)
+    numDistricts = len(arrays["Key"])
+    X = np.zeros((numFits, numDistricts))
+    Y = np.zeros((numFits, numDistricts))
+    W = np.zeros((numFits, numDistricts))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for k, (electionRound, candidate, quantity, maxTurnout,
+                weighting) in enumerate(specs):
+
+            totalVotes = arrays[(electionRound, "Total")]
+            candidateVotes = arrays[(electionRound, candidate)]
+
+            X[k] = 100.0 * totalVotes / eligible
+
+            if quantity == "VoteShare":
+                Y[k] = 100.0 * candidateVotes / totalVotes
+            elif quantity == "VOverE":
+                Y[k] = 100.0 * candidateVotes / eligible
+            else:
+                raise ValueError("Unknown regression quantity " + quantity)
+
+            if weighting == "Population":
+                W[k] = arrays["Population"]
+            elif weighting == "Equal":
+                W[k] = 1.0
+            else:
+                raise ValueError("Unknown weighting " + weighting)
+
+            if maxTurnout != None:
+                W[k][~(X[k] <= maxTurnout)] = 0.0
+
+    # Remove districts with missing data from every fit.
+    invalid = ~(np.isfinite(X) & np.isfinite(Y) & np.isfinite(W))
+    X[invalid] = 0.0
+    Y[invalid] = 0.0
+    W[invalid] = 0.0
+
+    return X, Y, W
+
+
+# This function computes weighted least squares lines y = a + b x for a
+# batch of fits. X, Y and W are (K, N) arrays; a weight of 0 excludes a
+# point. It returns a dictionary of (K,) arrays with the keys "Slope",
+# "Intercept", "RSquared" and "NumPoints".
+#
+def weightedLeastSquaresBatch(X, Y, W):
+    sumW = W.sum(axis = 1)
+    meanX = (W * X).sum(axis = 1) / sumW
+    meanY = (W * Y).sum(axis = 1) / sumW
+
+    dX = X - meanX[:, np.newaxis]
+    dY = Y - meanY[:, np.newaxis]
+    sXX = (W * dX * dX).sum(axis = 1)
+    sXY = (W * dX * dY).sum(axis = 1)
+    sYY = (W * dY * dY).sum(axis = 1)
+
+    slope = sXY / sXX
+
+    results = dict()
+    results["Slope"] = slope
+    results["Intercept"] = meanY - slope * meanX
+    results["RSquared"] = sXY**2.0 / (sXX * sYY)
+    results["NumPoints"] = (W > 0).sum(axis = 1)
+
+    return results
+
+
+# This function computes Huber robust regression lines for a batch of fits,
+# by iteratively reweighted least squares. The prior weights W (e.g.
+# populations) are multiplied by Huber's weights min(1, delta/|r/s|), where
+# s is a robust (MAD-based) scale estimate of each fit's residuals.
+#
+def huberBatch(X, Y, W, delta = HUBER_DELTA):
+    results = weightedLeastSquaresBatch(X, Y, W)
+    used = W > 0
+
+    for iteration in range(HUBER_MAX_ITERATIONS):
+        residuals = Y - (results["Intercept"][:, np.newaxis] + \
+                         results["Slope"][:, np.newaxis] * X)
+
+        # The scale of each fit's residuals, only counting its own points.
+        absResiduals = np.where(used, np.abs(residuals), np.nan)
+        scale = 1.4826 * np.nanmedian(absResiduals, axis = 1)
+        scale[scale == 0.0] = 1.0
+
+        with np.errstate(divide = 'ignore'):
+            huberWeights = np.minimum(1.0, delta * scale[:, np.newaxis] / \
+                                      np.abs(residuals))
+
+        newResults = weightedLeastSquaresBatch(X, Y, W * huberWeights)
+        change = np.abs(newResults["Slope"] - results["Slope"]) + \
+                np.abs(newResults["Intercept"] - results["Intercept"])
+        results = newResults
+
+        if np.all(change < HUBER_TOLERANCE):
+            break
+
+    # r^2 and the point count are reported for the unweighted-by-Huber
+    # data, so they're comparable with the other methods.
+    residuals = Y - (results["Intercept"][:, np.newaxis] + \
+                     results["Slope"][:, np.newaxis] * X)
+    results["RSquared"] = rSquaredBatch(Y, W, residuals)
+    results["NumPoints"] = used.sum(axis = 1)
+
+    return results
+
+
+# This function computes Theil-Sen lines for a batch of fits. The slope is
+# the median of the slopes between all pairs of points in a fit, and the
+# intercept is the median of y - slope * x. Points with zero weight are
+# excluded; otherwise the weights are only used for r^2. All pairs are
+# built at once, so memory use is O(K * N^2).
+#
+def theilSenBatch(X, Y, W):
+    used = W > 0
+    first, second = np.triu_indices(X.shape[1], 1)
+
+    dX = X[:, second] - X[:, first]
+    dY = Y[:, second] - Y[:, first]
+    validPairs = used[:, first] & used[:, second] & (dX != 0.0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        pairSlopes = np.where(validPairs, dY / dX, np.nan)
+
+    slope = np.nanmedian(pairSlopes, axis = 1)
+    intercept = np.nanmedian(np.where(used, Y - slope[:, np.newaxis] * X,
+                                      np.nan), axis = 1)
+
+    residuals = Y - (intercept[:, np.newaxis] + slope[:, np.newaxis] * X)
+
+    results = dict()
+    results["Slope"] = slope
+    results["Intercept"] = intercept
+    results["RSquared"] = rSquaredBatch(Y, W, residuals)
+    results["NumPoints"] = used.sum(axis = 1)
+
+    return results
+
+
+# This function fits y = a_g + b x for a batch of fits, where a_g is a
+# separate intercept for each group (province) g. "groups" is a length-N
+# array of group labels shared by all of the fits. The group means are all
+# computed in one bincount over (fit, group) offsets. The returned
+# "Intercept" is the weighted mean of the group intercepts, and
+# "GroupIntercepts" is a (K, G) array in the order of "Groups".
+#
+def fixedEffectsBatch(X, Y, W, groups):
+    numFits = X.shape[0]
+    groupLabels, groupIndex = np.unique(groups, return_inverse = True)
+    numGroups = len(groupLabels)
+
+    # Flat (fit, group) index for every point.
+    offsets = (np.arange(numFits)[:, np.newaxis] * numGroups + \
+               groupIndex[np.newaxis, :]).ravel()
+    size = numFits * numGroups
+
+    groupW = np.bincount(offsets, W.ravel(), size).reshape(numFits,
+                                                           numGroups)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        groupMeanX = np.bincount(offsets, (W * X).ravel(), size).reshape(
+                numFits, numGroups) / groupW
+        groupMeanY = np.bincount(offsets, (W * Y).ravel(), size).reshape(
+                numFits, numGroups) / groupW
+
+    # Demean within each group. Groups with no weight don't matter, since
+    # all of their points have zero weight anyway.
+    dX = X - np.nan_to_num(groupMeanX)[:, groupIndex]
+    dY = Y - np.nan_to_num(groupMeanY)[:, groupIndex]
+
+    slope = (W * dX * dY).sum(axis = 1) / (W * dX * dX).sum(axis = 1)
+    groupIntercepts = groupMeanY - slope[:, np.newaxis] * groupMeanX
+
+    residuals = dY - slope[:, np.newaxis] * dX
+
+    results = dict()
+    results["Slope"] = slope
+    results["Intercept"] = np.nansum(groupW * groupIntercepts, axis = 1) / \
+            groupW.sum(axis = 1)
+    results["RSquared"] = rSquaredBatch(Y, W, residuals)
+    results["NumPoints"] = (W > 0).sum(axis = 1)
+    results["Groups"] = groupLabels
+    results["GroupIntercepts"] = groupIntercepts
+
+    return results
+
+
+# This function returns the weighted r^2 (1 - SS_res/SS_tot) for a batch of
+# fits, given their (K, N) residuals.
+#
+def rSquaredBatch(Y, W, residuals):
+    meanY = (W * Y).sum(axis = 1) / W.sum(axis = 1)
+    totalSumSquares = (W * (Y - meanY[:, np.newaxis])**2.0).sum(axis = 1)
+
+    return 1.0 - (W * residuals**2.0).sum(axis = 1) / totalSumSquares
+
+
+# This function runs a batch of fits with the given method (one of
+# FIT_METHODS). For "OLS", the prior weights are only used to decide which
+# points are included. For "FixedEffects", provinces are the groups.
+#
+def fitBatch(X, Y, W, method):
+    if method == "OLS":
+        return weightedLeastSquaresBatch(X, Y, (W > 0).astype(float))
+    elif method == "WLS":
+        return weightedLeastSquaresBatch(X, Y, W)
+    elif method == "Huber":
+        return huberBatch(X, Y, W)
+    elif method == "TheilSen":
+        return theilSenBatch(X, Y, W)
+    elif method == "FixedEffects":
+        return fixedEffectsBatch(X, Y, W, getDistrictArrays()["Province"])
+
+    raise ValueError("Unknown fitting method " + method)
+
+
+# Main code
+if __name__ == "__main__":
+    # Every combination of round, candidate and quantity, both over all
+    # districts and with the old <= 200% turnout cut, weighted by
+    # population.
+    specs = list()
+
+    for electionRound in ["FirstRound", "Runoff"]:
+        for candidate in ["Abdullah", "Ghani"]:
+            for quantity in ["VoteShare", "VOverE"]:
+                for maxTurnout in [None, 200.0]:
+                    specs.append((electionRound, candidate, quantity,
+                                  maxTurnout, "Population"))
+
+    X, Y, W = buildFitBatch(specs)
+
+    csvWriter = csv.writer(open(REGRESSION_FITS_FILE, "w"))
+    csvWriter.writerow(["Round", "Candidate", "Quantity", "MaxTurnout",
+                        "Weighting", "Method", "Slope", "Intercept",
+                        "RSquared", "NumDistricts"])
+
+    for method in FIT_METHODS:
+        results = fitBatch(X, Y, W, method)
+
+        for k in range(len(specs)):
+            csvWriter.writerow(list(specs[k]) + [method,
+                               results["Slope"][k],
+                               results["Intercept"][k],
+                               results["RSquared"][k],
+                               results["NumPoints"][k]])
+
+    print("Saved " + str(len(specs) * len(FIT_METHODS)) +\
+          " regression fits to\n" + REGRESSION_FITS_FILE)
@@ -0,0 +1,243 @@
+# Description: Monte Carlo propagation of population uncertainty into
+# district turnout. high_turnout.csv ranks districts by a point turnout,
+# treating the CSO populations as exact, but those populations are
+# estimates (projected from old census data) and are published in
+# thousands, and VOTING_FRACTION is itself a national estimate. Here, each
+# draw samples
+#
+#       * each district's population: the published figure, plus a
+#         uniform rounding error of up to half of POPULATION_ROUNDING,
+#         times a lognormal error with log-sd POPULATION_LOG_SD (drawn
+#         independently for every district), and
+#       * the voting-age fraction: VOTING_FRACTION times a lognormal error
+#         with log-sd VOTING_FRACTION_LOG_SD (one national draw, shared by
+#         every district in that draw),
+#
+# and recomputes the turnout of every district. For each district, we
+# report the probability that its turnout exceeds 100%, along with
+# percentiles of its turnout distribution. The error sizes are assumptions
+# rather than published figures.
+#
+# Draws are done in batches of BATCH_SIZE, each one a (draws, districts)
+# array, and the batches are spread over a process pool. Each batch has its
+# own seed, so the results don't depend on the number of processes.
+#
+# Command-line arguments (optional, in this order):
+#       * Election ("Runoff" or "FirstRound"); default "Runoff".
+#       * Number of draws; default NUM_DRAWS.
+#       * Number of worker processes; default is the number of CPUs.
+#
+# Inputs:
+#       * The inputs of summary_cube.py
+#
+# Outputs:
+#       * ../clean_data/turnout_exceedance_<election>.csv - For each
+#         district, its point turnout, the probability that its turnout is
+#         over 100%, and the 5th, 50th and 95th percentiles of its turnout,
+#         sorted by that probability (highest first).
+#
+
+
+import sys
+import csv
+import time
+import multiprocessing
+import numpy as np
+
+# Import some convenience functions
+from summary_cube import ELECTIONS, getSummaryCube, getCubeDistrictTurnouts
+
+
+# Constants
+
+# VALUES
+from afghan_constants import VOTING_FRACTION
+
+# The log-sd of the (multiplicative) error in each district's population.
+POPULATION_LOG_SD = 0.1
+
+# The log-sd of the (multiplicative) error in the national voting-age
+# fraction.
+VOTING_FRACTION_LOG_SD = 0.05
+
+# Populations are published in thousands, with one decimal place.
+POPULATION_ROUNDING = 100.0
+
+# The default number of draws, and the number of draws per batch.
+NUM_DRAWS = 100000
+BATCH_SIZE = 2000
+
+# Turnout percentiles are read off a histogram of each district's sampled
+# turnouts, with these bin edges (in %). Turnouts past the last edge are
+# counted in the last bin.
+TURNOUT_BIN_EDGES = np.linspace(0.0, 2000.0, 4001)
+
+# The percentiles to report.
+PERCENTILES = [5, 50, 95]
+
+# The seed for the first batch (batch i uses RANDOM_SEED + i), so results
+# are reproducible.
+RANDOM_SEED = 2014
+
+# DIRECTORIES
+CLEAN_DATA_DIR = "../clean_data/"
+
+
+# This function simulates one batch of draws. "batch" is a (batch index,
+# number of draws, district votes, district populations) tuple. It returns
+# the number of draws in which each district's turnout was over 100%, and
+# a (districts, turnout bins) array of turnout histogram counts.
+#
+def simulateBatch(batch):
+    batchIndex, numDraws, votes, pops = batch
+    randomState = np.random.RandomState(RANDOM_SEED + batchIndex)
+    numDistricts = len(pops)
+
+    sampledPops = (pops + POPULATION_ROUNDING *
+                   randomState.uniform(-0.5, 0.5, (numDraws, numDistricts)))
+    sampledPops *= np.exp(POPULATION_LOG_SD *
+                          randomState.standard_normal((numDraws,
+                                                       numDistricts)))
+    sampledFractions = VOTING_FRACTION * np.exp(VOTING_FRACTION_LOG_SD *
+            randomState.standard_normal((numDraws, 1)))
+
+    turnouts = 100.0 * votes / (sampledPops * sampledFractions)
+    numOver100 = (turnouts > 100.0).sum(axis = 0)
+
+    # One bincount over (district, bin) pairs for the whole batch. The
+    # bins are equal-width, so no search is needed.
+    numBins = len(TURNOUT_BIN_EDGES) - 1
+    binWidth = TURNOUT_BIN_EDGES[1] - TURNOUT_BIN_EDGES[0]
+    bins = np.minimum(((turnouts - TURNOUT_BIN_EDGES[0]) / binWidth)
+                      .astype(np.int64), numBins - 1)
+    bins += numBins * np.arange(numDistricts)
+    histogram = np.bincount(bins.ravel(), minlength = numDistricts *
+                            numBins).reshape(numDistricts, numBins)
+
+    return numOver100, histogram
+
+
+# This function returns the given percentiles (in %) of each row of a
+# (districts, bins) histogram. Each one is found in the bin where the
+# cumulative count first reaches it, by interpolating linearly between
+# that bin's edges (as if its turnouts were spread evenly across it).
+#
+def getHistogramPercentiles(histogram, percentiles):
+    numBins = len(TURNOUT_BIN_EDGES) - 1
+    binWidth = TURNOUT_BIN_EDGES[1] - TURNOUT_BIN_EDGES[0]
+    cumulative = np.cumsum(histogram, axis = 1)
+    totals = cumulative[:, -1]
+    rows = np.arange(len(histogram))
+    results = list()
+
+    for percentile in percentiles:
+        targets = totals * percentile / 100.0
+        bins = np.minimum((cumulative < targets[:, None]).sum(axis = 1),
+                          numBins - 1)
+        counts = histogram[rows, bins]
+        below = cumulative[rows, bins] - counts
+        fractions = (targets - below) / np.maximum(counts, 1)
+        results.append(TURNOUT_BIN_EDGES[bins] +
+                       np.clip(fractions, 0.0, 1.0) * binWidth)
+
+    return results
+
+
+# This function runs the Monte Carlo for an election's districts (those
+# with a known population and at least one vote). It returns a dictionary
+# with the "DistrictIds", "Provinces", "PointTurnout",
+# "ProbabilityOver100" and one "Percentile<p>" entry per PERCENTILES.
+#
+def getTurnoutExceedance(election, numDraws = NUM_DRAWS,
+                         numProcesses = None):
+    cube = getSummaryCube(election)
+    known = (np.nan_to_num(cube["Population"]) > 0) & \
+            (cube["DistrictVotes"] > 0)
+    votes = cube["DistrictVotes"][known]
+    pops = cube["Population"][known]
+
+    batches = [(i, min(BATCH_SIZE, numDraws - start), votes, pops)
+               for i, start in enumerate(range(0, numDraws, BATCH_SIZE))]
+
+    if numProcesses == None:
+        numProcesses = multiprocessing.cpu_count()
+
+    if numProcesses > 1:
+        pool = multiprocessing.Pool(numProcesses)
+
+        try:
+            batchResults = pool.map(simulateBatch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        batchResults = [simulateBatch(batch) for batch in batches]
+
+    numOver100 = sum(result[0] for result in batchResults)
+    histogram = sum(result[1] for result in batchResults)
+
+    results = dict()
+    results["DistrictIds"] = cube["DistrictIds"][known]
+    results["Provinces"] = cube["Provinces"][known]
+    results["PointTurnout"] = getCubeDistrictTurnouts(cube)[known]
+    results["ProbabilityOver100"] = numOver100 / float(numDraws)
+
+    for percentile, values in zip(PERCENTILES, getHistogramPercentiles(
+            histogram, PERCENTILES)):
+        results["Percentile" + str(percentile)] = values
+
+    return results
+
+
+# Main code
+if __name__ == "__main__":
+    election = "Runoff"
+    numDraws = NUM_DRAWS
+    numProcesses = None
+
+    if len(sys.argv) > 1:
+        election = sys.argv[1].strip()
+
+    if election not in ELECTIONS:
+        print("usage: " + sys.argv[0] + " [Runoff|FirstRound] [draws] "
+              "[processes]")
+        sys.exit(1)
+
+    if len(sys.argv) > 2:
+        numDraws = int(sys.argv[2])
+
+    if len(sys.argv) > 3:
+        numProcesses = int(sys.argv[3])
+
+    startTime = time.time()
+    results = getTurnoutExceedance(election, numDraws, numProcesses)
+    elapsed = time.time() - startTime
+
+    columns = ["DistrictIds", "Provinces", "PointTurnout",
+               "ProbabilityOver100"] + ["Percentile" + str(percentile)
+                                        for percentile in PERCENTILES]
+    order = np.argsort(-results["ProbabilityOver100"], kind = 'mergesort')
+
+    outputFile = CLEAN_DATA_DIR + "turnout_exceedance_" + \
+            ("first_round" if election == "FirstRound" else "runoff") + ".csv"
+
+    with open(outputFile, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["DistrictId", "Province", "PointTurnout",
+                            "ProbabilityOver100"] +
+                           ["TurnoutP" + str(percentile)
+                            for percentile in PERCENTILES])
+        csvWriter.writerows(zip(*[results[column][order]
+                                  for column in columns]))
+
+    probabilities = results["ProbabilityOver100"]
+    pointOver100 = results["PointTurnout"] > 100.0
+
+    print(str(numDraws) + " draws over " + str(len(probabilities)) +\
+          " " + election + " districts took " + ("%.2f" % elapsed) + " s")
+    print(str(pointOver100.sum()) + " districts have a point turnout " +\
+          "over 100%; " + str((probabilities > 0.95).sum()) + " are over " +\
+          "100% with probability > 0.95, and " +\
+          str(((probabilities > 0.05) & ~pointOver100).sum()) + " more " +\
+          "have a probability > 0.05")
+    print("Saved turnout exceedance probabilities to\n" + outputFile)
@@ -18,14 +18,18 @@
 #
 
 
-import csv
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import linregress
+from lazy_imports import lazyImport, lazyFunction
 
 # Import convenience functions
 from afghan_functions import *
 from turnout_distrib import getProvinceDistrictToRunoffTurnout
+from figure_cache import getFigureHash, isFigureCurrent, saveFigure
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+linregress = lazyFunction("scipy.stats", "linregress")
 
 
 # Constants
@@ -59,25 +63,6 @@ GHANI_V_OVER_E_VS_T_RESID = FIGURE_DIR +\
         "runoff_ghani_v_over_e_vs_t_resid.png"
 
 
-# Global variables
-
-# Dicts to track district-level data (cached to avoid regeneration).
-provinceDistrictToPop = None
-
-
-# This function populates a dictionary that maps (Province, District)
-# tuples to their populations.
-#
-def populateProvinceDistrictToPop():
-    global provinceDistrictToPop
-
-    # If it's already populated, just return.
-    if provinceDistrictToPop != None:
-        return
-
-    provinceDistrictToPop = getProvinceDistrictToPop()
-
-
 # This function takes a candidate (either "Abdullah" or "Ghani") and
 # returns a mapping from (Province, District) tuples to the V/E for that
 # candidate in that district. Note that the V/E is expressed as a
@@ -88,8 +73,7 @@ def getProvinceDistrictToVOverE(candidate):
         raise ValueError("The input candidate " + candidate + " was " +\
                 "neither Abdullah nor Ghani!")
 
-    global provinceDistrictToPop
-    populateProvinceDistrictToPop()
+    provinceDistrictToPop = populateProvinceDistrictToPop()
 
     # Set the column to look at in the CSV.
     voteColumn = "GhaniVotes"
@@ -102,28 +86,25 @@ def getProvinceDistrictToVOverE(candidate):
     # (which is the district population times VOTING_FRACTION).
     provinceDistrictToCandidateVOverE = dict()
 
-    with open(RUNOFF_VOTES_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+    for row in getCsvRows(RUNOFF_VOTES_FILE):
+        provinceName = row['Province']
+        districtName = row['District']
+        candidateVotes = float(row[voteColumn])
 
-        for row in csvReader:
-            provinceName = row['Province']
-            districtName = row['District']
-            candidateVotes = float(row[voteColumn])
+        districtPop = provinceDistrictToPop[(provinceName,
+                                             districtName)]
 
-            districtPop = provinceDistrictToPop[(provinceName,
-                                                 districtName)]
+        if (provinceName, districtName) in \
+                provinceDistrictToCandidateVOverE:
 
-            if (provinceName, districtName) in \
-                    provinceDistrictToCandidateVOverE:
+            provinceDistrictToCandidateVOverE[\
+                    (provinceName, districtName)] += 100.0 *\
+                    candidateVotes / (VOTING_FRACTION * districtPop)
 
-                provinceDistrictToCandidateVOverE[\
-                        (provinceName, districtName)] += 100.0 *\
-                        candidateVotes / (VOTING_FRACTION * districtPop)
-
-            else:
-                provinceDistrictToCandidateVOverE[\
-                        (provinceName, districtName)] = 100.0 *\
-                        candidateVotes / (VOTING_FRACTION * districtPop)
+        else:
+            provinceDistrictToCandidateVOverE[\
+                    (provinceName, districtName)] = 100.0 *\
+                    candidateVotes / (VOTING_FRACTION * districtPop)
 
     return provinceDistrictToCandidateVOverE
 
@@ -178,50 +159,67 @@ def plotVOverEVsT(candidate,
     # Get the residuals
     residValues = yValues - (slope * xValues + intercept)
 
-    # Plot V/E vs T with the linear fit, as well as y = x for reference.
-    fig = plt.figure()
-    fig.set_facecolor('white')
-    plt.scatter(xValues, yValues, color = plotColor, s = 20)
-    plt.plot(xValuesFitLine, yValuesFitLine, 'k', lw=1.5)
-    plt.plot([0.0, 300.0], [0.0, 300.0], 'k--')
-    plt.xlim([0.0, 200.0])
-    plt.ylim([0.0, 200.0])
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("V/E for " + candidate)
-    plt.title(plotTitle)
-
-    # Include the fitted line's equation and r^2. Format the equation
-    # correctly depending on the intercept's sign.
-    if intercept >= 0:
-        plt.text(30.0, 150.0, r"$V/E \,= \," + str(slope)[0:6] + "T \,+\, " +\
-                 str(intercept)[0:6] + r"$")
+    # Hash everything that each figure is drawn from, so that unchanged
+    # figures aren't redrawn (see figure_cache.py).
+    plotHash = getFigureHash(plotVOverEVsT, "Fit", candidate, xValues,
+            yValues, plotTitle, plotColor)
+    residPlotHash = getFigureHash(plotVOverEVsT, "Residuals", candidate,
+            xValues, yValues, residPlotTitle, plotColor)
+
+    if isFigureCurrent(plotSaveFile, plotHash):
+        print("V/E vs T plot for " + candidate + " in " + plotSaveFile +\
+              " is up to date")
+    else:
+        # Plot V/E vs T with the linear fit, as well as y = x for reference.
+        fig = plt.figure()
+        fig.set_facecolor('white')
+        plt.scatter(xValues, yValues, color = plotColor, s = 20)
+        plt.plot(xValuesFitLine, yValuesFitLine, 'k', lw=1.5)
+        plt.plot([0.0, 300.0], [0.0, 300.0], 'k--')
+        plt.xlim([0.0, 200.0])
+        plt.ylim([0.0, 200.0])
+        plt.xlabel("Turnout Percentage")
+        plt.ylabel("V/E for " + candidate)
+        plt.title(plotTitle)
+
+        # Include the fitted line's equation and r^2. Format the equation
+        # correctly depending on the intercept's sign.
+        if intercept >= 0:
+            plt.text(30.0, 150.0, r"$V/E \,= \," + str(slope)[0:6] +\
+                     "T \,+\, " + str(intercept)[0:6] + r"$")
+        else:
+            plt.text(30.0, 150.0, r"$V/E \,= \," + str(slope)[0:6] +\
+                     "T \,-\, " + str(abs(intercept))[0:6] + r"$")
+
+        plt.text(30.0, 137.0, r"$r^2 = \," + str(rValue**2.0)[0:6] + r"$")
+
+        # Save to file and inform the user.
+        saveFigure(plotSaveFile, plotHash, bbox_inches = "tight")
+        plt.close()
+        print("Saved V/E vs T plot for " + candidate + " to\n" +\
+              plotSaveFile)
+
+    if isFigureCurrent(residPlotSaveFile, residPlotHash):
+        print("V/E vs T residual plot for " + candidate + " in " +\
+              residPlotSaveFile + " is up to date\n")
     else:
-        plt.text(30.0, 150.0, r"$V/E \,= \," + str(slope)[0:6] + "T \,-\, " +\
-                 str(abs(intercept))[0:6] + r"$")
-
-    plt.text(30.0, 137.0, r"$r^2 = \," + str(rValue**2.0)[0:6] + r"$")
-
-    # Save to file and inform the user.
-    plt.savefig(plotSaveFile, bbox_inches = "tight")
-    plt.close()
-    print "Saved V/E vs T plot for", candidate, "to\n", plotSaveFile
-
-    # Plot the residual plot, with a flat line at y = 0 for reference.
-    fig = plt.figure()
-    fig.set_facecolor('white')
-    plt.scatter(xValues, residValues, color = plotColor, s = 20)
-    plt.plot([0.0, 250.0], [0.0, 0.0], 'k--')
-    plt.xlim([0.0, 200.0])
-    plt.ylim([-100.0, 100.0])
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("Residual V/E")
-    plt.title(residPlotTitle)
-
-    # Save to file and inform the user.
-    plt.savefig(residPlotSaveFile, bbox_inches = "tight")
-    plt.close()
-    print "Saved V/E vs T residual plot for", candidate, "to\n",\
-            residPlotSaveFile, "\n"
+        # Plot the residual plot, with a flat line at y = 0 for reference.
+        fig = plt.figure()
+        fig.set_facecolor('white')
+        plt.scatter(xValues, residValues, color = plotColor, s = 20)
+        plt.plot([0.0, 250.0], [0.0, 0.0], 'k--')
+        plt.xlim([0.0, 200.0])
+        plt.ylim([-100.0, 100.0])
+        plt.xlabel("Turnout Percentage")
+        plt.ylabel("Residual V/E")
+        plt.title(residPlotTitle)
+
+        # Save to file and inform the user.
+        saveFigure(residPlotSaveFile, residPlotHash,
+                   bbox_inches = "tight")
+        plt.close()
+        print("Saved V/E vs T residual plot for " + candidate + " to\n" +\
+              residPlotSaveFile + "\n")
 
 
 # Main code
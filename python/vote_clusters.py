@@ -0,0 +1,418 @@
+# Description: Clusters polling stations and districts by their first round
+# vote profile (the share of the votes that each of the 11 candidates got),
+# to find voting blocs, and flags the stations whose runoff result departs
+# from that of their bloc.
+#
+#       * Stations are clustered with mini-batch k-means: the centers are
+#         seeded with k-means++ on a sample of the stations, and then
+#         updated from random batches of BATCH_SIZE stations (each center
+#         moves towards its batch members at a rate of 1 / the number of
+#         stations it has been given so far). Distances are computed for a
+#         whole batch (or, when labeling every station, for a chunk of
+#         CHUNK_SIZE stations) at once, as |x|^2 - 2 x.c + |c|^2, so the
+#         working memory doesn't grow with the number of stations.
+#       * Districts (whose vote profiles are the sums over their stations)
+#         are clustered hierarchically, with Ward linkage.
+#
+# Each cluster is labeled with the candidates that got at least
+# BLOC_SHARE_THRESHOLD of the votes at its center (e.g. "Abdullah/Ghani").
+# A station departs from its bloc if its runoff vote share for Ghani is
+# more than DEPARTURE_THRESHOLD robust standard deviations (1.4826 times
+# the median absolute deviation) from the median of its bloc's stations.
+#
+# Inputs:
+#       * ../clean_data/first_round_votes.csv
+#       * ../raw_data/raw_votes_runoff.csv
+#
+# Outputs:
+#       * ../analysis_output/station_blocs.csv - Each station cluster's
+#         label, size and center.
+#       * ../analysis_output/district_blocs.csv - Each district's cluster
+#         and label.
+#       * ../analysis_output/departing_stations.csv - The stations whose
+#         runoff result departs from their bloc, by how much.
+#       * stdout - A summary of the blocs.
+#
+
+
+import os
+import csv
+import numpy as np
+from lazy_imports import lazyFunction
+
+# Import some convenience functions
+from afghan_functions import getStationColumns, pcNumbersToDistrictIds,\
+        sumByKey
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+linkage = lazyFunction("scipy.cluster.hierarchy", "linkage")
+fcluster = lazyFunction("scipy.cluster.hierarchy", "fcluster")
+
+
+# Constants
+
+# VALUES
+from summary_cube import FIRST_ROUND_CANDIDATES
+
+# The short name of each first round candidate (in the order of
+# FIRST_ROUND_CANDIDATES).
+CANDIDATE_NAMES = ["Hilal", "Abdullah", "Rassoul", "Wardak", "Karzai",
+                   "Sayyaf", "Ghani", "Sultanzoy", "Sherzai", "Naeem",
+                   "Arsala"]
+
+# The runoff candidate columns.
+RUNOFF_CANDIDATES = ["Abdullah", "Ghani"]
+
+# The number of station clusters, and of district clusters.
+NUM_STATION_CLUSTERS = 8
+NUM_DISTRICT_CLUSTERS = 6
+
+# Mini-batch k-means parameters: the number of stations that the centers
+# are seeded from, the batch size, the number of batches, and the number of
+# stations whose distances are computed at once when labeling.
+INIT_SAMPLE_SIZE = 10000
+BATCH_SIZE = 1024
+NUM_BATCHES = 300
+CHUNK_SIZE = 65536
+
+# The seed of the random number generator (so the clusters are
+# reproducible).
+RANDOM_SEED = 0
+
+# A candidate is part of a bloc's label if they got at least this share of
+# the votes at the bloc's center.
+BLOC_SHARE_THRESHOLD = 0.2
+
+# The number of robust standard deviations from its bloc's median at which
+# a station's runoff result departs from its bloc.
+DEPARTURE_THRESHOLD = 3.0
+
+# The ratio of a normal distribution's standard deviation to its median
+# absolute deviation.
+MAD_TO_STD = 1.4826
+
+# DIRECTORIES
+RAW_DATA_DIR = "../raw_data/"
+CLEAN_DATA_DIR = "../clean_data/"
+OUTPUT_DIR = "../analysis_output/"
+
+# INPUT FILES
+
+# CSV file for first round votes (by polling station).
+FIRST_ROUND_VOTES_FILE = CLEAN_DATA_DIR + "first_round_votes.csv"
+
+# CSV file for runoff votes (by polling station).
+RUNOFF_VOTES_POLLING_STATION_FILE = RAW_DATA_DIR + "raw_votes_runoff.csv"
+
+# OUTPUT FILES
+
+# Each station cluster's label, size and center.
+STATION_BLOCS_FILE = OUTPUT_DIR + "station_blocs.csv"
+
+# Each district's cluster and label.
+DISTRICT_BLOCS_FILE = OUTPUT_DIR + "district_blocs.csv"
+
+# The stations whose runoff result departs from their bloc.
+DEPARTING_STATIONS_FILE = OUTPUT_DIR + "departing_stations.csv"
+
+
+# This function reads a polling station vote file. It returns the PC and PS
+# numbers of its stations, and an (N, candidates) array of their votes.
+# The file is read as typed columns (see getStationColumns(), which leaves
+# out the stations that aren't assigned to a province), so memory only
+# grows by a few numbers per station.
+#
+def readStationVotes(votesFile, candidates):
+    columns = getStationColumns(votesFile)
+    votes = np.zeros((len(columns['PC_number']), len(candidates)))
+
+    for i, candidate in enumerate(candidates):
+        votes[:, i] = columns[candidate]
+
+    return columns['PC_number'].astype(np.int64),\
+            columns['PS_number'].astype(np.int64), votes
+
+
+
+# This function returns each row's share of its row total. Rows with no
+# votes get all-zero shares.
+#
+def toShares(votes):
+    totals = votes.sum(axis = 1)[:, None]
+
+    return np.where(totals > 0, votes / np.maximum(totals, 1.0), 0.0)
+
+
+# This function returns the squared distance from each point to each
+# center, as a (points, centers) array.
+#
+def getSquaredDistances(points, centers):
+    distances = (points**2).sum(axis = 1)[:, None] - \
+            2.0 * np.dot(points, centers.T) + (centers**2).sum(axis = 1)
+
+    return np.maximum(distances, 0.0)
+
+
+# This function returns the index of each point's nearest center, and the
+# squared distance to it. The points are processed CHUNK_SIZE at a time.
+#
+def assignClusters(points, centers, chunkSize = CHUNK_SIZE):
+    labels = np.zeros(len(points), dtype = np.int64)
+    distances = np.zeros(len(points))
+
+    for start in range(0, len(points), chunkSize):
+        chunkDistances = getSquaredDistances(points[start:start + chunkSize],
+                                             centers)
+        labels[start:start + chunkSize] = np.argmin(chunkDistances, axis = 1)
+        distances[start:start + chunkSize] = chunkDistances.min(axis = 1)
+
+    return labels, distances
+
+
+# This function picks numClusters initial centers from the points with
+# k-means++ (each new center is a point picked with probability
+# proportional to its squared distance from the nearest center so far).
+#
+def seedCenters(points, numClusters, randomState):
+    centers = [points[randomState.randint(len(points))]]
+    distances = getSquaredDistances(points, np.array(centers))[:, 0]
+
+    for i in range(1, numClusters):
+        if distances.sum() > 0:
+            probabilities = distances / distances.sum()
+        else:
+            probabilities = np.ones(len(points)) / len(points)
+
+        centers.append(points[randomState.choice(len(points),
+                                                 p = probabilities)])
+        distances = np.minimum(distances, getSquaredDistances(points,
+                np.array(centers[-1:]))[:, 0])
+
+    return np.array(centers)
+
+
+# This function clusters the points (one per row) with mini-batch k-means,
+# and returns the (numClusters, columns) array of centers.
+#
+def miniBatchKMeans(points, numClusters, batchSize = BATCH_SIZE,
+                    numBatches = NUM_BATCHES, seed = RANDOM_SEED):
+    randomState = np.random.RandomState(seed)
+
+    sample = points[randomState.choice(len(points),
+            min(INIT_SAMPLE_SIZE, len(points)), replace = False)]
+    centers = seedCenters(sample, numClusters, randomState)
+    centerCounts = np.zeros(numClusters)
+
+    for i in range(numBatches):
+        batch = points[randomState.randint(len(points), size = batchSize)]
+        labels = np.argmin(getSquaredDistances(batch, centers), axis = 1)
+
+        # Move each center towards the mean of its batch members. Over all
+        # of the batches, a center ends up at the mean of every point it
+        # was given.
+        batchCounts = np.bincount(labels, minlength = numClusters)
+        batchSums = np.zeros(centers.shape)
+        np.add.at(batchSums, labels, batch)
+
+        centerCounts += batchCounts
+        hasMembers = batchCounts > 0
+        rates = batchCounts[hasMembers] / centerCounts[hasMembers]
+        centers[hasMembers] += rates[:, None] * (batchSums[hasMembers] /
+                batchCounts[hasMembers][:, None] - centers[hasMembers])
+
+    return centers
+
+
+# This function clusters the points hierarchically (with Ward linkage), and
+# returns each point's cluster (numbered from 0).
+#
+def clusterHierarchically(points, numClusters):
+    return fcluster(linkage(points, method = 'ward'), numClusters,
+                    criterion = 'maxclust') - 1
+
+
+# This function returns the label of each cluster center: the names of the
+# candidates with at least BLOC_SHARE_THRESHOLD of its votes, largest
+# first (or just the largest, if nobody has that much).
+#
+def getBlocLabels(centers):
+    labels = list()
+
+    for center in centers:
+        order = np.argsort(-center, kind = 'mergesort')
+        names = [CANDIDATE_NAMES[i] for i in order
+                 if center[i] >= BLOC_SHARE_THRESHOLD]
+
+        labels.append("/".join(names or [CANDIDATE_NAMES[order[0]]]))
+
+    return labels
+
+
+# This function returns, for each of the given stations, the index of the
+# same (PC_number, PS_number) station among the other stations, or -1 if
+# it isn't there. If a key is repeated, its first station is used.
+#
+def matchStations(pcNumbers, psNumbers, otherPcNumbers, otherPsNumbers):
+    psRange = max(psNumbers.max(), otherPsNumbers.max()) + 1
+    keys = pcNumbers * psRange + psNumbers
+    otherKeys, firstRows = np.unique(otherPcNumbers * psRange +
+                                     otherPsNumbers, return_index = True)
+
+    positions = np.minimum(np.searchsorted(otherKeys, keys),
+                           len(otherKeys) - 1)
+
+    return np.where(otherKeys[positions] == keys, firstRows[positions], -1)
+
+
+# This function returns each value's robust z-score within its group: its
+# distance from the group's median, in units of MAD_TO_STD times the
+# group's median absolute deviation. Values in groups with no spread get
+# a score of 0. NaN values get NaN scores.
+#
+def getRobustScores(values, groups, numGroups):
+    scores = np.full(len(values), np.nan)
+
+    for group in range(numGroups):
+        inGroup = (groups == group) & np.isfinite(values)
+
+        if not inGroup.any():
+            continue
+
+        median = np.median(values[inGroup])
+        spread = MAD_TO_STD * np.median(np.abs(values[inGroup] - median))
+        scores[inGroup] = (values[inGroup] - median) / spread \
+                if spread > 0 else 0.0
+
+    return scores
+
+
+# This function returns the station blocs: a dictionary with the first
+# round stations' "PCNumbers", "PSNumbers", "DistrictIds", "Shares" and
+# "Labels" (their cluster), the clusters' "Centers" and "BlocNames", and
+# the stations' "RunoffShares" (Ghani's share of the runoff vote, NaN if
+# the station isn't in the runoff file) and "DepartureScores" (the robust
+# z-score of that share within the station's bloc).
+#
+def getStationBlocs(numClusters = NUM_STATION_CLUSTERS):
+    pcNumbers, psNumbers, votes = readStationVotes(FIRST_ROUND_VOTES_FILE,
+                                                   FIRST_ROUND_CANDIDATES)
+    hasVotes = votes.sum(axis = 1) > 0
+    pcNumbers = pcNumbers[hasVotes]
+    psNumbers = psNumbers[hasVotes]
+    shares = toShares(votes[hasVotes])
+
+    centers = miniBatchKMeans(shares, numClusters)
+    labels, distances = assignClusters(shares, centers)
+
+    runoffPcNumbers, runoffPsNumbers, runoffVotes = readStationVotes(
+            RUNOFF_VOTES_POLLING_STATION_FILE, RUNOFF_CANDIDATES)
+    runoffRows = matchStations(pcNumbers, psNumbers, runoffPcNumbers,
+                               runoffPsNumbers)
+    runoffShares = np.full(len(pcNumbers), np.nan)
+    matched = runoffRows >= 0
+    matchedVotes = runoffVotes[runoffRows[matched]]
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        runoffShares[matched] = matchedVotes[:, 1] / \
+                matchedVotes.sum(axis = 1)
+
+    return {
+        "PCNumbers": pcNumbers,
+        "PSNumbers": psNumbers,
+        "DistrictIds": pcNumbersToDistrictIds(pcNumbers),
+        "Shares": shares,
+        "Labels": labels,
+        "Centers": centers,
+        "BlocNames": getBlocLabels(centers),
+        "RunoffShares": runoffShares,
+        "DepartureScores": getRobustScores(runoffShares, labels,
+                                           numClusters),
+    }
+
+
+# This function returns the district blocs: the IEC district IDs, their
+# vote shares, their cluster (from hierarchical clustering), and the
+# clusters' labels and centers.
+#
+def getDistrictBlocs(numClusters = NUM_DISTRICT_CLUSTERS):
+    pcNumbers, psNumbers, votes = readStationVotes(FIRST_ROUND_VOTES_FILE,
+                                                   FIRST_ROUND_CANDIDATES)
+    districtIds, districtVotes = sumByKey(pcNumbersToDistrictIds(pcNumbers),
+                                          votes)
+    shares = toShares(districtVotes)
+    labels = clusterHierarchically(shares, numClusters)
+
+    numLabels = labels.max() + 1
+    centers = np.array([shares[labels == i].mean(axis = 0)
+                        for i in range(numLabels)])
+
+    return districtIds, shares, labels, centers, getBlocLabels(centers)
+
+
+# Main code
+if __name__ == "__main__":
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    stationBlocs = getStationBlocs()
+    labels = stationBlocs["Labels"]
+    scores = stationBlocs["DepartureScores"]
+
+    with open(STATION_BLOCS_FILE, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["Cluster", "Bloc", "Stations",
+                            "MedianRunoffGhaniShare"] + CANDIDATE_NAMES)
+
+        for i, center in enumerate(stationBlocs["Centers"]):
+            runoffShares = stationBlocs["RunoffShares"][labels == i]
+            runoffShares = runoffShares[np.isfinite(runoffShares)]
+            csvWriter.writerow([i, stationBlocs["BlocNames"][i],
+                    np.sum(labels == i), np.median(runoffShares)
+                    if len(runoffShares) else ""] + center.tolist())
+
+    print("Station blocs (saved to " + STATION_BLOCS_FILE + "):")
+
+    for i, blocName in enumerate(stationBlocs["BlocNames"]):
+        print("    " + str(i) + ". " + blocName.ljust(24) +\
+              str(np.sum(labels == i)).rjust(6) + " stations")
+
+    # The departing stations, most departing first.
+    with np.errstate(invalid = 'ignore'):
+        departing = np.nonzero(np.abs(scores) > DEPARTURE_THRESHOLD)[0]
+
+    departing = departing[np.argsort(-np.abs(scores[departing]),
+                                     kind = 'mergesort')]
+
+    with open(DEPARTING_STATIONS_FILE, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["PC_number", "PS_number", "Cluster", "Bloc",
+                            "RunoffGhaniShare", "DepartureScore"])
+
+        for i in departing:
+            csvWriter.writerow([stationBlocs["PCNumbers"][i],
+                                stationBlocs["PSNumbers"][i], labels[i],
+                                stationBlocs["BlocNames"][labels[i]],
+                                stationBlocs["RunoffShares"][i], scores[i]])
+
+    print(str(len(departing)) + " stations depart from their bloc in the" +\
+          " runoff (saved to " + DEPARTING_STATIONS_FILE + ")")
+
+    districtIds, shares, districtLabels, centers, blocNames = \
+            getDistrictBlocs()
+
+    with open(DISTRICT_BLOCS_FILE, "w") as csvFile:
+        csvWriter = csv.writer(csvFile)
+        csvWriter.writerow(["DistrictId", "Cluster", "Bloc"] +\
+                           CANDIDATE_NAMES)
+
+        for districtId, districtShares, label in zip(districtIds, shares,
+                                                     districtLabels):
+            csvWriter.writerow([districtId, label, blocNames[label]] +\
+                               districtShares.tolist())
+
+    print("District blocs (saved to " + DISTRICT_BLOCS_FILE + "):")
+
+    for i, blocName in enumerate(blocNames):
+        print("    " + str(i) + ". " + blocName.ljust(24) +\
+              str(np.sum(districtLabels == i)).rjust(6) + " districts")
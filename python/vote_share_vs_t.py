@@ -22,14 +22,18 @@
 #
 
 
-import csv
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import linregress
+from lazy_imports import lazyImport, lazyFunction
 
 # Import convenience functions
 from afghan_functions import *
 from turnout_distrib import getProvinceDistrictToRunoffTurnout
+from figure_cache import getFigureHash, isFigureCurrent, saveFigure
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
+linregress = lazyFunction("scipy.stats", "linregress")
 
 
 # Constants
@@ -89,28 +93,25 @@ def getProvinceDistrictToVoteShare(candidate):
     provinceDistrictToCandidateVotes = dict()
     provinceDistrictToTotalVotes = dict()
 
-    with open(RUNOFF_VOTES_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province']
-            districtName = row['District']
-            candidateVotes = float(row[voteColumn])
-            totalVotes = float(row['PopulationVoted'])
+    for row in getCsvRows(RUNOFF_VOTES_FILE):
+        provinceName = row['Province']
+        districtName = row['District']
+        candidateVotes = float(row[voteColumn])
+        totalVotes = float(row['PopulationVoted'])
 
-            if (provinceName, districtName) in \
-                    provinceDistrictToCandidateVotes:
+        if (provinceName, districtName) in \
+                provinceDistrictToCandidateVotes:
 
-                provinceDistrictToCandidateVotes[\
-                        (provinceName, districtName)] += candidateVotes
-                provinceDistrictToTotalVotes[\
-                        (provinceName, districtName)] += totalVotes
+            provinceDistrictToCandidateVotes[\
+                    (provinceName, districtName)] += candidateVotes
+            provinceDistrictToTotalVotes[\
+                    (provinceName, districtName)] += totalVotes
 
-            else:
-                provinceDistrictToCandidateVotes[\
-                        (provinceName, districtName)] = candidateVotes
-                provinceDistrictToTotalVotes[\
-                        (provinceName, districtName)] = totalVotes
+        else:
+            provinceDistrictToCandidateVotes[\
+                    (provinceName, districtName)] = candidateVotes
+            provinceDistrictToTotalVotes[\
+                    (provinceName, districtName)] = totalVotes
 
     # Sanity check: both dictionaries should have the same keys.
     assert sorted(provinceDistrictToCandidateVotes.keys()) == \
@@ -180,49 +181,66 @@ def plotVoteShareVsT(candidate,
     # Get the residuals
     residValues = yValues - (slope * xValues + intercept)
 
-    # Plot vote share vs T with the linear fit.
-    fig = plt.figure()
-    fig.set_facecolor('white')
-    plt.scatter(xValues, yValues, color = plotColor, s = 20)
-    plt.plot(xValuesFitLine, yValuesFitLine, 'k', lw=1.5)
-    plt.xlim([0.0, 200.0])
-    plt.ylim([0.0, 100.0])
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("Vote Share for " + candidate)
-    plt.title(plotTitle)
-
-    # Include the fitted line's equation and r^2. Format the equation
-    # correctly depending on the intercept's sign.
-    if intercept >= 0:
-        plt.text(115.0, 28.0, r"$VS \,= \," + str(slope)[0:6] +\
-                 "T \,+\, " + str(intercept)[0:6] + r"$")
+    # Hash everything that each figure is drawn from, so that unchanged
+    # figures aren't redrawn (see figure_cache.py).
+    plotHash = getFigureHash(plotVoteShareVsT, "Fit", candidate, xValues,
+            yValues, plotTitle, plotColor)
+    residPlotHash = getFigureHash(plotVoteShareVsT, "Residuals", candidate,
+            xValues, yValues, residPlotTitle, plotColor)
+
+    if isFigureCurrent(plotSaveFile, plotHash):
+        print("VS vs T plot for " + candidate + " in " + plotSaveFile +\
+              " is up to date")
+    else:
+        # Plot vote share vs T with the linear fit.
+        fig = plt.figure()
+        fig.set_facecolor('white')
+        plt.scatter(xValues, yValues, color = plotColor, s = 20)
+        plt.plot(xValuesFitLine, yValuesFitLine, 'k', lw=1.5)
+        plt.xlim([0.0, 200.0])
+        plt.ylim([0.0, 100.0])
+        plt.xlabel("Turnout Percentage")
+        plt.ylabel("Vote Share for " + candidate)
+        plt.title(plotTitle)
+
+        # Include the fitted line's equation and r^2. Format the equation
+        # correctly depending on the intercept's sign.
+        if intercept >= 0:
+            plt.text(115.0, 28.0, r"$VS \,= \," + str(slope)[0:6] +\
+                     "T \,+\, " + str(intercept)[0:6] + r"$")
+        else:
+            plt.text(115.0, 28.0, r"$VS \,= \," + str(slope)[0:6] +\
+                     "T \,-\, " + str(abs(intercept))[0:6] + r"$")
+
+        plt.text(115.0, 23.0, r"$r^2 = \," + str(rValue**2.0)[0:6] + r"$")
+
+        # Save to file and inform the user.
+        saveFigure(plotSaveFile, plotHash, bbox_inches = "tight")
+        plt.close()
+        print("Saved VS vs T plot for " + candidate + " to\n" +\
+              plotSaveFile)
+
+    if isFigureCurrent(residPlotSaveFile, residPlotHash):
+        print("VS vs T residual plot for " + candidate + " in " +\
+              residPlotSaveFile + " is up to date\n")
     else:
-        plt.text(115.0, 28.0, r"$VS \,= \," + str(slope)[0:6] +\
-                 "T \,-\, " + str(abs(intercept))[0:6] + r"$")
-
-    plt.text(115.0, 23.0, r"$r^2 = \," + str(rValue**2.0)[0:6] + r"$")
-
-    # Save to file and inform the user.
-    plt.savefig(plotSaveFile, bbox_inches = "tight")
-    plt.close()
-    print "Saved VS vs T plot for", candidate, "to\n", plotSaveFile
-
-    # Plot the residual plot, with a flat line at y = 0 for reference.
-    fig = plt.figure()
-    fig.set_facecolor('white')
-    plt.scatter(xValues, residValues, color = plotColor, s = 20)
-    plt.plot([0.0, 250.0], [0.0, 0.0], 'k--')
-    plt.xlim([0.0, 200.0])
-    plt.ylim([-60.0, 60.0])
-    plt.xlabel("Turnout Percentage")
-    plt.ylabel("Vote Share Residuals")
-    plt.title(residPlotTitle)
-
-    # Save to file and inform the user.
-    plt.savefig(residPlotSaveFile, bbox_inches = "tight")
-    plt.close()
-    print "Saved VS vs T residual plot for", candidate, "to\n",\
-            residPlotSaveFile, "\n"
+        # Plot the residual plot, with a flat line at y = 0 for reference.
+        fig = plt.figure()
+        fig.set_facecolor('white')
+        plt.scatter(xValues, residValues, color = plotColor, s = 20)
+        plt.plot([0.0, 250.0], [0.0, 0.0], 'k--')
+        plt.xlim([0.0, 200.0])
+        plt.ylim([-60.0, 60.0])
+        plt.xlabel("Turnout Percentage")
+        plt.ylabel("Vote Share Residuals")
+        plt.title(residPlotTitle)
+
+        # Save to file and inform the user.
+        saveFigure(residPlotSaveFile, residPlotHash,
+                   bbox_inches = "tight")
+        plt.close()
+        print("Saved VS vs T residual plot for " + candidate + " to\n" +\
+              residPlotSaveFile + "\n")
 
 
 # Main code
@@ -25,12 +25,16 @@
 #
 
 
-import csv
 import numpy as np
-import matplotlib.pyplot as plt
+from lazy_imports import lazyImport
 
 # Import some convenience functions
 from afghan_functions import *
+from afghan_plotting import *
+
+
+# Heavy modules, imported on first use (see lazy_imports.py).
+plt = lazyImport("matplotlib.pyplot")
 
 
 # Constants
@@ -59,19 +63,12 @@ BAR_GRAPH_WMA_PROVINCE = FIGURE_DIR + "wma_by_province.png"
 SCATTER_WMA_DISTRICT = FIGURE_DIR + "wma_by_district.png"
 
 
-# Global variables
-
-# Dicts to track province data (cached to avoid regeneration).
-provinceNumToName = None
-
-
 # This function returns a dictionary that maps province numbers to Ghani's
 # winning margin in that province. The winning margin is defined as the %
 # of votes for Ghani (in that province) minus the % of votes for Abdullah.
 #
 def getProvinceNumToGhaniWinningMargin():
-    # Make sure provinceNumToName is populated.
-    global provinceNumToName
+    # Get the (cached) province names.
     provinceNumToName = populateProvinceNumToName()
 
     # Go through RUNOFF_VOTES_FILE, add up all of the votes for Ghani minus
@@ -81,27 +78,24 @@ def getProvinceNumToGhaniWinningMargin():
     provinceNameToGhaniWinningMarginVotes = dict()
     provinceNameToTotalVotes = dict()
 
-    with open(RUNOFF_VOTES_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
-
-        for row in csvReader:
-            provinceName = row['Province']
-            ghaniVotes = float(row['GhaniVotes'])
-            abdullahVotes = float(row['AbdullahVotes'])
-            totalVotes = float(row['PopulationVoted'])
+    for row in getCsvRows(RUNOFF_VOTES_FILE):
+        provinceName = row['Province']
+        ghaniVotes = float(row['GhaniVotes'])
+        abdullahVotes = float(row['AbdullahVotes'])
+        totalVotes = float(row['PopulationVoted'])
 
-            ghaniWinningMarginVotes = ghaniVotes - abdullahVotes
+        ghaniWinningMarginVotes = ghaniVotes - abdullahVotes
 
-            if provinceName in provinceNameToGhaniWinningMarginVotes:
+        if provinceName in provinceNameToGhaniWinningMarginVotes:
 
-                provinceNameToGhaniWinningMarginVotes[provinceName] += \
-                        ghaniWinningMarginVotes
-                provinceNameToTotalVotes[provinceName] += totalVotes
+            provinceNameToGhaniWinningMarginVotes[provinceName] += \
+                    ghaniWinningMarginVotes
+            provinceNameToTotalVotes[provinceName] += totalVotes
 
-            else:
-                provinceNameToGhaniWinningMarginVotes[provinceName] = \
-                        ghaniWinningMarginVotes
-                provinceNameToTotalVotes[provinceName] = totalVotes
+        else:
+            provinceNameToGhaniWinningMarginVotes[provinceName] = \
+                    ghaniWinningMarginVotes
+            provinceNameToTotalVotes[provinceName] = totalVotes
 
     # Sanity check: both dictionaries should have the same keys.
     assert sorted(provinceNameToGhaniWinningMarginVotes.keys()) == \
@@ -138,33 +132,30 @@ def getProvinceDistrictToGhaniWinningMargin():
     provinceDistrictToGhaniWinningMarginVotes = dict()
     provinceDistrictToTotalVotes = dict()
 
-    with open(RUNOFF_VOTES_FILE, 'rU') as csvFile:
-        csvReader = csv.DictReader(csvFile)
+    for row in getCsvRows(RUNOFF_VOTES_FILE):
+        provinceName = row['Province']
+        districtName = row['District']
+        ghaniVotes = float(row['GhaniVotes'])
+        abdullahVotes = float(row['AbdullahVotes'])
+        totalVotes = float(row['PopulationVoted'])
 
-        for row in csvReader:
-            provinceName = row['Province']
-            districtName = row['District']
-            ghaniVotes = float(row['GhaniVotes'])
-            abdullahVotes = float(row['AbdullahVotes'])
-            totalVotes = float(row['PopulationVoted'])
+        ghaniWinningMarginVotes = ghaniVotes - abdullahVotes
 
-            ghaniWinningMarginVotes = ghaniVotes - abdullahVotes
+        if (provinceName, districtName) in \
+                provinceDistrictToGhaniWinningMarginVotes:
 
-            if (provinceName, districtName) in \
-                    provinceDistrictToGhaniWinningMarginVotes:
+            provinceDistrictToGhaniWinningMarginVotes[\
+                    (provinceName, districtName)] += \
+                    ghaniWinningMarginVotes
+            provinceDistrictToTotalVotes[\
+                    (provinceName, districtName)] += totalVotes
 
-                provinceDistrictToGhaniWinningMarginVotes[\
-                        (provinceName, districtName)] += \
-                        ghaniWinningMarginVotes
-                provinceDistrictToTotalVotes[\
-                        (provinceName, districtName)] += totalVotes
-
-            else:
-                provinceDistrictToGhaniWinningMarginVotes[\
-                        (provinceName, districtName)] = \
-                        ghaniWinningMarginVotes
-                provinceDistrictToTotalVotes[\
-                        (provinceName, districtName)] = totalVotes
+        else:
+            provinceDistrictToGhaniWinningMarginVotes[\
+                    (provinceName, districtName)] = \
+                    ghaniWinningMarginVotes
+            provinceDistrictToTotalVotes[\
+                    (provinceName, districtName)] = totalVotes
 
     # Sanity check: both dictionaries should have the same keys.
     assert sorted(provinceDistrictToGhaniWinningMarginVotes.keys()) == \
@@ -186,52 +177,20 @@ def getProvinceDistrictToGhaniWinningMargin():
     return provinceDistrictToGhaniWinningMarginPct
 
 
-# This function plots and saves two bar graphs that have the same x-axis.
-# It also includes a legend. The two bars for each x-value are separated by
-# "width" along the x-axis.
-#
-# Note: It is assumed that a figure has already been created via
-# plt.figure(). The figure and axes are passed in as arguments.
+# This function plots and saves the two winning margin analysis figures:
+# a combined bar graph of each province's turnout *MINUS* 50% and Ghani's
+# winning margin there (saved to barGraphFile), and a scatterplot of
+# Ghani's district winning margins vs the district turnouts (saved to
+# scatterFile). The province dictionaries are keyed by province number,
+# and the district dictionaries by any district key (e.g. (Province,
+# District) tuples).
 #
-def plotAndSaveCombinedBarGraphs(fig, ax, firstDict, secondDict, width,
-        xLabel, yLabel, legendLabel1, legendLabel2, plotTitle, outputFile):
-
-    # Unpack the first dictionary to get the common x-values
-    keyValuePairs = np.array(firstDict.items())
-    xValues = keyValuePairs[:, 0]
-    firstBarGraphHeights = list()
-    secondBarGraphHeights = list()
-
-    for xVal in xValues:
-        firstBarGraphHeights.append(firstDict[xVal])
-        secondBarGraphHeights.append(secondDict[xVal])
-
-    width = 0.4
-    rects1 = ax.bar(xValues, firstBarGraphHeights, width,
-                    color = '#DB1212')
-    rects2 = ax.bar(xValues + width, secondBarGraphHeights,
-                    width, color = '#1AC08E')
-    ax.set_xlabel(xLabel)
-    ax.set_ylabel(yLabel)
-    ax.set_title(plotTitle)
-
-    ax.legend((rects1[0], rects2[0]), \
-              (legendLabel1, legendLabel2),
-              loc = "upper left",
-              prop = {"size": 10})
-
-    plt.savefig(outputFile, bbox_inches = 'tight')
-    print "Saved combined bar graph to\n", outputFile
-
-
-# Main code
-if __name__ == "__main__":
-    # Get the various dicts we want.
-    provinceNumToTurnout = getProvinceNumToTurnoutRunoff()
-    provinceDistrictToTurnout = getProvinceDistrictToTurnoutRunoff()
-    provinceNumToGhaniWinningMargin = getProvinceNumToGhaniWinningMargin()
-    provinceDistrictToGhaniWinningMargin = \
-            getProvinceDistrictToGhaniWinningMargin()
+def plotWinningMarginAnalysis(provinceNumToTurnout,
+                              provinceNumToGhaniWinningMargin,
+                              provinceDistrictToTurnout,
+                              provinceDistrictToGhaniWinningMargin,
+                              barGraphFile,
+                              scatterFile):
 
     # Subtract off 50% from the province-level turnout data for easy
     # viewing in the dual bar graph.
@@ -255,7 +214,9 @@ if __name__ == "__main__":
                                  "Ghani's Winning Margin (%)",
                                  "Province-Level Ghani Winning " +\
                                          "Margin Analysis",
-                                 BAR_GRAPH_WMA_PROVINCE)
+                                 barGraphFile,
+                                 colors = ('#DB1212', '#1AC08E'),
+                                 legendLocation = "upper left")
     plt.close()
 
     # Plot and save a scatterplot of the district-level Ghani winning
@@ -277,8 +238,19 @@ if __name__ == "__main__":
     plt.xlabel("Turnout Percentage")
     plt.ylabel("Ghani's Winning Margin")
     plt.title("District-Level Ghani Winning Margin Analysis")
-    plt.savefig(SCATTER_WMA_DISTRICT, bbox_inches = 'tight')
+    plt.savefig(scatterFile, bbox_inches = 'tight')
 
-    print "Saved scatterplot of district-level Ghani WMA " +\
-            "to\n", SCATTER_WMA_DISTRICT
+    print("Saved scatterplot of district-level Ghani WMA to\n" +\
+          scatterFile)
     plt.close()
+
+
+# Main code
+if __name__ == "__main__":
+    # Get the various dicts we want, and plot them.
+    plotWinningMarginAnalysis(getProvinceNumToTurnoutRunoff(),
+                              getProvinceNumToGhaniWinningMargin(),
+                              getProvinceDistrictToTurnoutRunoff(),
+                              getProvinceDistrictToGhaniWinningMargin(),
+                              BAR_GRAPH_WMA_PROVINCE,
+                              SCATTER_WMA_DISTRICT)